@@ -7,6 +7,7 @@
     "depends": ["isp_core", "account"],
     "data": [
         "security/ir.model.access.csv",
+        "security/ir_rule.xml",
         "data/parameters.xml",
         "data/mail_template.xml",
         "data/sequence.xml",
@@ -14,7 +15,9 @@
         "data/cron.xml",
         "views/dashboard_views.xml",
         "views/bank_transfer_views.xml",
+        "views/bank_statement_views.xml",
         "views/invoice_report_views.xml",
+        "views/kpi_fact_views.xml",
         "views/subscription_views.xml",
         "views/service_plan_views.xml"
     ],
@@ -3,4 +3,7 @@ from . import subscription
 from . import service_plan
 from . import account_move
 from . import bank_transfer_payment
+from . import fault_ticket
 from . import dashboard
+from . import kpi_fact
+from . import bank_statement
@@ -5,7 +5,7 @@ from odoo import fields, models
 class AccountMove(models.Model):
     _inherit = "account.move"
 
-    isp_subscription_id = fields.Many2one("isp.subscription", ondelete="set null")
+    isp_subscription_id = fields.Many2one("isp.subscription", ondelete="set null", index="btree_not_null")
     isp_sector_id = fields.Many2one(
         "isp.sector",
         related="isp_subscription_id.sector_id",
@@ -18,3 +18,37 @@ class AccountMove(models.Model):
         store=True,
         readonly=True,
     )
+
+    def _post(self, soft=True):
+        posted = super()._post(soft=soft)
+        if posted.filtered("isp_subscription_id"):
+            self.env["isp.dashboard"]._schedule_refresh()
+        return posted
+
+    def button_draft(self):
+        res = super().button_draft()
+        if self.filtered("isp_subscription_id"):
+            self.env["isp.dashboard"]._schedule_refresh()
+        return res
+
+    def button_cancel(self):
+        res = super().button_cancel()
+        if self.filtered("isp_subscription_id"):
+            self.env["isp.dashboard"]._schedule_refresh()
+        return res
+
+
+class AccountMoveLine(models.Model):
+    _inherit = "account.move.line"
+
+    # Payments and their reversal change the billing status of ISP subscriptions.
+    def reconcile(self):
+        res = super().reconcile()
+        if self.move_id.filtered("isp_subscription_id"):
+            self.env["isp.dashboard"]._schedule_refresh()
+        return res
+
+    def remove_move_reconcile(self):
+        if self.move_id.filtered("isp_subscription_id"):
+            self.env["isp.dashboard"]._schedule_refresh()
+        return super().remove_move_reconcile()
@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+import base64
+import csv
+import io
+import logging
+from collections import Counter
+from datetime import timedelta
+from odoo import api, fields, models
+from odoo.exceptions import UserError
+from .statement_matcher import StatementMatcher
+from .statement_parser import StatementFormatError, read_statement, row_key
+
+_logger = logging.getLogger(__name__)
+
+# Statement rows parsed, matched and inserted per create().
+LINE_CHUNK_SIZE = 1000
+
+MATCH_TYPES = [("transfer", "Transfer Payment"), ("invoice", "Invoice")]
+
+
+class IspBankStatementImport(models.Model):
+    """A bank statement file read row by row and matched against pending payments.
+
+    Rows matched with at least ``isp_billing.statement_auto_approve_confidence``
+    are approved in bulk; the others wait on their line for a reviewer.
+    """
+
+    _name = "isp.bank.statement.import"
+    _description = "ISP Bank Statement Import"
+    _order = "id desc"
+
+    name = fields.Char(default="New", readonly=True)
+    bank_name = fields.Char(required=True)
+    file = fields.Binary(string="Statement File", attachment=True, required=True)
+    filename = fields.Char()
+    file_format = fields.Selection(
+        [("auto", "Auto-detect"), ("csv", "CSV"), ("ofx", "OFX"), ("camt", "CAMT.053 XML")],
+        default="auto",
+        required=True,
+    )
+    decimal_separator = fields.Selection(
+        [("auto", "Auto-detect"), (".", "Point (1,234.56)"), (",", "Comma (1.234,56)")],
+        default="auto",
+        required=True,
+        help="Decimal separator of the amounts in CSV files. Auto-detect reads 1.234 as 1.234 and 1,234 as 1234.",
+    )
+    attachment_id = fields.Many2one("ir.attachment", readonly=True, ondelete="set null")
+    state = fields.Selection([("draft", "Draft"), ("imported", "Imported")], default="draft", readonly=True)
+    imported_at = fields.Datetime(readonly=True)
+    line_ids = fields.One2many("isp.bank.statement.line", "import_id", readonly=True)
+    skipped_count = fields.Integer(readonly=True, help="Debits and rows already imported by an earlier statement.")
+    line_count = fields.Integer(compute="_compute_counts")
+    unmatched_count = fields.Integer(compute="_compute_counts")
+    matched_count = fields.Integer(compute="_compute_counts")
+    approved_count = fields.Integer(compute="_compute_counts")
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        for vals in vals_list:
+            if vals.get("name", "New") == "New":
+                vals["name"] = self.env["ir.sequence"].next_by_code("isp.bank.statement.import") or "BSI"
+        return super().create(vals_list)
+
+    def _compute_counts(self):
+        groups = self.env["isp.bank.statement.line"]._read_group(
+            [("import_id", "in", self.ids)], ["import_id", "state"], ["__count"]
+        )
+        counts = {}
+        for statement, state, count in groups:
+            counts.setdefault(statement.id, {})[state] = count
+        for rec in self:
+            by_state = counts.get(rec.id, {})
+            rec.line_count = sum(by_state.values())
+            rec.unmatched_count = by_state.get("unmatched", 0)
+            rec.matched_count = by_state.get("matched", 0)
+            rec.approved_count = by_state.get("approved", 0)
+
+    def _auto_approve_confidence(self):
+        try:
+            return int(self.env["ir.config_parameter"].sudo().get_param("isp_billing.statement_auto_approve_confidence", 90))
+        except (TypeError, ValueError):
+            return 90
+
+    def action_import(self):
+        for rec in self:
+            if rec.state != "draft":
+                raise UserError(f"{rec.name} was already imported.")
+            if not rec.file:
+                raise UserError("Upload a statement file first.")
+            rec._import_file()
+            rec.action_approve_matches()
+
+    def _import_file(self):
+        """Stream the file into lines, matching each chunk before it is inserted."""
+        self.ensure_one()
+        data = base64.b64decode(self.file)
+        self.attachment_id = self.env["ir.attachment"].create(
+            {
+                "name": self.filename or f"{self.name}.statement",
+                "raw": data,
+                "res_model": self._name,
+                "res_id": self.id,
+            }
+        )
+        Line = self.env["isp.bank.statement.line"]
+        matcher = Line._statement_matcher(*Line._pending_match_ids())
+        skipped = 0
+        chunk = []
+        # Rows without a bank id are told apart by their content; identical rows
+        # are only skipped as far as earlier statements already hold them.
+        key_seen = Counter()
+
+        def flush(rows):
+            refs = [row["bank_ref"] for row in rows if row["bank_ref"]]
+            known = set(Line.search([("bank_ref", "in", refs)]).mapped("bank_ref")) if refs else set()
+            keys = {row_key(row) for row in rows if not row["bank_ref"]}
+            key_known = Counter()
+            if keys:
+                for key, count in Line._read_group(
+                    [("dedup_key", "in", list(keys)), ("import_id", "!=", self.id)], ["dedup_key"], ["__count"]
+                ):
+                    key_known[key] = count
+            vals_list = []
+            for row in rows:
+                if row["bank_ref"]:
+                    if row["bank_ref"] in known:
+                        continue
+                    known.add(row["bank_ref"])
+                    vals = self._prepare_line_vals(row, matcher)
+                else:
+                    key = row_key(row)
+                    key_seen[key] += 1
+                    if key_seen[key] <= key_known[key]:
+                        continue
+                    vals = dict(self._prepare_line_vals(row, matcher), dedup_key=key)
+                vals_list.append(vals)
+            Line.create(vals_list)
+            return len(rows) - len(vals_list)
+
+        decimal_separator = None if self.decimal_separator == "auto" else self.decimal_separator
+        try:
+            for row in read_statement(io.BytesIO(data), self.file_format, self.filename, decimal_separator):
+                if row["amount"] <= 0:
+                    skipped += 1
+                    continue
+                chunk.append(row)
+                if len(chunk) >= LINE_CHUNK_SIZE:
+                    skipped += flush(chunk)
+                    chunk = []
+            if chunk:
+                skipped += flush(chunk)
+        except (StatementFormatError, csv.Error, SyntaxError, UnicodeError) as exc:
+            raise UserError(f"Could not read {self.filename or 'the statement'}: {exc}") from exc
+        self.write({"state": "imported", "imported_at": fields.Datetime.now(), "skipped_count": skipped})
+        self.env["isp.audit_log"].sudo().log_action(
+            action="bank_statement_imported",
+            record=self,
+            details=f"{len(self.line_ids)} lines imported, {skipped} skipped",
+        )
+
+    def _prepare_line_vals(self, row, matcher):
+        record, confidence, message = matcher.match(row)
+        return {
+            "import_id": self.id,
+            "date": row["date"],
+            "amount": row["amount"],
+            "reference": row["reference"] or False,
+            "partner_name": row["partner_name"] or False,
+            "account_number": row["account_number"] or False,
+            "description": row["description"] or False,
+            "bank_ref": row["bank_ref"] or False,
+            "state": "matched" if record else "unmatched",
+            "match_type": False if not record else "invoice" if record._name == "account.move" else "transfer",
+            "transfer_id": record.id if record and record._name == "isp.bank.transfer.payment" else False,
+            "invoice_id": record.id if record and record._name == "account.move" else False,
+            "confidence": confidence,
+            "match_message": message,
+        }
+
+    def action_approve_matches(self):
+        threshold = self._auto_approve_confidence()
+        self.line_ids.filtered(lambda line: line.state == "matched" and line.confidence >= threshold)._approve()
+
+    def action_rematch(self):
+        self.line_ids.filtered(lambda line: line.state in ("unmatched", "matched"))._rematch()
+
+    def action_open_lines(self):
+        self.ensure_one()
+        return {
+            "type": "ir.actions.act_window",
+            "name": f"{self.name} Lines",
+            "res_model": "isp.bank.statement.line",
+            "view_mode": "list,form",
+            "domain": [("import_id", "=", self.id)],
+            "context": {"search_default_to_review": 1},
+        }
+
+
+class IspBankStatementLine(models.Model):
+    _name = "isp.bank.statement.line"
+    _description = "ISP Bank Statement Line"
+    _order = "import_id desc, date, id"
+
+    import_id = fields.Many2one("isp.bank.statement.import", required=True, ondelete="cascade", index=True)
+    date = fields.Date(index=True)
+    amount = fields.Monetary(currency_field="currency_id")
+    currency_id = fields.Many2one("res.currency", default=lambda self: self.env.company.currency_id)
+    reference = fields.Char(index="btree_not_null")
+    partner_name = fields.Char()
+    account_number = fields.Char()
+    description = fields.Char()
+    bank_ref = fields.Char(string="Bank Reference", index="btree_not_null", help="Transaction id given by the bank.")
+    dedup_key = fields.Char(
+        index="btree_not_null", readonly=True, help="Hash of date, amount and texts of a row without a bank id."
+    )
+    state = fields.Selection(
+        [
+            ("unmatched", "Unmatched"),
+            ("matched", "Matched"),
+            ("approved", "Approved"),
+            ("ignored", "Ignored"),
+        ],
+        default="unmatched",
+        index=True,
+    )
+    match_type = fields.Selection(MATCH_TYPES)
+    transfer_id = fields.Many2one("isp.bank.transfer.payment", ondelete="set null", index="btree_not_null")
+    invoice_id = fields.Many2one("account.move", ondelete="set null", index="btree_not_null")
+    confidence = fields.Integer(help="0-100; 100 is reference, amount and date matching a transfer.")
+    match_message = fields.Char()
+
+    _amount_date_idx = models.Index("(amount, date)")
+
+    @api.onchange("transfer_id", "invoice_id")
+    def _onchange_match(self):
+        for line in self:
+            if line.transfer_id or line.invoice_id:
+                line.match_type = "transfer" if line.transfer_id else "invoice"
+                line.confidence = 100
+                line.match_message = "Chosen by a reviewer."
+
+    def action_approve(self):
+        self._approve()
+
+    def action_ignore(self):
+        self.write({"state": "ignored"})
+
+    @api.model
+    def _statement_matcher(self, exclude_transfer_ids=(), exclude_invoice_ids=()):
+        """A ``StatementMatcher`` over the ``in_review`` transfers and open invoices, in two queries."""
+        try:
+            days = int(self.env["ir.config_parameter"].sudo().get_param("isp_billing.statement_match_days", 3))
+        except (TypeError, ValueError):
+            days = 3
+        transfers = self.env["isp.bank.transfer.payment"].sudo().search_fetch(
+            [("state", "=", "in_review"), ("id", "not in", list(exclude_transfer_ids))],
+            ["reference", "amount", "transfer_datetime"],
+        )
+        invoices = self.env["account.move"].sudo().search_fetch(
+            [
+                ("move_type", "=", "out_invoice"),
+                ("state", "=", "posted"),
+                ("payment_state", "in", ("not_paid", "partial")),
+                ("amount_residual", ">", 0),
+                ("id", "not in", list(exclude_invoice_ids)),
+            ],
+            ["name", "payment_reference", "amount_residual", "partner_id"],
+        )
+        return StatementMatcher(transfers, invoices, timedelta(days=days), self.env.company.currency_id.round)
+
+    @api.model
+    def _pending_match_ids(self):
+        """Transfers and invoices already proposed by lines still waiting for review."""
+        lines = self.search_fetch([("state", "=", "matched")], ["transfer_id", "invoice_id"])
+        return set(lines.transfer_id.ids), set(lines.invoice_id.ids)
+
+    def _rematch(self):
+        lines = self.filtered(lambda line: line.state in ("unmatched", "matched"))
+        if not lines:
+            return
+        transfer_ids, invoice_ids = self._pending_match_ids()
+        matcher = self._statement_matcher(
+            transfer_ids - set(lines.transfer_id.ids), invoice_ids - set(lines.invoice_id.ids)
+        )
+        for line in lines:
+            vals = line.import_id._prepare_line_vals(line._as_row(), matcher)
+            line.write({key: vals[key] for key in ("state", "match_type", "transfer_id", "invoice_id", "confidence", "match_message")})
+
+    def _as_row(self):
+        return {
+            "date": self.date,
+            "amount": self.amount,
+            "reference": self.reference or "",
+            "partner_name": self.partner_name or "",
+            "account_number": self.account_number or "",
+            "description": self.description or "",
+            "bank_ref": self.bank_ref or "",
+        }
+
+    def _approve(self):
+        """Apply the matched payments, one savepoint per line.
+
+        Transfers are approved as if a reviewer pressed Approve. Invoices
+        matched directly get a transfer created from the statement line, with
+        the statement file as its evidence, and paid the same way.
+        """
+        lines = self.filtered(
+            lambda line: line.state in ("unmatched", "matched") and (line.transfer_id or line.invoice_id)
+        )
+        if not lines:
+            return
+        Transfer = self.env["isp.bank.transfer.payment"]
+        invoice_lines = lines.filtered(lambda line: not line.transfer_id)
+        created = Transfer.create([line._prepare_transfer_vals() for line in invoice_lines])
+        for line, transfer in zip(invoice_lines, created):
+            line.transfer_id = transfer
+        approved_ids = []
+        for line in lines:
+            transfer = line.transfer_id
+            try:
+                with self.env.cr.savepoint():
+                    transfer.write({"reviewer_id": self.env.user.id, "state": "approved"})
+                    transfer._create_and_apply_payment()
+            except Exception as exc:
+                _logger.warning("Could not apply %s from statement line %s: %s", transfer.name, line.id, exc)
+                line.match_message = f"Approval failed: {exc}"
+                if transfer in created:
+                    # The bank saw the money: leave the new transfer to a reviewer.
+                    transfer.needs_attention = True
+                continue
+            approved_ids.append(line.id)
+        approved = self.browse(approved_ids)
+        approved.write({"state": "approved"})
+        transfers = approved.transfer_id
+        self.env["isp.audit_log"].sudo().log_actions(
+            "transfer_approved",
+            transfers,
+            details={
+                line.transfer_id.id: f"Transfer approved {line.transfer_id.name} from statement {line.import_id.name}"
+                for line in approved
+            },
+        )
+        transfers._send_template("isp_billing.mail_template_transfer_approved")
+
+    def _prepare_transfer_vals(self):
+        self.ensure_one()
+        invoice = self.invoice_id
+        return {
+            "partner_id": invoice.partner_id.commercial_partner_id.id,
+            "subscription_id": invoice.isp_subscription_id.id,
+            "invoice_ids": [(6, 0, invoice.ids)],
+            "bank_name": self.import_id.bank_name,
+            "reference": self.reference or self.bank_ref or self.import_id.name,
+            "amount": self.amount,
+            "currency_id": self.currency_id.id,
+            "transfer_datetime": fields.Datetime.to_datetime(self.date) if self.date else fields.Datetime.now(),
+            "attachment_ids": [(6, 0, self.import_id.attachment_id.ids)],
+            "notes": f"Created from bank statement {self.import_id.name}: {self.description or ''}".strip(),
+            "state": "in_review",
+        }
@@ -2,6 +2,7 @@
 from datetime import timedelta
 from odoo import api, fields, models
 from odoo.exceptions import ValidationError
+from odoo.addons.isp_core.models.metrics import METRICS
 
 
 class IspBankTransferPayment(models.Model):
@@ -46,8 +47,15 @@ class IspBankTransferPayment(models.Model):
         records = super().create(vals_list)
         for rec in records:
             rec._set_review_deadline()
+        self.env["isp.dashboard"]._schedule_refresh()
         return records
 
+    def write(self, vals):
+        res = super().write(vals)
+        if "state" in vals or "needs_attention" in vals:
+            self.env["isp.dashboard"]._schedule_refresh()
+        return res
+
     def _set_review_deadline(self):
         review_hours = int(self.env["ir.config_parameter"].sudo().get_param("isp_billing.transfer_review_hours", "48"))
         attention_hours = int(self.env["ir.config_parameter"].sudo().get_param("isp_billing.transfer_attention_hours", "24"))
@@ -145,14 +153,15 @@ class IspBankTransferPayment(models.Model):
 
     @api.model
     def _cron_transfer_deadlines(self):
-        now = fields.Datetime.now()
-        records = self.search([
-            ("state", "=", "in_review"),
-            ("attention_deadline", "!=", False),
-            ("attention_deadline", "<=", now),
-        ])
-        for rec in records:
-            rec.needs_attention = True
+        with METRICS.track_cron("transfer_deadlines"):
+            now = fields.Datetime.now()
+            records = self.search([
+                ("state", "=", "in_review"),
+                ("attention_deadline", "!=", False),
+                ("attention_deadline", "<=", now),
+            ])
+            for rec in records:
+                rec.needs_attention = True
 
     def _send_template(self, xmlid):
         template = self.env.ref(xmlid, raise_if_not_found=False)
@@ -1,106 +1,189 @@
 # -*- coding: utf-8 -*-
-from datetime import date
+from datetime import date, timedelta
 from dateutil.relativedelta import relativedelta
 from odoo import api, fields, models
+from odoo.addons.isp_core.models.metrics import METRICS
 
 
 class IspDashboard(models.Model):
+    """Snapshot of the ISP KPIs, refreshed by a cron and soon after the events that move them.
+
+    Opening the dashboard only reads the stored row.
+    """
+
     _name = "isp.dashboard"
     _description = "ISP Dashboard"
     _rec_name = "name"
 
     name = fields.Char(default="ISP Dashboard")
     currency_id = fields.Many2one("res.currency", default=lambda self: self.env.company.currency_id)
-    active_subscriptions = fields.Integer(compute="_compute_metrics", store=False)
-    up_to_date_subscriptions = fields.Integer(compute="_compute_metrics", store=False)
-    suspended_subscriptions = fields.Integer(compute="_compute_metrics", store=False)
-    overdue_subscriptions = fields.Integer(compute="_compute_metrics", store=False)
-    grace_subscriptions = fields.Integer(compute="_compute_metrics", store=False)
-    mrr = fields.Monetary(compute="_compute_metrics", store=False, currency_field="currency_id")
-    invoices_month = fields.Monetary(compute="_compute_metrics", store=False, currency_field="currency_id")
-    transfer_pending = fields.Integer(compute="_compute_metrics", store=False)
-    transfer_attention = fields.Integer(compute="_compute_metrics", store=False)
-    faults_open = fields.Integer(compute="_compute_metrics", store=False)
-    faults_closed = fields.Integer(compute="_compute_metrics", store=False)
-    avg_resolution_hours = fields.Float(compute="_compute_metrics", store=False)
-    top_overdue_sectors = fields.Char(compute="_compute_metrics", store=False)
-
-    @api.depends_context("uid")
-    def _compute_metrics(self):
+    refreshed_at = fields.Datetime(string="Last Refresh", readonly=True)
+    active_subscriptions = fields.Integer(readonly=True)
+    up_to_date_subscriptions = fields.Integer(readonly=True)
+    suspended_subscriptions = fields.Integer(readonly=True)
+    overdue_subscriptions = fields.Integer(readonly=True)
+    grace_subscriptions = fields.Integer(readonly=True)
+    mrr = fields.Monetary(readonly=True, currency_field="currency_id")
+    invoices_month = fields.Monetary(readonly=True, currency_field="currency_id")
+    transfer_pending = fields.Integer(readonly=True)
+    transfer_attention = fields.Integer(readonly=True)
+    faults_open = fields.Integer(readonly=True)
+    faults_closed = fields.Integer(readonly=True)
+    avg_resolution_hours = fields.Float(readonly=True)
+    top_overdue_sectors = fields.Char(readonly=True)
+
+    def action_refresh(self):
+        self._refresh_snapshot()
+
+    @api.model
+    def _cron_refresh_snapshot(self):
+        with METRICS.track_cron("dashboard_refresh"):
+            self._refresh_snapshot()
+
+    @api.model
+    def _refresh_snapshot(self):
+        values = self._get_snapshot_values()
+        values["refreshed_at"] = fields.Datetime.now()
+        self.sudo().search([]).write(values)
+
+    @api.model
+    def _schedule_refresh(self):
+        """Ask the refresh cron to run shortly; called by the events that move the KPIs.
+
+        Only one trigger is created per transaction, so bulk operations cost one insert.
+        """
+        data = self.env.cr.precommit.data
+        if data.get("isp.dashboard.refresh"):
+            return
+        data["isp.dashboard.refresh"] = True
+        self.env.cr.precommit.add(self._trigger_refresh)
+
+    @api.model
+    def _trigger_refresh(self):
+        cron = self.env.ref("isp_billing.ir_cron_isp_dashboard_refresh", raise_if_not_found=False)
+        if cron:
+            delay = int(self.env["ir.config_parameter"].sudo().get_param("isp_billing.dashboard_refresh_delay", 60))
+            cron.sudo()._trigger(fields.Datetime.now() + timedelta(seconds=delay))
+
+    @api.model
+    def _get_snapshot_values(self):
         today = fields.Date.today()
         month_start = date(today.year, today.month, 1)
         month_end = month_start + relativedelta(months=1, days=-1)
-        Subscription = self.env["isp.subscription"].sudo()
         Move = self.env["account.move"].sudo()
         Transfer = self.env["isp.bank.transfer.payment"].sudo()
         Fault = self.env["isp.fault.ticket"].sudo()
 
-        active_subs = Subscription.search_count([("state", "=", "active")])
-        suspended_subs = Subscription.search_count([("state", "=", "suspended")])
-        status_map = self._get_subscription_status_map()
-        overdue_subs = sum(1 for status in status_map.values() if status == "in_arrears")
-        grace_subs = sum(1 for status in status_map.values() if status == "grace")
-        up_to_date_subs = sum(1 for status in status_map.values() if status == "up_to_date")
-        mrr_total = sum(Subscription.search([("state", "=", "active")]).mapped("plan_id.price"))
-        invoices_month = sum(Move.search([
-            ("move_type", "=", "out_invoice"),
-            ("state", "=", "posted"),
-            ("invoice_date", ">=", month_start),
-            ("invoice_date", "<=", month_end),
-        ]).mapped("amount_total"))
-        transfer_pending = Transfer.search_count([("state", "=", "in_review")])
-        transfer_attention = Transfer.search_count([("state", "=", "in_review"), ("needs_attention", "=", True)])
-        faults_open = Fault.search_count([("state", "not in", ("resolved", "closed"))])
-        faults_closed = Fault.search_count([("state", "in", ("resolved", "closed"))])
-        resolution_group = Fault.read_group(
-            [("state", "in", ("resolved", "closed")), ("resolution_time_hours", ">", 0)],
-            ["resolution_time_hours:avg"],
-            [],
+        kpis = self._get_kpi_values()
+        totals = {}
+        for (metric, _sector_id, _plan_id), value in kpis.items():
+            totals[metric] = totals.get(metric, 0) + value
+        invoices_month = Move._read_group(
+            [
+                ("move_type", "=", "out_invoice"),
+                ("state", "=", "posted"),
+                ("invoice_date", ">=", month_start),
+                ("invoice_date", "<=", month_end),
+            ],
+            aggregates=["amount_total:sum"],
+        )[0][0]
+        transfers = dict(Transfer._read_group([("state", "=", "in_review")], ["needs_attention"], ["__count"]))
+        faults_closed_domain = [("state", "in", ("resolved", "closed"))]
+        avg_resolution = Fault._read_group(
+            faults_closed_domain + [("resolution_time_hours", ">", 0)],
+            aggregates=["resolution_time_hours:avg"],
+        )[0][0]
+        return {
+            "active_subscriptions": totals.get("active_subscriptions", 0),
+            "up_to_date_subscriptions": totals.get("up_to_date_subscriptions", 0),
+            "suspended_subscriptions": totals.get("suspended_subscriptions", 0),
+            "overdue_subscriptions": totals.get("arrears_subscriptions", 0),
+            "grace_subscriptions": totals.get("grace_subscriptions", 0),
+            "mrr": totals.get("mrr", 0.0),
+            "invoices_month": invoices_month or 0.0,
+            "transfer_pending": sum(transfers.values()),
+            "transfer_attention": transfers.get(True, 0),
+            "faults_open": totals.get("faults_open", 0),
+            "faults_closed": Fault.search_count(faults_closed_domain),
+            "avg_resolution_hours": avg_resolution or 0.0,
+            "top_overdue_sectors": self._get_top_overdue_sectors(),
+        }
+
+    @api.model
+    def _get_kpi_values(self, date_from=None, date_to=None):
+        """KPI values keyed by ``(metric, sector id, plan id)``.
+
+        Stock metrics (see ``kpi_fact.KPI_METRICS``) are taken as of now. Flow metrics
+        are counted over ``[date_from, date_to)`` and left out without a range.
+        The snapshot and the ``isp.kpi.fact`` history both come from here.
+        """
+        Subscription = self.env["isp.subscription"].sudo()
+        Fault = self.env["isp.fault.ticket"].sudo()
+        no_plan = self.env["isp.service_plan"]
+        values = {}
+
+        def add(metric, sector, plan, value):
+            key = (metric, sector.id or False, plan.id or False)
+            values[key] = values.get(key, 0) + value
+
+        groups = Subscription._read_group(
+            [("state", "in", ("active", "suspended"))],
+            ["sector_id", "plan_id", "state", "billing_status"],
+            ["__count", "open_balance:sum"],
         )
-        avg_resolution = resolution_group[0]["resolution_time_hours_avg"] if resolution_group else 0.0
-        top_overdue = self._get_top_overdue_sectors()
-
-        for rec in self:
-            rec.active_subscriptions = active_subs
-            rec.up_to_date_subscriptions = up_to_date_subs
-            rec.suspended_subscriptions = suspended_subs
-            rec.overdue_subscriptions = overdue_subs
-            rec.grace_subscriptions = grace_subs
-            rec.mrr = mrr_total
-            rec.invoices_month = invoices_month
-            rec.transfer_pending = transfer_pending
-            rec.transfer_attention = transfer_attention
-            rec.faults_open = faults_open
-            rec.faults_closed = faults_closed
-            rec.avg_resolution_hours = avg_resolution
-            rec.top_overdue_sectors = top_overdue
-
-    def _get_subscription_status_map(self):
-        today = fields.Date.today()
-        grace_days = int(self.env["ir.config_parameter"].sudo().get_param("isp_billing.grace_days", "5"))
-        subs = self.env["isp.subscription"].sudo().search([("state", "=", "active")])
-        status_map = {sub.id: "up_to_date" for sub in subs}
-        if not subs:
-            return status_map
-        moves = self.env["account.move"].sudo().search([
-            ("isp_subscription_id", "in", subs.ids),
-            ("state", "=", "posted"),
-            ("payment_state", "not in", ("paid", "in_payment")),
-            ("invoice_date_due", "!=", False),
-        ])
-        for move in moves:
-            sub_id = move.isp_subscription_id.id
-            if not sub_id:
+        for sector, plan, state, billing_status, count, open_balance in groups:
+            add("open_balance", sector, plan, open_balance or 0.0)
+            if state == "suspended":
+                add("suspended_subscriptions", sector, plan, count)
                 continue
-            due_date = move.invoice_date_due
-            if not due_date:
-                continue
-            if due_date + relativedelta(days=grace_days) >= today:
-                if status_map.get(sub_id) != "in_arrears":
-                    status_map[sub_id] = "grace"
-            else:
-                status_map[sub_id] = "in_arrears"
-        return status_map
+            add("active_subscriptions", sector, plan, count)
+            add("mrr", sector, plan, plan.price * count)
+            status_metric = {"grace": "grace_subscriptions", "in_arrears": "arrears_subscriptions"}
+            add(status_metric.get(billing_status, "up_to_date_subscriptions"), sector, plan, count)
+        for sector, count in Fault._read_group([("state", "not in", ("resolved", "closed"))], ["sector_id"], ["__count"]):
+            add("faults_open", sector, no_plan, count)
+        if date_from is None or date_to is None:
+            return values
+
+        for sector, plan, count in Subscription._read_group(
+            [("create_date", ">=", date_from), ("create_date", "<", date_to)], ["sector_id", "plan_id"], ["__count"]
+        ):
+            add("new_subscriptions", sector, plan, count)
+        terminated_ids = [
+            subscription.id
+            for subscription, in self.env["isp.provisioning_job"].sudo()._read_group(
+                [
+                    ("job_type", "=", "terminate_subscription"),
+                    ("state", "=", "success"),
+                    ("subscription_id", "!=", False),
+                    ("executed_at", ">=", date_from),
+                    ("executed_at", "<", date_to),
+                ],
+                ["subscription_id"],
+            )
+        ]
+        if terminated_ids:
+            for sector, plan, count in Subscription._read_group(
+                [("id", "in", terminated_ids)], ["sector_id", "plan_id"], ["__count"]
+            ):
+                add("churned_subscriptions", sector, plan, count)
+        for sector, plan, amount in self.env["account.move"].sudo()._read_group(
+            [
+                ("move_type", "=", "out_invoice"),
+                ("state", "=", "posted"),
+                ("isp_subscription_id", "!=", False),
+                ("invoice_date", ">=", date_from.date()),
+                ("invoice_date", "<", date_to.date()),
+            ],
+            ["isp_sector_id", "isp_plan_id"],
+            ["amount_total_signed:sum"],
+        ):
+            add("invoiced_amount", sector, plan, amount or 0.0)
+        for sector, count in Fault._read_group(
+            [("opened_at", ">=", date_from), ("opened_at", "<", date_to)], ["sector_id"], ["__count"]
+        ):
+            add("faults_opened", sector, no_plan, count)
+        return values
 
     def _get_top_overdue_sectors(self):
         Move = self.env["account.move"].sudo()
@@ -159,25 +242,21 @@ class IspDashboard(models.Model):
         }
 
     def action_open_up_to_date_subscriptions(self):
-        status_map = self._get_subscription_status_map()
-        ids = [sid for sid, status in status_map.items() if status == "up_to_date"]
         return {
             "type": "ir.actions.act_window",
             "name": "Up to Date Subscriptions",
             "res_model": "isp.subscription",
             "view_mode": "list,form",
-            "domain": [("id", "in", ids)],
+            "domain": [("state", "=", "active"), ("billing_status", "=", "up_to_date")],
         }
 
     def action_open_in_arrears_subscriptions(self):
-        status_map = self._get_subscription_status_map()
-        ids = [sid for sid, status in status_map.items() if status == "in_arrears"]
         return {
             "type": "ir.actions.act_window",
             "name": "Subscriptions in Arrears",
             "res_model": "isp.subscription",
             "view_mode": "list,form",
-            "domain": [("id", "in", ids)],
+            "domain": [("state", "=", "active"), ("billing_status", "=", "in_arrears")],
         }
 
     def action_open_transfer_pending(self):
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from odoo import api, models
+
+
+class IspFaultTicket(models.Model):
+    _inherit = "isp.fault.ticket"
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.env["isp.dashboard"]._schedule_refresh()
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        if "state" in vals:
+            self.env["isp.dashboard"]._schedule_refresh()
+        return res
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta, timezone
+from dateutil.relativedelta import relativedelta
+from odoo import api, fields, models
+from odoo.exceptions import UserError
+from odoo.addons.isp_core.models.metrics import METRICS
+
+# metric: (label, kind). Stocks are levels taken at capture time and filed under
+# the period the capture runs in; flows are counted over completed periods. A
+# month keeps the last day's stock and the sum of the flows.
+KPI_METRICS = {
+    "mrr": ("MRR", "stock"),
+    "active_subscriptions": ("Active Subscriptions", "stock"),
+    "up_to_date_subscriptions": ("Up to Date Subscriptions", "stock"),
+    "grace_subscriptions": ("Subscriptions in Grace", "stock"),
+    "arrears_subscriptions": ("Subscriptions in Arrears", "stock"),
+    "suspended_subscriptions": ("Suspended Subscriptions", "stock"),
+    "open_balance": ("Open Balance", "stock"),
+    "faults_open": ("Open Faults", "stock"),
+    "new_subscriptions": ("New Subscriptions", "flow"),
+    "churned_subscriptions": ("Churned Subscriptions", "flow"),
+    "invoiced_amount": ("Invoiced Amount", "flow"),
+    "faults_opened": ("Faults Opened", "flow"),
+}
+
+KPI_PERIODS = {
+    "hour": relativedelta(hours=1),
+    "day": relativedelta(days=1),
+    "month": relativedelta(months=1),
+}
+
+# Invoices are dated, not timestamped: hourly facts cannot split them.
+DAILY_ONLY_METRICS = ("invoiced_amount",)
+
+# Completed periods whose flows a capture fills in when earlier runs were missed.
+BACKFILL_LIMIT = {"hour": 48, "day": 31}
+
+DEFAULT_SERIES_SPAN = {
+    "hour": relativedelta(hours=48),
+    "day": relativedelta(days=30),
+    "month": relativedelta(months=12),
+}
+
+
+def _period_start(value, period):
+    value = value.replace(minute=0, second=0, microsecond=0)
+    if period in ("day", "month"):
+        value = value.replace(hour=0)
+    if period == "month":
+        value = value.replace(day=1)
+    return value
+
+
+class IspKpiFact(models.Model):
+    """KPI history: one row per metric, sector and plan per period (UTC).
+
+    Written by the capture crons from the same aggregation as the dashboard
+    snapshot (``isp.dashboard._get_kpi_values``), rolled up into months and
+    pruned by retention parameters. ``get_series`` reads it for charts.
+    """
+
+    _name = "isp.kpi.fact"
+    _description = "ISP KPI History"
+    _order = "period_start desc, metric"
+
+    period = fields.Selection([("hour", "Hour"), ("day", "Day"), ("month", "Month")], required=True, readonly=True)
+    period_start = fields.Datetime(required=True, readonly=True, help="Start of the period, in UTC.")
+    metric = fields.Selection(
+        [(metric, label) for metric, (label, _kind) in KPI_METRICS.items()], required=True, readonly=True
+    )
+    sector_id = fields.Many2one("isp.sector", ondelete="set null", readonly=True)
+    plan_id = fields.Many2one("isp.service_plan", ondelete="set null", readonly=True)
+    value = fields.Float(readonly=True)
+
+    _period_metric_idx = models.Index("(period, metric, period_start)")
+
+    @api.model
+    def _cron_capture_hourly(self):
+        if self.env["ir.config_parameter"].sudo().get_param("isp_billing.kpi_hourly") not in ("1", "true", "True"):
+            return
+        with METRICS.track_cron("kpi_capture_hourly"):
+            current = _period_start(fields.Datetime.now(), "hour")
+            for start in self._missed_periods("hour", current, "isp_billing.ir_cron_isp_kpi_capture_hourly"):
+                self._capture("hour", start, "flow")
+            self._capture("hour", current, "stock")
+
+    @api.model
+    def _cron_capture_daily(self):
+        with METRICS.track_cron("kpi_capture_daily"):
+            today = _period_start(fields.Datetime.now(), "day")
+            days = self._missed_periods("day", today, "isp_billing.ir_cron_isp_kpi_capture_daily")
+            for day in days:
+                self._capture("day", day, "flow")
+            self._capture("day", today, "stock")
+            for month_start in sorted({_period_start(day, "month") for day in days + [today]}):
+                self._rollup_month(month_start)
+            self._apply_retention()
+
+    @api.model
+    def _missed_periods(self, period, current, cron_xmlid):
+        """Completed periods since the cron's previous run, oldest first, at most ``BACKFILL_LIMIT``."""
+        step = KPI_PERIODS[period]
+        first = current - step
+        cron = self.env.ref(cron_xmlid, raise_if_not_found=False)
+        if cron and cron.sudo().lastcall:
+            first = max(_period_start(cron.sudo().lastcall, period), current - step * BACKFILL_LIMIT[period])
+        periods = []
+        while first < current:
+            periods.append(first)
+            first += step
+        return periods
+
+    @api.model
+    def _capture(self, period, start, kind):
+        """Replace the ``kind`` (stock or flow) facts of the period starting at ``start``.
+
+        Stocks can only be read as of now, so they go to the current period.
+        """
+        metrics = tuple(metric for metric, (_label, metric_kind) in KPI_METRICS.items() if metric_kind == kind)
+        if kind == "flow":
+            values = self.env["isp.dashboard"]._get_kpi_values(start, start + KPI_PERIODS[period])
+        else:
+            values = self.env["isp.dashboard"]._get_kpi_values()
+        self.env.cr.execute(
+            "DELETE FROM isp_kpi_fact WHERE period = %s AND period_start = %s AND metric IN %s",
+            (period, start, metrics),
+        )
+        self.invalidate_model()
+        return self.sudo().create(
+            [
+                {
+                    "period": period,
+                    "period_start": start,
+                    "metric": metric,
+                    "sector_id": sector_id,
+                    "plan_id": plan_id,
+                    "value": value,
+                }
+                for (metric, sector_id, plan_id), value in values.items()
+                if value and metric in metrics and not (period == "hour" and metric in DAILY_ONLY_METRICS)
+            ]
+        )
+
+    @api.model
+    def _rollup_month(self, month_start):
+        """Rebuild the month row from its daily facts in one statement."""
+        self.flush_model()
+        month_end = month_start + KPI_PERIODS["month"]
+        self.env.cr.execute("DELETE FROM isp_kpi_fact WHERE period = 'month' AND period_start = %s", (month_start,))
+        self.env.cr.execute(
+            """
+            WITH days AS (
+                SELECT *, max(period_start) OVER (PARTITION BY metric) AS last_start
+                  FROM isp_kpi_fact
+                 WHERE period = 'day' AND period_start >= %(start)s AND period_start < %(end)s
+            )
+            INSERT INTO isp_kpi_fact
+                   (period, period_start, metric, sector_id, plan_id, value,
+                    create_uid, create_date, write_uid, write_date)
+            SELECT 'month', %(start)s, metric, sector_id, plan_id,
+                   sum(value) FILTER (WHERE metric IN %(flows)s OR period_start = last_start),
+                   %(uid)s, now() AT TIME ZONE 'UTC', %(uid)s, now() AT TIME ZONE 'UTC'
+              FROM days
+             GROUP BY metric, sector_id, plan_id
+            HAVING sum(value) FILTER (WHERE metric IN %(flows)s OR period_start = last_start) IS NOT NULL
+            """,
+            {
+                "start": month_start,
+                "end": month_end,
+                "flows": tuple(metric for metric, (_label, kind) in KPI_METRICS.items() if kind == "flow"),
+                "uid": self.env.uid,
+            },
+        )
+        self.invalidate_model()
+
+    @api.model
+    def _apply_retention(self):
+        """Drop hourly and daily facts past their retention; monthly rows are kept."""
+        params = self.env["ir.config_parameter"].sudo()
+        now = fields.Datetime.now()
+        for period, key, default in (
+            ("hour", "isp_billing.kpi_hourly_retention_days", 14),
+            ("day", "isp_billing.kpi_daily_retention_days", 800),
+        ):
+            try:
+                days = int(params.get_param(key, default))
+            except (TypeError, ValueError):
+                days = default
+            if days > 0:
+                self.env.cr.execute(
+                    "DELETE FROM isp_kpi_fact WHERE period = %s AND period_start < %s",
+                    (period, now - timedelta(days=days)),
+                )
+        self.invalidate_model()
+
+    @api.model
+    def get_series(self, metric, period="day", date_from=None, date_to=None, sector_id=None, plan_id=None, split_by=None):
+        """Chart-ready series of ``metric``.
+
+        Returns ``{"labels": [...], "series": [{"name", "id", "data"}]}`` with one
+        label per period between ``date_from`` and ``date_to`` (UTC, both
+        included), missing periods filled with 0. ``split_by`` is ``sector_id``
+        or ``plan_id`` for one series per sector or plan; otherwise the facts
+        matching the sector/plan filters are summed into a single series.
+        """
+        if metric not in KPI_METRICS:
+            raise UserError(f"Unknown KPI metric: {metric}")
+        if period not in KPI_PERIODS:
+            raise UserError(f"Unknown KPI period: {period}")
+        if split_by not in (None, "sector_id", "plan_id"):
+            raise UserError(f"Cannot split KPI series by {split_by}")
+        self.check_access("read")
+
+        date_to = _period_start(fields.Datetime.to_datetime(date_to) or fields.Datetime.now(), period)
+        date_from = _period_start(
+            fields.Datetime.to_datetime(date_from) or date_to - DEFAULT_SERIES_SPAN[period], period
+        )
+        labels = []
+        cursor = date_from
+        while cursor <= date_to:
+            labels.append(cursor)
+            cursor += KPI_PERIODS[period]
+
+        domain = [
+            ("period", "=", period),
+            ("metric", "=", metric),
+            ("period_start", ">=", date_from),
+            ("period_start", "<=", date_to),
+        ]
+        if sector_id:
+            domain.append(("sector_id", "=", sector_id))
+        if plan_id:
+            domain.append(("plan_id", "=", plan_id))
+        # Period starts fall on whole hours: grouping by hour keeps them as stored.
+        # _read_group applies the record rules, so other sectors' facts and names stay out.
+        groups = self.with_context(tz="UTC")._read_group(
+            domain, ["period_start:hour"] + ([split_by] if split_by else []), ["value:sum"]
+        )
+        points = {}
+        names = {}
+        for start, *key, value in groups:
+            if start.tzinfo:
+                start = start.astimezone(timezone.utc).replace(tzinfo=None)
+            record = key[0] if key else None
+            if record:
+                names[record.id] = record.display_name
+            points.setdefault(record.id if record else None, {})[start] = value
+
+        if split_by:
+            keys = sorted(points, key=lambda k: (not k, names.get(k, "")))
+        else:
+            keys = [None]
+        return {
+            "metric": metric,
+            "period": period,
+            "labels": [fields.Datetime.to_string(label) for label in labels],
+            "series": [
+                {
+                    "id": key or False,
+                    "name": names.get(key, "Undefined") if split_by else KPI_METRICS[metric][0],
+                    "data": [points.get(key, {}).get(label, 0.0) for label in labels],
+                }
+                for key in keys
+            ],
+        }
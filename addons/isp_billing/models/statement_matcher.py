@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""Matching of bank statement rows against pending transfers and open invoices.
+
+Kept free of Odoo imports: the matcher works on any objects carrying the
+fields it reads (``_name``, ``id``, ``name``, ``reference``, ``amount`` and
+``transfer_datetime`` for transfers; ``_name``, ``id``, ``name``,
+``payment_reference``, ``amount_residual`` and ``partner_id.name`` for
+invoices), so it can be tested on its own.
+"""
+import re
+
+TOKEN_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9/_.\-]*")
+
+
+def _normalize(reference):
+    return re.sub(r"[^A-Z0-9]", "", (reference or "").upper())
+
+
+def _tokens(*texts):
+    """Normalized references found in free text (whole values first, then words)."""
+    found = []
+    for text in texts:
+        for token in [text or ""] + TOKEN_RE.findall(text or ""):
+            token = _normalize(token)
+            if len(token) >= 4 and token not in found:
+                found.append(token)
+    return found
+
+
+class StatementMatcher:
+    """In-memory indexes of the ``in_review`` transfers and open invoices.
+
+    Built from two queries before a statement is read; every row is then
+    matched with dict lookups on reference and amount. A transfer or invoice
+    is handed to one row only. ``window`` is the ``timedelta`` a row's date may
+    differ from a transfer's; ``round_amount`` rounds to the currency.
+
+    Only reference, amount and date together reach the default auto-approval
+    score of 90; a date outside the window scores 85.
+    """
+
+    def __init__(self, transfers, invoices, window, round_amount=lambda amount: round(amount, 2)):
+        self.window = window
+        self.round_amount = round_amount
+        self.taken = set()
+        self.transfers_by_ref, self.transfers_by_amount = {}, {}
+        for transfer in transfers:
+            self.transfers_by_ref.setdefault(_normalize(transfer.reference), []).append(transfer)
+            self.transfers_by_amount.setdefault(self._key(transfer.amount), []).append(transfer)
+        self.invoices_by_ref, self.invoices_by_amount = {}, {}
+        for invoice in invoices:
+            for reference in {_normalize(invoice.name), _normalize(invoice.payment_reference)} - {""}:
+                self.invoices_by_ref.setdefault(reference, []).append(invoice)
+            self.invoices_by_amount.setdefault(self._key(invoice.amount_residual), []).append(invoice)
+
+    def _key(self, amount):
+        return self.round_amount(amount or 0.0)
+
+    def _free(self, records):
+        return [record for record in records if (record._name, record.id) not in self.taken]
+
+    def _in_window(self, transfer, day):
+        if not day or not transfer.transfer_datetime:
+            return False
+        return abs(transfer.transfer_datetime.date() - day) <= self.window
+
+    def match(self, row):
+        """Return ``(record, confidence, message)`` for a statement row, or ``(None, 0, message)``."""
+        amount = self._key(row["amount"])
+        tokens = _tokens(row["reference"], row["description"])
+        best = (None, 0, "No transfer or invoice matches this row.")
+        for token in tokens:
+            for transfer in self._free(self.transfers_by_ref.get(token, ())):
+                if self._key(transfer.amount) != amount:
+                    candidate = (transfer, 50, f"Reference matches {transfer.name} but the amount is {transfer.amount}.")
+                elif self._in_window(transfer, row["date"]):
+                    candidate = (transfer, 100, f"Reference, amount and date match {transfer.name}.")
+                else:
+                    candidate = (transfer, 85, f"Reference and amount match {transfer.name}; the date is off.")
+                best = max(best, candidate, key=lambda item: item[1])
+            for invoice in self._free(self.invoices_by_ref.get(token, ())):
+                if self._key(invoice.amount_residual) == amount:
+                    candidate = (invoice, 95, f"Reference and amount match invoice {invoice.name}.")
+                else:
+                    candidate = (invoice, 40, f"Reference matches invoice {invoice.name} but {invoice.amount_residual} is due.")
+                best = max(best, candidate, key=lambda item: item[1])
+        if best[1] < 60:
+            same_amount = [
+                transfer
+                for transfer in self._free(self.transfers_by_amount.get(amount, ()))
+                if self._in_window(transfer, row["date"])
+            ]
+            if len(same_amount) == 1:
+                best = (same_amount[0], 60, f"Only {same_amount[0].name} has this amount around this date.")
+        if best[1] < 60 and row["partner_name"]:
+            name = row["partner_name"].strip().lower()
+            same_payer = [
+                invoice
+                for invoice in self._free(self.invoices_by_amount.get(amount, ()))
+                if (invoice.partner_id.name or "").strip().lower() == name
+            ]
+            if len(same_payer) == 1:
+                best = (same_payer[0], 70, f"Payer and amount match invoice {same_payer[0].name}.")
+        if best[0]:
+            self.taken.add((best[0]._name, best[0].id))
+        return best
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""Streaming readers for bank statement files.
+
+Each reader takes a binary file object and yields one dict per transaction
+with the keys of ``EMPTY_ROW``, without building the whole statement in
+memory: CSV goes through ``csv.reader``, CAMT.053 through ``iterparse`` (each
+entry is cleared once read) and OFX, SGML or XML, through a tag scanner fed
+line by line.
+"""
+import csv
+import hashlib
+import io
+import re
+from datetime import datetime
+from xml.etree.ElementTree import iterparse
+
+EMPTY_ROW = {
+    "date": None,
+    "amount": 0.0,
+    "reference": "",
+    "partner_name": "",
+    "account_number": "",
+    "description": "",
+    "bank_ref": "",
+}
+
+# Normalized CSV header -> row key. The first matching column wins.
+CSV_COLUMNS = {
+    "date": "date",
+    "fecha": "date",
+    "value date": "date",
+    "booking date": "date",
+    "transaction date": "date",
+    "fecha valor": "date",
+    "amount": "amount",
+    "monto": "amount",
+    "importe": "amount",
+    "credit": "amount",
+    "credito": "amount",
+    "crédito": "amount",
+    "reference": "reference",
+    "referencia": "reference",
+    "ref": "reference",
+    "payment reference": "reference",
+    "name": "partner_name",
+    "payer": "partner_name",
+    "counterparty": "partner_name",
+    "nombre": "partner_name",
+    "ordenante": "partner_name",
+    "account": "account_number",
+    "account number": "account_number",
+    "cuenta": "account_number",
+    "description": "description",
+    "descripcion": "description",
+    "descripción": "description",
+    "concepto": "description",
+    "memo": "description",
+    "id": "bank_ref",
+    "transaction id": "bank_ref",
+    "bank reference": "bank_ref",
+}
+
+DATE_FORMATS = ("%Y-%m-%d", "%d/%m/%Y", "%m/%d/%Y", "%d-%m-%Y", "%Y%m%d", "%d.%m.%Y")
+
+OFX_TAG = re.compile(r"<(/?)([A-Za-z0-9.]+)>([^<]*)")
+
+
+class StatementFormatError(ValueError):
+    pass
+
+
+def parse_date(value):
+    value = (value or "").strip()
+    if not value:
+        return None
+    # OFX dates carry a time and a zone after the day; CAMT ones may carry a time.
+    if re.match(r"^\d{8}", value):
+        value = value[:8]
+    elif "T" in value:
+        value = value.split("T", 1)[0]
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    raise StatementFormatError(f"Unrecognized date: {value}")
+
+
+def parse_amount(value, decimal_separator=None):
+    """Parse ``1,234.56``, ``1.234,56``, ``-12`` or ``(12.00)``.
+
+    With ``decimal_separator`` (``"."`` or ``","``) the other one is taken as a
+    thousands separator. Without it the last separator is the decimal one,
+    except a lone comma followed by three digits or a repeated separator
+    (``1,234``, ``1.234.567``); a lone point is always decimal (``1.234``).
+    """
+    value = (value or "").strip().replace(" ", "").replace("\xa0", "").replace("'", "")
+    if not value:
+        return 0.0
+    negative = value.startswith("(") and value.endswith(")")
+    value = value.strip("()").lstrip("$€")
+    if decimal_separator == ".":
+        value = value.replace(",", "")
+    elif decimal_separator == ",":
+        value = value.replace(".", "").replace(",", ".")
+    elif "," in value and "." in value:
+        if value.rfind(",") > value.rfind("."):
+            value = value.replace(".", "").replace(",", ".")
+        else:
+            value = value.replace(",", "")
+    elif value.count(",") > 1 or value.count(".") > 1:
+        value = value.replace(",", "").replace(".", "")
+    elif "," in value:
+        head, _, tail = value.rpartition(",")
+        value = f"{head}.{tail}" if len(tail) != 3 else head + tail
+    try:
+        amount = float(value)
+    except ValueError:
+        raise StatementFormatError(f"Unrecognized amount: {value}") from None
+    return -amount if negative else amount
+
+
+def row_key(row):
+    """Hash of what identifies a row without a bank id: date, amount and texts."""
+    payload = "|".join(
+        [
+            row["date"].isoformat() if row["date"] else "",
+            f"{row['amount']:.2f}",
+            row["reference"],
+            row["partner_name"],
+            row["account_number"],
+            row["description"],
+        ]
+    )
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
+def detect_format(head, filename=None):
+    """Guess ``csv``, ``ofx`` or ``camt`` from the first bytes and the file name."""
+    name = (filename or "").lower()
+    sample = head.lstrip(b"\xef\xbb\xbf \t\r\n").lower()
+    if name.endswith(".ofx") or sample.startswith(b"ofxheader") or b"<ofx>" in sample:
+        return "ofx"
+    if sample.startswith(b"<?xml") or sample.startswith(b"<document") or name.endswith(".xml"):
+        return "camt"
+    return "csv"
+
+
+def read_csv(stream, encoding="utf-8-sig", decimal_separator=None):
+    text = io.TextIOWrapper(stream, encoding=encoding, errors="replace", newline="")
+    sample = text.read(4096)
+    text.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t|")
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(text, dialect)
+    header = next(reader, None)
+    if not header:
+        return
+    columns = {}
+    for index, title in enumerate(header):
+        key = CSV_COLUMNS.get(title.strip().lower())
+        if key and key not in columns:
+            columns[key] = index
+    if "date" not in columns or "amount" not in columns:
+        raise StatementFormatError("The CSV header needs at least a date and an amount column.")
+    for cells in reader:
+        if not any(cell.strip() for cell in cells):
+            continue
+        raw = {key: cells[index].strip() if index < len(cells) else "" for key, index in columns.items()}
+        row = dict(EMPTY_ROW, **raw)
+        row["date"] = parse_date(raw["date"])
+        row["amount"] = parse_amount(raw["amount"], decimal_separator)
+        yield row
+
+
+def read_ofx(stream, encoding="utf-8"):
+    text = io.TextIOWrapper(stream, encoding=encoding, errors="replace")
+    row = None
+    for line in text:
+        for closing, tag, value in OFX_TAG.findall(line):
+            tag = tag.upper()
+            if tag == "STMTTRN":
+                if closing and row is not None:
+                    yield row
+                    row = None
+                elif not closing:
+                    row = dict(EMPTY_ROW)
+                continue
+            if row is None or closing:
+                continue
+            value = value.strip()
+            if tag in ("DTPOSTED", "DTUSER") and (tag == "DTPOSTED" or not row["date"]):
+                row["date"] = parse_date(value)
+            elif tag == "TRNAMT":
+                row["amount"] = parse_amount(value)
+            elif tag == "FITID":
+                row["bank_ref"] = value
+            elif tag in ("REFNUM", "CHECKNUM") and not row["reference"]:
+                row["reference"] = value
+            elif tag == "NAME":
+                row["partner_name"] = value
+            elif tag == "MEMO":
+                row["description"] = value
+            elif tag == "ACCTID":
+                row["account_number"] = value
+    if row is not None:
+        # SGML files may leave the last transaction unclosed.
+        yield row
+
+
+def _local(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def _find_text(element, *path):
+    """Text of the first descendant along ``path`` of local names, ignoring namespaces."""
+    nodes = [element]
+    for name in path:
+        nodes = [child for node in nodes for child in node if _local(child.tag) == name]
+        if not nodes:
+            return ""
+    return (nodes[0].text or "").strip()
+
+
+def read_camt(stream):
+    """CAMT.053/054 ``Ntry`` elements; debits come out negative."""
+    for _event, element in iterparse(stream, events=("end",)):
+        if _local(element.tag) != "Ntry":
+            continue
+        amount = parse_amount(_find_text(element, "Amt"))
+        if _find_text(element, "CdtDbtInd") == "DBIT":
+            amount = -amount
+        details = ("NtryDtls", "TxDtls")
+        date = next(
+            (
+                text
+                for text in (_find_text(element, name, kind) for name in ("ValDt", "BookgDt") for kind in ("Dt", "DtTm"))
+                if text
+            ),
+            "",
+        )
+        row = dict(
+            EMPTY_ROW,
+            date=parse_date(date),
+            amount=amount,
+            bank_ref=_find_text(element, "AcctSvcrRef") or _find_text(element, *details, "Refs", "AcctSvcrRef"),
+            reference=_find_text(element, *details, "RmtInf", "Strd", "CdtrRefInf", "Ref")
+            or _find_text(element, *details, "Refs", "EndToEndId"),
+            description=_find_text(element, *details, "RmtInf", "Ustrd") or _find_text(element, "AddtlNtryInf"),
+            partner_name=_find_text(element, *details, "RltdPties", "Dbtr", "Nm")
+            or _find_text(element, *details, "RltdPties", "Dbtr", "Pty", "Nm"),
+            account_number=_find_text(element, *details, "RltdPties", "DbtrAcct", "Id", "IBAN")
+            or _find_text(element, *details, "RltdPties", "DbtrAcct", "Id", "Othr", "Id"),
+        )
+        if row["reference"] == "NOTPROVIDED":
+            row["reference"] = ""
+        element.clear()
+        yield row
+
+
+READERS = {"csv": read_csv, "ofx": read_ofx, "camt": read_camt}
+
+
+def read_statement(stream, file_format=None, filename=None, decimal_separator=None):
+    """Yield the transactions of a binary, seekable ``stream``.
+
+    ``decimal_separator`` applies to CSV amounts; OFX and CAMT always use a point.
+    """
+    if not file_format or file_format == "auto":
+        file_format = detect_format(stream.read(512), filename)
+        stream.seek(0)
+    if file_format == "csv":
+        return read_csv(stream, decimal_separator=decimal_separator)
+    return READERS[file_format](stream)
@@ -1,7 +1,19 @@
 # -*- coding: utf-8 -*-
-from datetime import timedelta
+import logging
 from dateutil.relativedelta import relativedelta
 from odoo import api, fields, models
+from odoo.addons.isp_core.models.metrics import METRICS
+
+_logger = logging.getLogger(__name__)
+
+# Progress of the current invoicing run, "<run date>:<last subscription id>".
+INVOICE_CHECKPOINT_PARAM = "isp_billing.invoice_run_checkpoint"
+
+BILLING_STATUSES = [
+    ("up_to_date", "Up to date"),
+    ("grace", "Grace period"),
+    ("in_arrears", "In arrears"),
+]
 
 
 class IspSubscription(models.Model):
@@ -9,18 +21,104 @@ class IspSubscription(models.Model):
 
     last_invoice_id = fields.Many2one("account.move", ondelete="set null")
     transfer_payment_ids = fields.One2many("isp.bank.transfer.payment", "subscription_id")
+    isp_invoice_ids = fields.One2many("account.move", "isp_subscription_id")
+    billing_status = fields.Selection(
+        BILLING_STATUSES, compute="_compute_billing_status", store=True, index=True, readonly=True
+    )
+    oldest_unpaid_due_date = fields.Date(compute="_compute_billing_status", store=True, readonly=True)
+    open_balance = fields.Monetary(
+        compute="_compute_billing_status", store=True, readonly=True, currency_field="billing_currency_id"
+    )
+    billing_currency_id = fields.Many2one(related="plan_id.currency_id")
     portal_status = fields.Char(compute="_compute_portal_status", store=False)
 
-    def action_generate_invoice(self):
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self.env["isp.dashboard"]._schedule_refresh()
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        if "state" in vals or "plan_id" in vals:
+            self.env["isp.dashboard"]._schedule_refresh()
+        return res
+
+    @api.depends(
+        "isp_invoice_ids.state",
+        "isp_invoice_ids.payment_state",
+        "isp_invoice_ids.amount_residual_signed",
+        "isp_invoice_ids.invoice_date_due",
+    )
+    def _compute_billing_status(self):
+        """Recomputed by the ORM when invoices post, get paid or reset; the grace rollover cron covers time."""
+        today = fields.Date.context_today(self)
+        grace_days = self._get_grace_days()
+        unpaid = {}
+        if self._origin.ids:
+            groups = self.env["account.move"].sudo()._read_group(
+                [
+                    ("isp_subscription_id", "in", self._origin.ids),
+                    ("state", "=", "posted"),
+                    ("payment_state", "not in", ("paid", "in_payment")),
+                    ("invoice_date_due", "!=", False),
+                ],
+                ["isp_subscription_id"],
+                ["invoice_date_due:min", "amount_residual_signed:sum"],
+            )
+            unpaid = {sub.id: (oldest, balance) for sub, oldest, balance in groups}
         for sub in self:
-            sub._generate_invoice()
+            oldest, balance = unpaid.get(sub._origin.id, (False, 0.0))
+            sub.oldest_unpaid_due_date = oldest
+            sub.open_balance = balance
+            if not oldest:
+                sub.billing_status = "up_to_date"
+            elif oldest + relativedelta(days=grace_days) >= today:
+                sub.billing_status = "grace"
+            else:
+                sub.billing_status = "in_arrears"
+
+    @api.model
+    def _get_grace_days(self):
+        """Days after the oldest unpaid due date during which a subscription is in grace."""
+        try:
+            return max(int(self.env["ir.config_parameter"].sudo().get_param("isp_billing.grace_days", 5)), 0)
+        except (TypeError, ValueError):
+            return 5
+
+    @api.model
+    def _cron_billing_grace_rollover(self):
+        """Recompute the subscriptions whose grace window opened or closed since the last run."""
+        with METRICS.track_cron("billing_grace_rollover"):
+            limit = fields.Date.context_today(self) - relativedelta(days=self._get_grace_days())
+            subs = self.search(
+                [
+                    "|",
+                    "&",
+                    ("billing_status", "=", "grace"),
+                    ("oldest_unpaid_due_date", "<", limit),
+                    "&",
+                    ("billing_status", "=", "in_arrears"),
+                    ("oldest_unpaid_due_date", ">=", limit),
+                ]
+            )
+            self.env.add_to_compute(self._fields["billing_status"], subs)
+            subs.flush_recordset()
+            if subs:
+                self.env["isp.dashboard"]._schedule_refresh()
+
+    def action_generate_invoice(self):
+        self._generate_invoices()
 
     def _generate_invoice(self):
         self.ensure_one()
-        if not self.partner_id:
-            return False
+        moves = self._generate_invoices()
+        return moves[:1] or False
+
+    def _prepare_invoice_vals(self):
+        self.ensure_one()
         plan = self.plan_id
-        move_vals = {
+        return {
             "move_type": "out_invoice",
             "partner_id": self.partner_id.id,
             "invoice_date": fields.Date.today(),
@@ -35,95 +133,147 @@ class IspSubscription(models.Model):
                 })
             ],
         }
-        move = self.env["account.move"].create(move_vals)
+
+    def _generate_invoices(self):
+        """Invoice every subscription of ``self`` with one create, one post and one audit create."""
+        subs = self.filtered("partner_id")
+        if not subs:
+            return self.env["account.move"]
+        moves = self.env["account.move"].create([sub._prepare_invoice_vals() for sub in subs])
         try:
-            move.action_post()
+            with self.env.cr.savepoint():
+                moves.action_post()
         except Exception:
-            # Leave in draft if posting fails.
-            pass
-        self.last_invoice_id = move.id
-        self.next_invoice_date = (self.next_invoice_date or fields.Date.today()) + relativedelta(months=1)
-        self.env["isp.audit_log"].sudo().log_action(
-            action="invoice_generated",
-            record=self,
-            details=f"Invoice {move.name or move.id} generated",
+            # Post one by one; moves that cannot be posted stay in draft.
+            for move in moves:
+                try:
+                    with self.env.cr.savepoint():
+                        move.action_post()
+                except Exception:
+                    _logger.warning("Could not post invoice %s of subscription %s", move.id, move.isp_subscription_id.id)
+        today = fields.Date.today()
+        for sub, move in zip(subs, moves):
+            sub.last_invoice_id = move
+            sub.next_invoice_date = (sub.next_invoice_date or today) + relativedelta(months=1)
+        self.env["isp.audit_log"].sudo().log_actions(
+            "invoice_generated",
+            subs,
+            details={move.isp_subscription_id.id: f"Invoice {move.name or move.id} generated" for move in moves},
         )
-        return move
+        return moves
 
     @api.model
     def _cron_generate_invoices(self):
-        today = fields.Date.today()
-        subs = self.search([
-            ("state", "=", "active"),
-            ("next_invoice_date", "!=", False),
-            ("next_invoice_date", "<=", today),
-        ])
-        for sub in subs:
-            sub._generate_invoice()
+        """Invoice due subscriptions in chunks, committing each one.
+
+        The last invoiced subscription id is checkpointed, so a run that
+        crashed resumes where it stopped instead of retrying failing chunks.
+        """
+        with METRICS.track_cron("generate_invoices"):
+            params = self.env["ir.config_parameter"].sudo()
+            batch_size = int(params.get_param("isp_billing.invoice_batch_size", 200))
+            today = fields.Date.today()
+            run, _, last_id = (params.get_param(INVOICE_CHECKPOINT_PARAM) or "").partition(":")
+            last_id = int(last_id) if run == str(today) and last_id.isdigit() else 0
+            while True:
+                subs = self.search(
+                    [
+                        ("state", "=", "active"),
+                        ("next_invoice_date", "!=", False),
+                        ("next_invoice_date", "<=", today),
+                        ("id", ">", last_id),
+                    ],
+                    order="id",
+                    limit=batch_size,
+                )
+                if not subs:
+                    break
+                try:
+                    with self.env.cr.savepoint():
+                        subs._generate_invoices()
+                except Exception:
+                    _logger.exception("Invoice chunk failed, invoicing its %s subscriptions one by one", len(subs))
+                    for sub in subs:
+                        try:
+                            with self.env.cr.savepoint():
+                                sub._generate_invoices()
+                        except Exception:
+                            _logger.exception("Could not invoice subscription %s", sub.id)
+                last_id = subs[-1].id
+                params.set_param(INVOICE_CHECKPOINT_PARAM, f"{today}:{last_id}")
+                self.env.cr.commit()
+                self.env.invalidate_all()
+            params.set_param(INVOICE_CHECKPOINT_PARAM, False)
 
     @api.model
     def _cron_suspend_overdue(self):
-        today = fields.Date.today()
-        suspend_param = int(self.env["ir.config_parameter"].sudo().get_param("isp_billing.suspend_after_days", "10"))
-        moves = self.env["account.move"].search([
-            ("isp_subscription_id", "!=", False),
-            ("state", "=", "posted"),
-            ("payment_state", "not in", ("paid", "in_payment")),
-        ])
-        for move in moves:
-            sub = move.isp_subscription_id
-            if not sub or sub.state != "active":
-                continue
-            days = sub.plan_id.suspend_after_days or suspend_param
-            due_date = move.invoice_date_due or move.invoice_date
-            if not due_date:
-                continue
-            if today >= due_date + timedelta(days=days):
-                sub._queue_job("suspend_subscription")
+        with METRICS.track_cron("suspend_overdue"):
+            suspend_param = int(self.env["ir.config_parameter"].sudo().get_param("isp_billing.suspend_after_days", "10"))
+            to_suspend = self.browse(self._get_overdue_subscription_ids(fields.Date.today(), suspend_param))
+            to_suspend.with_context(isp_job_lane="billing")._queue_jobs("suspend_subscription")
+
+    @api.model
+    def _get_overdue_subscription_ids(self, today, suspend_after_days):
+        """Active subscriptions with a posted unpaid invoice past the plan's (or the global) suspension delay."""
+        self.env.flush_all()
+        self.env.cr.execute(
+            """
+            SELECT DISTINCT sub.id
+              FROM account_move move
+              JOIN isp_subscription sub ON sub.id = move.isp_subscription_id
+              LEFT JOIN isp_service_plan plan ON plan.id = sub.plan_id
+             WHERE sub.state = 'active'
+               AND move.state = 'posted'
+               AND move.payment_state NOT IN ('paid', 'in_payment')
+               AND COALESCE(move.invoice_date_due, move.invoice_date)
+                   + COALESCE(NULLIF(plan.suspend_after_days, 0), %s) <= %s
+             ORDER BY sub.id
+            """,
+            [suspend_after_days, today],
+        )
+        return [row[0] for row in self.env.cr.fetchall()]
 
     @api.model
     def _cron_reconnect_on_payment(self):
-        subs = self.search([("state", "=", "suspended")])
-        for sub in subs:
-            open_count = self.env["account.move"].search_count([
-                ("isp_subscription_id", "=", sub.id),
-                ("state", "=", "posted"),
-                ("payment_state", "not in", ("paid", "in_payment")),
-            ])
-            if open_count == 0:
-                sub._queue_job("reconnect_subscription")
+        with METRICS.track_cron("reconnect_on_payment"):
+            to_reconnect = self.browse(self._get_paid_up_suspended_ids())
+            to_reconnect.with_context(isp_job_lane="billing")._queue_jobs("reconnect_subscription")
+
+    @api.model
+    def _get_paid_up_suspended_ids(self):
+        """Suspended subscriptions without open posted invoices nor a reconnection already queued or running."""
+        self.env.flush_all()
+        self.env.cr.execute(
+            """
+            SELECT sub.id
+              FROM isp_subscription sub
+             WHERE sub.state = 'suspended'
+               AND NOT EXISTS (
+                   SELECT 1
+                     FROM account_move move
+                    WHERE move.isp_subscription_id = sub.id
+                      AND move.state = 'posted'
+                      AND move.payment_state NOT IN ('paid', 'in_payment')
+               )
+               AND NOT EXISTS (
+                   SELECT 1
+                     FROM isp_provisioning_job job
+                    WHERE job.subscription_id = sub.id
+                      AND job.job_type = 'reconnect_subscription'
+                      AND job.state IN ('queued', 'running')
+               )
+             ORDER BY sub.id
+            """
+        )
+        return [row[0] for row in self.env.cr.fetchall()]
 
+    @api.depends("state", "billing_status")
     def _compute_portal_status(self):
-        today = fields.Date.today()
-        grace_days = int(self.env["ir.config_parameter"].sudo().get_param("isp_billing.grace_days", "5"))
+        labels = dict(BILLING_STATUSES)
         for sub in self:
             if sub.state == "suspended":
                 sub.portal_status = "Suspended"
-                continue
-            if sub.state != "active":
-                sub.portal_status = sub.state.capitalize()
-                continue
-            overdue_count = self.env["account.move"].search_count([
-                ("isp_subscription_id", "=", sub.id),
-                ("state", "=", "posted"),
-                ("payment_state", "not in", ("paid", "in_payment")),
-                ("invoice_date_due", "!=", False),
-            ])
-            is_in_grace = False
-            if overdue_count:
-                overdue_invoices = self.env["account.move"].search([
-                    ("isp_subscription_id", "=", sub.id),
-                    ("state", "=", "posted"),
-                    ("payment_state", "not in", ("paid", "in_payment")),
-                    ("invoice_date_due", "!=", False),
-                ])
-                for inv in overdue_invoices:
-                    if inv.invoice_date_due and inv.invoice_date_due + relativedelta(days=grace_days) >= today:
-                        is_in_grace = True
-                        break
-            if overdue_count and not is_in_grace:
-                sub.portal_status = "In arrears"
-            elif overdue_count and is_in_grace:
-                sub.portal_status = "Grace period"
+            elif sub.state != "active":
+                sub.portal_status = (sub.state or "").capitalize()
             else:
-                sub.portal_status = "Up to date"
+                sub.portal_status = labels.get(sub.billing_status or "up_to_date")
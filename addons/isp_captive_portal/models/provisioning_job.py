@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 from odoo import models
 from odoo.exceptions import UserError
-from odoo.addons.isp_mikrotik.models.routeros_client import get_routeros_client, LibRouterosError
+from odoo.addons.isp_mikrotik.models.routeros_client import LibRouterosError
 
 
 class IspProvisioningJob(models.Model):
@@ -12,7 +12,7 @@ class IspProvisioningJob(models.Model):
         if rec.router_id:
             return rec.router_id
         if rec.sector_id:
-            router = Router.search([("sector_id", "=", rec.sector_id.id)], limit=1)
+            router = Router.browse(Router._router_id_for_sector(rec.sector_id.id) or [])
             if router:
                 return router
         raise UserError("No MikroTik router found for captive operation.")
@@ -24,22 +24,22 @@ class IspProvisioningJob(models.Model):
             raise UserError("captive_user_id missing in payload.")
         user = self.env["isp.captive.user"].browse(user_id)
         router = self._get_router_for_captive(user)
-        client = get_routeros_client(self.env, router)
         profile = user.profile or "default"
-        try:
-            client.cmd(
-                "/ip/hotspot/user/add",
-                name=user.username,
-                password=user.password or "",
-                profile=profile,
-                disabled="no",
-                comment=user.sector_id.code if user.sector_id else "",
-            )
-        except LibRouterosError:
-            client.cmd(
-                "/ip/hotspot/user/set",
-                **{"numbers": user.username, "profile": profile, "disabled": "no"},
-            )
+        with self._routeros_session(router) as client:
+            try:
+                client.cmd(
+                    "/ip/hotspot/user/add",
+                    name=user.username,
+                    password=user.password or "",
+                    profile=profile,
+                    disabled="no",
+                    comment=user.sector_id.code if user.sector_id else "",
+                )
+            except LibRouterosError:
+                client.cmd(
+                    "/ip/hotspot/user/set",
+                    **{"numbers": user.username, "profile": profile, "disabled": "no"},
+                )
         user.state = "active"
 
     def _handle_captive_user_disable(self):
@@ -49,14 +49,14 @@ class IspProvisioningJob(models.Model):
             raise UserError("captive_user_id missing in payload.")
         user = self.env["isp.captive.user"].browse(user_id)
         router = self._get_router_for_captive(user)
-        client = get_routeros_client(self.env, router)
-        try:
-            client.cmd(
-                "/ip/hotspot/user/set",
-                **{"numbers": user.username, "disabled": "yes"},
-            )
-        except LibRouterosError:
-            return
+        with self._routeros_session(router) as client:
+            try:
+                client.cmd(
+                    "/ip/hotspot/user/set",
+                    **{"numbers": user.username, "disabled": "yes"},
+                )
+            except LibRouterosError:
+                return
         user.state = "disabled"
 
     def _handle_walled_garden_apply(self):
@@ -66,11 +66,11 @@ class IspProvisioningJob(models.Model):
             raise UserError("walled_garden_id missing in payload.")
         wg = self.env["isp.captive.walled_garden"].browse(wg_id)
         router = self._get_router_for_captive(wg)
-        client = get_routeros_client(self.env, router)
-        try:
-            client.cmd(
-                "/ip/hotspot/walled-garden/add",
-                **{"dst-host": wg.domain},
-            )
-        except LibRouterosError:
-            return
+        with self._routeros_session(router) as client:
+            try:
+                client.cmd(
+                    "/ip/hotspot/walled-garden/add",
+                    **{"dst-host": wg.domain},
+                )
+            except LibRouterosError:
+                return
@@ -26,7 +26,8 @@
         "views/job_views.xml",
         "views/audit_views.xml",
         "views/audit_report_views.xml",
-        "views/isp_menu.xml"
+        "views/isp_menu.xml",
+        "views/job_report_views.xml"
     ],
     "demo": [
         "demo/isp_demo.xml",
@@ -1,2 +1,3 @@
 # -*- coding: utf-8 -*-
 from . import mac_onboarding
+from . import metrics
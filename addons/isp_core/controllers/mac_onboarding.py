@@ -3,11 +3,17 @@ import json
 import secrets
 from odoo import fields, http
 from odoo.http import request, Response
+from odoo.addons.isp_core.models.metrics import METRICS
 
 
 class IspMacOnboardingController(http.Controller):
     @http.route("/isp/mac_onboarding", type="http", auth="public", csrf=False, methods=["GET", "POST"])
     def mac_onboarding(self, **kw):
+        response = self._mac_onboarding(**kw)
+        METRICS.inc("isp_mac_onboarding_requests_total", {"status": response.status_code})
+        return response
+
+    def _mac_onboarding(self, **kw):
         env = request.env
         token = kw.get("token") or request.httprequest.headers.get("X-ISP-TOKEN")
         expected = env["ir.config_parameter"].sudo().get_param("isp_core.mac_onboarding_token")
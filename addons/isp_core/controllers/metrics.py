@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+import hmac
+from odoo import http
+from odoo.http import request, Response
+
+
+class IspMetricsController(http.Controller):
+    @http.route("/isp/metrics", type="http", auth="public", csrf=False, methods=["GET"])
+    def metrics(self, **kw):
+        env = request.env
+        expected = env["ir.config_parameter"].sudo().get_param("isp_core.metrics_token")
+        if not expected:
+            return Response("metrics_token not configured", status=403)
+        token = kw.get("token")
+        authorization = request.httprequest.headers.get("Authorization") or ""
+        if authorization.startswith("Bearer "):
+            token = authorization[len("Bearer "):]
+        if not token or not hmac.compare_digest(token, expected):
+            return Response("unauthorized", status=401)
+        body = env["isp.metrics"].sudo()._render()
+        return Response(body, status=200, content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -11,3 +11,4 @@ from . import network_site
 from . import res_partner
 from . import res_users
 from . import mac_profile
+from . import metrics
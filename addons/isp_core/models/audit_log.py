@@ -25,3 +25,23 @@ class IspAuditLog(models.Model):
             "details": details or "",
         }
         return self.create(vals)
+
+    @api.model
+    def log_actions(self, action, records, details=None):
+        """Log ``action`` once per record of ``records`` with a single create.
+
+        ``details`` is either one text for all records or a dict keyed by record id.
+        """
+        vals_list = []
+        for record in records:
+            text = details.get(record.id) if isinstance(details, dict) else details
+            vals_list.append(
+                {
+                    "action": action,
+                    "record_model": record._name,
+                    "record_id": record.id,
+                    "record_name": record.display_name,
+                    "details": text or "",
+                }
+            )
+        return self.create(vals_list)
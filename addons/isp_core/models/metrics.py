@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""Process-local metrics exported at ``/isp/metrics`` in Prometheus text format.
+
+Every Odoo process (prefork worker, cron worker, threaded server) keeps its
+counters and histograms in memory and dumps them every few seconds (and at
+exit) to one JSON file per process in a shared directory. A scrape merges
+those files, so it never reads more than a handful of small files plus the
+few aggregate queries of ``isp.metrics``. Files of processes gone for a day
+are folded into ``retired.json`` so counters never go down.
+"""
+import atexit
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from odoo import api, models
+from odoo.tools import config
+
+try:
+    import fcntl
+except ImportError:  # Windows: scrapes are not run from several processes there
+    fcntl = None
+
+_logger = logging.getLogger(__name__)
+
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ROUTEROS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+CRON_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 900, 1800, 3600)
+
+# name: (type, help, histogram buckets)
+METRIC_DEFINITIONS = {
+    "isp_job_executions_total": ("counter", "Provisioning job executions by job type and resulting state.", None),
+    "isp_job_duration_seconds": ("histogram", "Provisioning job execution time.", SECONDS_BUCKETS),
+    "isp_job_queue_wait_seconds": ("histogram", "Time jobs waited in the queue before being claimed.", SECONDS_BUCKETS),
+    "isp_routeros_commands_total": ("counter", "RouterOS API commands sent, per router.", None),
+    "isp_routeros_request_seconds": ("histogram", "RouterOS API request latency (one command or one pipelined batch).", ROUTEROS_BUCKETS),
+    "isp_routeros_errors_total": ("counter", "RouterOS API errors per router and kind.", None),
+    "isp_healthcheck_runs_total": ("counter", "Router healthchecks by result.", None),
+    "isp_healthcheck_duration_seconds": ("histogram", "Fleet healthcheck run time.", SECONDS_BUCKETS),
+    "isp_mac_onboarding_requests_total": ("counter", "MAC onboarding webhook requests by result.", None),
+    "isp_cron_runs_total": ("counter", "ISP cron runs by cron and result.", None),
+    "isp_cron_duration_seconds": ("histogram", "ISP cron run time.", CRON_BUCKETS),
+    "isp_cron_last_success_timestamp_seconds": ("gauge", "Unix time of the last successful cron run.", None),
+}
+
+# Files of processes silent for this long (recycled workers) are folded into
+# RETIRED_FILE, which keeps their counters and histograms.
+STALE_FILE_SECONDS = 86400
+RETIRED_FILE = "retired.json"
+
+
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in (labels or {}).items()))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def _merge(merged, data):
+    """Add a serialized registry to ``merged`` (counters, histograms, gauges dicts)."""
+    counters, histograms, gauges = merged
+    for name, labels, value in data.get("counters", ()):
+        key = (name, tuple(map(tuple, labels)))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, value in data.get("histograms", ()):
+        key = (name, tuple(map(tuple, labels)))
+        current = histograms.get(key)
+        if current is None:
+            histograms[key] = {"buckets": list(value["buckets"]), "sum": value["sum"], "count": value["count"]}
+            continue
+        current["buckets"] = [a + b for a, b in zip(current["buckets"], value["buckets"])]
+        current["sum"] += value["sum"]
+        current["count"] += value["count"]
+    for name, labels, value, stamp in data.get("gauges", ()):
+        key = (name, tuple(map(tuple, labels)))
+        if key not in gauges or gauges[key][1] < stamp:
+            gauges[key] = (value, stamp)
+    return merged
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    """Counters, histograms and gauges of this process, flushed to ``<directory>/<host>-<pid>.json``."""
+
+    def __init__(self, directory=None, flush_interval=5.0):
+        self._directory = directory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._reset()
+        if hasattr(os, "register_at_fork"):
+            # A forked worker starts from zero; the parent's values stay in the parent's file.
+            os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.flush)
+
+    def _reset(self):
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._last_flush = 0.0
+        self._dirty = False
+        self._flushed = None
+        # Threads do not survive a fork: the child schedules its own timer.
+        self._timer = None
+
+    @property
+    def directory(self):
+        return self._directory or config.get("isp_metrics_dir") or os.path.join(config["data_dir"], "isp_metrics")
+
+    def inc(self, name, labels=None, value=1):
+        with self._lock:
+            key = (name, _label_key(labels))
+            self._counters[key] = self._counters.get(key, 0) + value
+            self._dirty = True
+        self._maybe_flush()
+
+    def observe(self, name, value, labels=None):
+        buckets = METRIC_DEFINITIONS[name][2]
+        with self._lock:
+            key = (name, _label_key(labels))
+            data = self._histograms.get(key)
+            if data is None:
+                data = self._histograms[key] = {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    data["buckets"][index] += 1
+            data["sum"] += value
+            data["count"] += 1
+            self._dirty = True
+        self._maybe_flush()
+
+    def set(self, name, value, labels=None):
+        with self._lock:
+            self._gauges[(name, _label_key(labels))] = (value, time.time())
+            self._dirty = True
+        self._maybe_flush()
+
+    @contextmanager
+    def track_cron(self, cron):
+        """Time a cron run and count it as ``ok`` or ``error``."""
+        started = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self.inc("isp_cron_runs_total", {"cron": cron, "result": "error"})
+            raise
+        finally:
+            self.observe("isp_cron_duration_seconds", time.monotonic() - started, {"cron": cron})
+        self.inc("isp_cron_runs_total", {"cron": cron, "result": "ok"})
+        self.set("isp_cron_last_success_timestamp_seconds", time.time(), {"cron": cron})
+
+    def _maybe_flush(self):
+        """Flush now if the interval passed, else make sure a timer flushes later.
+
+        The timer exports the last values of a worker that goes idle.
+        """
+        wait = self.flush_interval - (time.monotonic() - self._last_flush)
+        if wait <= 0:
+            self.flush()
+            return
+        with self._lock:
+            if self._timer is not None:
+                return
+            self._timer = threading.Timer(wait, self._flush_from_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_from_timer(self):
+        with self._lock:
+            self._timer = None
+        self.flush()
+
+    def _serialize(self):
+        return {
+            "counters": [[name, labels, value] for (name, labels), value in self._counters.items()],
+            "histograms": [[name, labels, data] for (name, labels), data in self._histograms.items()],
+            "gauges": [[name, labels, value, stamp] for (name, labels), (value, stamp) in self._gauges.items()],
+        }
+
+    def flush(self):
+        directory = self.directory
+        path = os.path.join(directory, f"{socket.gethostname()}-{os.getpid()}.json")
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._dirty:
+                return
+            if self._flushed is not None and not os.path.exists(path):
+                # Folded into RETIRED_FILE while this process sat idle: keep only what came since.
+                self._subtract(json.loads(self._flushed))
+            data = self._flushed = json.dumps(self._serialize())
+            self._dirty = False
+        try:
+            os.makedirs(directory, exist_ok=True)
+            tmp = f"{path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as handle:
+                handle.write(data)
+            os.replace(tmp, path)
+        except OSError as exc:
+            _logger.warning("Could not write ISP metrics to %s: %s", path, exc)
+
+    def _subtract(self, data):
+        for name, labels, value in data["counters"]:
+            key = (name, tuple(map(tuple, labels)))
+            self._counters[key] = self._counters.get(key, 0) - value
+        for name, labels, value in data["histograms"]:
+            current = self._histograms.get((name, tuple(map(tuple, labels))))
+            if current is not None:
+                current["buckets"] = [a - b for a, b in zip(current["buckets"], value["buckets"])]
+                current["sum"] -= value["sum"]
+                current["count"] -= value["count"]
+
+    def _load(self):
+        """Yield the serialized registry of every process sharing the directory, retired ones included."""
+        directory = self.directory
+        try:
+            names = [name for name in os.listdir(directory) if name.endswith(".json")]
+        except OSError:
+            return
+        now = time.time()
+        live = []
+        for name in names:
+            try:
+                age = now - os.path.getmtime(os.path.join(directory, name))
+            except OSError:
+                continue
+            if name == RETIRED_FILE or age <= STALE_FILE_SECONDS:
+                live.append(name)
+            elif self._retire(directory, name) and RETIRED_FILE not in live:
+                live.append(RETIRED_FILE)
+        for name in dict.fromkeys(live):
+            try:
+                with open(os.path.join(directory, name), encoding="utf-8") as handle:
+                    yield json.load(handle)
+            except (OSError, ValueError):
+                # Removed or being replaced by its owner meanwhile.
+                continue
+
+    def _retire(self, directory, name):
+        """Fold the file of a process gone for good into ``RETIRED_FILE``.
+
+        Renaming the file first makes sure only one scrape folds it. Returns
+        whether it was folded. If its owner was only idle, its next flush
+        notices the file is gone and exports what it counted since.
+        """
+        path = os.path.join(directory, name)
+        claimed = f"{path}.retiring"
+        try:
+            os.rename(path, claimed)
+        except OSError:
+            return False
+        retired_path = os.path.join(directory, RETIRED_FILE)
+        with open(os.path.join(directory, "retired.lock"), "a", encoding="utf-8") as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            merged = ({}, {}, {})
+            try:
+                with open(retired_path, encoding="utf-8") as handle:
+                    _merge(merged, json.load(handle))
+            except FileNotFoundError:
+                pass
+            try:
+                with open(claimed, encoding="utf-8") as handle:
+                    _merge(merged, json.load(handle))
+            except ValueError:
+                _logger.warning("Dropping unreadable ISP metrics file %s", claimed)
+            counters, histograms, gauges = merged
+            data = {
+                "counters": [[name, labels, value] for (name, labels), value in counters.items()],
+                "histograms": [[name, labels, value] for (name, labels), value in histograms.items()],
+                "gauges": [[name, labels, value, stamp] for (name, labels), (value, stamp) in gauges.items()],
+            }
+            tmp = f"{retired_path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as handle:
+                json.dump(data, handle)
+            os.replace(tmp, retired_path)
+            os.remove(claimed)
+        return True
+
+    def collect(self):
+        """Merge every process' file: counters and histograms add up, the newest gauge wins."""
+        self.flush()
+        merged = ({}, {}, {})
+        for data in self._load():
+            _merge(merged, data)
+        counters, histograms, gauges = merged
+        return counters, histograms, {key: value for key, (value, _) in gauges.items()}
+
+    def render(self, samples=()):
+        """Prometheus text exposition of the merged registry plus ``samples``.
+
+        ``samples`` are ``(name, type, help, labels dict, value)`` tuples computed
+        at scrape time (gauges read from the database).
+        """
+        counters, histograms, gauges = self.collect()
+        families = {}
+        for (name, labels), value in list(counters.items()) + list(gauges.items()):
+            families.setdefault(name, []).append((name, labels, value))
+        for (name, labels), data in histograms.items():
+            lines = families.setdefault(name, [])
+            buckets = METRIC_DEFINITIONS[name][2]
+            for bound, count in zip(buckets, data["buckets"]):
+                lines.append((f"{name}_bucket", labels + (("le", _format_value(float(bound))),), count))
+            lines.append((f"{name}_bucket", labels + (("le", "+Inf"),), data["count"]))
+            lines.append((f"{name}_sum", labels, data["sum"]))
+            lines.append((f"{name}_count", labels, data["count"]))
+        definitions = dict(METRIC_DEFINITIONS)
+        for name, kind, help_text, labels, value in samples:
+            definitions.setdefault(name, (kind, help_text, None))
+            families.setdefault(name, []).append((name, _label_key(labels), value))
+
+        output = []
+        for name in sorted(families):
+            kind, help_text, _ = definitions.get(name, ("untyped", "", None))
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {kind}")
+            for sample, labels, value in families[name]:
+                output.append(f"{sample}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(output) + "\n"
+
+
+METRICS = MetricsRegistry()
+
+
+class IspMetrics(models.AbstractModel):
+    _name = "isp.metrics"
+    _description = "ISP Metrics Exporter"
+
+    @api.model
+    def _collect_samples(self):
+        """Gauges computed at scrape time; modules extend the list.
+
+        Each must stay a cheap aggregate query: scrapes come every few seconds.
+        """
+        self.env.cr.execute(
+            """
+            SELECT j.state, j.job_type, s.code, count(*)
+              FROM isp_provisioning_job j
+              LEFT JOIN isp_sector s ON s.id = j.sector_id
+             WHERE j.state IN ('queued', 'running', 'dead')
+             GROUP BY j.state, j.job_type, s.code
+            """
+        )
+        return [
+            (
+                "isp_job_queue_depth",
+                "gauge",
+                "Provisioning jobs waiting, running or dead-lettered, by job type and sector.",
+                {"state": state, "job_type": job_type, "sector": sector or ""},
+                count,
+            )
+            for state, job_type, sector, count in self.env.cr.fetchall()
+        ]
+
+    @api.model
+    def _render(self):
+        return METRICS.render(self._collect_samples())
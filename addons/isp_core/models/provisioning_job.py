@@ -1,7 +1,77 @@
 # -*- coding: utf-8 -*-
 import json
+import logging
+import random
+import threading
+import time
+import traceback
+import zlib
+from contextlib import contextmanager
+from datetime import timedelta
 from odoo import api, fields, models
 from odoo.exceptions import UserError
+from .metrics import METRICS
+
+_logger = logging.getLogger(__name__)
+
+# Namespace for the session-level advisory locks used as worker slots.
+JOB_WORKER_LOCK_KEY = zlib.crc32(b"isp.provisioning_job.worker") & 0x7FFFFFFF
+
+class JobDeferred(Exception):
+    """Raised by a handler to put its job back in the queue without using up an attempt."""
+
+    def __init__(self, message, delay=60):
+        super().__init__(message)
+        self.delay = delay
+
+
+class JobTimer:
+    """Timing breakdown (milliseconds) and counters of the job being executed.
+
+    Handlers reach it through the ``isp_job_timer`` context key; code without
+    an environment (the RouterOS client) through ``JobTimer.current()``.
+    """
+
+    _local = threading.local()
+
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+
+    @classmethod
+    def current(cls):
+        return getattr(cls._local, "timer", None)
+
+    @contextmanager
+    def activate(self):
+        previous = JobTimer.current()
+        JobTimer._local.timer = self
+        try:
+            yield self
+        finally:
+            JobTimer._local.timer = previous
+
+    def add(self, key, milliseconds):
+        self.timings[key] = self.timings.get(key, 0.0) + milliseconds
+
+    def count(self, key, value=1):
+        self.counters[key] = self.counters.get(key, 0) + value
+
+
+# Claim order of the lanes; within a lane jobs round-robin across sectors.
+JOB_LANES = [
+    ("interactive", "Interactive"),
+    ("billing", "Billing"),
+    ("maintenance", "Maintenance"),
+]
+
+# Subscription state each job type leaves behind; only the latest queued one matters.
+SUBSCRIPTION_STATE_JOBS = {
+    "activate_subscription": "active",
+    "suspend_subscription": "suspended",
+    "reconnect_subscription": "active",
+    "terminate_subscription": "terminated",
+}
 
 
 class IspProvisioningJob(models.Model):
@@ -27,12 +97,20 @@ class IspProvisioningJob(models.Model):
         required=True,
         ondelete="cascade",
     )
-    subscription_id = fields.Many2one("isp.subscription", ondelete="set null")
+    subscription_id = fields.Many2one("isp.subscription", ondelete="set null", index=True)
     device_id = fields.Many2one("isp.device", ondelete="set null")
     sector_id = fields.Many2one("isp.sector", ondelete="set null")
     state = fields.Selection(
-        [("queued", "Queued"), ("running", "Running"), ("success", "Success"), ("failed", "Failed")],
+        [
+            ("queued", "Queued"),
+            ("running", "Running"),
+            ("success", "Success"),
+            ("failed", "Failed"),
+            ("dead", "Dead Letter"),
+            ("cancelled", "Cancelled"),
+        ],
         default="queued",
+        index=True,
     )
     attempts = fields.Integer(default=0)
     max_attempts = fields.Integer(default=3)
@@ -40,48 +118,383 @@ class IspProvisioningJob(models.Model):
     traceback = fields.Text()
     requested_by = fields.Many2one("res.users", default=lambda self: self.env.user)
     requested_at = fields.Datetime(default=fields.Datetime.now)
+    claimed_at = fields.Datetime(readonly=True)
+    next_attempt_at = fields.Datetime(readonly=True, help="Retry backoff: the job is not claimed before this time.")
     executed_at = fields.Datetime()
     payload_json = fields.Text(default="{}")
+    superseded_by_id = fields.Many2one("isp.provisioning_job", readonly=True, ondelete="set null")
+    lane = fields.Selection(JOB_LANES, required=True, default="interactive")
+    priority = fields.Integer(default=0, help="Higher runs first within the lane.")
+
+    queue_wait_ms = fields.Float(string="Queue Wait (ms)", readonly=True, aggregator="avg")
+    claim_ms = fields.Float(string="Claim (ms)", readonly=True, aggregator="avg")
+    router_lookup_ms = fields.Float(string="Router Lookup (ms)", readonly=True, aggregator="avg")
+    connect_ms = fields.Float(string="Connect (ms)", readonly=True, aggregator="avg")
+    routeros_ms = fields.Float(string="RouterOS Commands (ms)", readonly=True, aggregator="avg")
+    db_ms = fields.Float(string="DB and Handler (ms)", readonly=True, aggregator="avg")
+    duration_ms = fields.Float(string="Duration (ms)", readonly=True, aggregator="avg")
+    query_count = fields.Integer(string="SQL Queries", readonly=True, aggregator="avg")
+    routeros_commands = fields.Integer(string="RouterOS Commands", readonly=True, aggregator="avg")
+    routeros_round_trips = fields.Integer(string="RouterOS Round-Trips", readonly=True, aggregator="avg")
+
+    _queued_claim_idx = models.Index("(lane, sector_id, priority DESC, requested_at, id) WHERE state = 'queued'")
 
     @api.model_create_multi
     def create(self, vals_list):
         for vals in vals_list:
             if vals.get("name", "New") == "New":
                 vals["name"] = self.env["ir.sequence"].next_by_code("isp.provisioning.job") or "JOB"
+            if not vals.get("lane"):
+                vals["lane"] = self._get_default_lane(vals.get("job_type"))
         return super().create(vals_list)
 
+    @api.model
+    def _maintenance_job_types(self):
+        return {"mikrotik_healthcheck", "export_config_snapshot"}
+
+    @api.model
+    def _get_default_lane(self, job_type):
+        """Lane of a new job: the ``isp_job_lane`` context key, else derived from its type."""
+        lane = self.env.context.get("isp_job_lane")
+        if lane in dict(JOB_LANES):
+            return lane
+        return "maintenance" if job_type in self._maintenance_job_types() else "interactive"
+
+    @api.model
+    def _get_int_param(self, key, default):
+        value = self.env["ir.config_parameter"].sudo().get_param(f"isp_core.{key}")
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return default
+
     @api.model
     def _cron_run_pending_jobs(self):
-        jobs = self.search([("state", "=", "queued")], limit=20, order="requested_at asc")
-        for job in jobs:
-            job._execute()
+        self._requeue_stale_jobs()
+        threads = max(self._get_int_param("job_worker_threads", 1), 1)
+        if threads == 1:
+            self._run_job_worker()
+            return
+        # Each thread works on its own cursor; publish what we have so far first.
+        self.env.cr.commit()
+        uid, context = self.env.uid, dict(self.env.context)
+        workers = [
+            threading.Thread(
+                target=self._run_job_worker_thread,
+                args=(uid, context),
+                name=f"isp_job_worker_{index}",
+                daemon=True,
+            )
+            for index in range(threads)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
 
-    def action_run(self):
+    def _run_job_worker_thread(self, uid, context):
+        registry = self.env.registry
+        threading.current_thread().dbname = registry.db_name
+        try:
+            with registry.cursor() as cr:
+                env = api.Environment(cr, uid, context)
+                env[self._name]._run_job_worker()
+        except Exception:
+            _logger.exception("Provisioning job worker crashed")
+
+    @api.model
+    def _run_job_worker(self):
+        """Claim and run queued jobs until the queue is empty or the time budget is spent.
+
+        Several workers (cron threads, Odoo processes) may run this at the same
+        time; ``isp_core.job_max_workers`` caps how many are active at once.
+        """
+        slot = self._acquire_worker_slot()
+        if slot is None:
+            return 0
+        processed = 0
+        try:
+            batch_size = max(self._get_int_param("job_batch_size", 20), 1)
+            deadline = time.monotonic() + self._get_int_param("job_time_limit", 50)
+            while time.monotonic() < deadline:
+                jobs = self._claim_jobs(batch_size)
+                if not jobs:
+                    break
+                jobs._run_claimed()
+                processed += len(jobs)
+        finally:
+            self._release_worker_slot(slot)
+        return processed
+
+    @api.model
+    def _acquire_worker_slot(self):
+        max_workers = max(self._get_int_param("job_max_workers", 4), 1)
+        for slot in range(max_workers):
+            self.env.cr.execute("SELECT pg_try_advisory_lock(%s, %s)", [JOB_WORKER_LOCK_KEY, slot])
+            if self.env.cr.fetchone()[0]:
+                return slot
+        return None
+
+    @api.model
+    def _release_worker_slot(self, slot):
+        self.env.cr.execute("SELECT pg_advisory_unlock(%s, %s)", [JOB_WORKER_LOCK_KEY, slot])
+
+    @api.model
+    def _claim_jobs(self, limit):
+        """Lock up to ``limit`` queued jobs, mark them running and commit the claim.
+
+        Lanes are served in ``JOB_LANES`` order. Inside a lane, jobs are taken
+        by priority, then round-robin across sectors (the n-th job of every
+        sector before the n+1-th of any), then oldest first.
+        """
+        started = time.monotonic()
+        self.env.flush_all()
+        lane_rank = " ".join(f"WHEN '{lane}' THEN {rank}" for rank, (lane, _) in enumerate(JOB_LANES))
+        self.env.cr.execute(
+            f"""
+            WITH ranked AS (
+                SELECT id,
+                       ROW_NUMBER() OVER (
+                           PARTITION BY lane, priority, sector_id
+                           ORDER BY requested_at, id
+                       ) AS turn
+                  FROM isp_provisioning_job
+                 WHERE state = 'queued'
+                   AND (next_attempt_at IS NULL OR next_attempt_at <= %s)
+            )
+            SELECT j.id
+              FROM isp_provisioning_job j
+              JOIN ranked r ON r.id = j.id
+             WHERE j.state = 'queued'
+          ORDER BY CASE j.lane {lane_rank} ELSE {len(JOB_LANES)} END,
+                   j.priority DESC,
+                   r.turn,
+                   j.requested_at,
+                   j.id
+             LIMIT %s
+               FOR UPDATE OF j SKIP LOCKED
+            """,
+            [fields.Datetime.now(), limit],
+        )
+        jobs = self.browse([row[0] for row in self.env.cr.fetchall()])
+        if jobs:
+            claim_ms = (time.monotonic() - started) * 1000 / len(jobs)
+            jobs.write({"state": "running", "claimed_at": fields.Datetime.now(), "claim_ms": claim_ms})
+        self.env.cr.commit()
+        return jobs
+
+    @api.model
+    def _requeue_stale_jobs(self):
+        stale_minutes = self._get_int_param("job_stale_minutes", 15)
+        limit = fields.Datetime.now() - timedelta(minutes=stale_minutes)
+        stale = self.search([("state", "=", "running"), ("claimed_at", "<", limit)])
+        if stale:
+            _logger.warning("Requeueing %s stale provisioning jobs", len(stale))
+        # The worker died with its transaction, attempt counter included: count
+        # the lost attempt here, or a job that kills its worker loops forever.
+        for job in stale:
+            job.attempts += 1
+            if job.attempts >= job.max_attempts:
+                job.write(
+                    {
+                        "state": "dead",
+                        "claimed_at": False,
+                        "error_message": "Worker lost while running the job; max attempts reached",
+                    }
+                )
+                continue
+            job.write(
+                {
+                    "state": "queued",
+                    "claimed_at": False,
+                    "next_attempt_at": fields.Datetime.now() + timedelta(seconds=job._get_retry_delay()),
+                }
+            )
+
+    @api.model
+    def _lock_queued_jobs(self, domain):
+        """Return the queued jobs matching ``domain``, locked; jobs being claimed are left out."""
+        jobs = self.search(domain + [("state", "=", "queued")])
+        if not jobs:
+            return jobs
+        self.env.cr.execute(
+            "SELECT id FROM isp_provisioning_job WHERE id IN %s AND state = 'queued' FOR UPDATE SKIP LOCKED",
+            [tuple(jobs.ids)],
+        )
+        locked = {row[0] for row in self.env.cr.fetchall()}
+        return jobs.filtered(lambda job: job.id in locked)
+
+    @api.model
+    def _coalesce_subscription_jobs(self, subscriptions, job_type, payload=None):
+        """Match a new ``job_type`` request for ``subscriptions`` against their queued jobs.
+
+        Returns ``(pending, obsolete)``: ``pending`` maps a subscription id to a
+        queued job doing exactly the same work, ``obsolete`` to the queued jobs the
+        new request makes redundant (older state changes; everything for a
+        termination).
+        """
+        pending = {}
+        obsolete = {}
+        payload = payload or {}
+        for job in self._lock_queued_jobs([("subscription_id", "in", subscriptions.ids)]):
+            sub_id = job.subscription_id.id
+            if job.job_type == job_type and job.get_payload() == payload:
+                pending.setdefault(sub_id, job)
+            elif job_type == "terminate_subscription" or (
+                job_type in SUBSCRIPTION_STATE_JOBS and job.job_type in SUBSCRIPTION_STATE_JOBS
+            ):
+                obsolete[sub_id] = obsolete.get(sub_id, self.browse()) | job
+        return pending, obsolete
+
+    def _run_claimed(self):
         for job in self:
-            job._execute()
+            job._execute_claimed()
+            self.env.cr.commit()
 
-    def _execute(self):
+    def _execute_claimed(self):
+        """Run a job claimed by ``_claim_jobs``; failures are recorded, not raised.
+
+        The job's timing breakdown is stored on it. When the context holds an
+        ``isp_job_stats`` list (benchmarks), an entry is appended to it as well.
+        """
         self.ensure_one()
-        if self.state != "queued":
-            return
+        timer = JobTimer()
+        job = self.with_context(isp_job_timer=timer)
+        started = time.monotonic()
+        queries = self.env.cr.sql_log_count
+        try:
+            with timer.activate():
+                job._attempt()
+        finally:
+            finished = time.monotonic()
+            job._record_timing(timer, (finished - started) * 1000, self.env.cr.sql_log_count - queries)
+            stats = self.env.context.get("isp_job_stats")
+            if stats is not None:
+                stats.append(
+                    {
+                        "job_id": self.id,
+                        "job_type": self.job_type,
+                        "state": self.state,
+                        "started": started,
+                        "finished": finished,
+                        "queries": self.query_count,
+                    }
+                )
+
+    def _record_timing(self, timer, duration_ms, query_count):
+        timings = timer.timings
+        vals = {
+            "router_lookup_ms": timings.get("router_lookup", 0.0),
+            "connect_ms": timings.get("connect", 0.0),
+            "routeros_ms": timings.get("routeros", 0.0),
+            "db_ms": max(duration_ms - sum(timings.values()), 0.0),
+            "duration_ms": duration_ms,
+            "query_count": query_count,
+            "routeros_commands": timer.counters.get("routeros_commands", 0),
+            "routeros_round_trips": timer.counters.get("routeros_round_trips", 0),
+        }
+        if self.claimed_at and self.requested_at:
+            vals["queue_wait_ms"] = max((self.claimed_at - self.requested_at).total_seconds() * 1000, 0.0)
+            METRICS.observe("isp_job_queue_wait_seconds", vals["queue_wait_ms"] / 1000, {"lane": self.lane})
+        self.write(vals)
+        METRICS.inc("isp_job_executions_total", {"job_type": self.job_type, "state": self.state})
+        METRICS.observe("isp_job_duration_seconds", duration_ms / 1000, {"job_type": self.job_type})
+
+    def _attempt(self):
         if self.attempts >= self.max_attempts:
-            self.write({"state": "failed", "error_message": "Max attempts reached"})
+            self.write({"state": "dead", "error_message": self.error_message or "Max attempts reached"})
             return
         self.write(
             {
-                "state": "running",
                 "attempts": self.attempts + 1,
                 "executed_at": fields.Datetime.now(),
+                "next_attempt_at": False,
                 "error_message": False,
                 "traceback": False,
             }
         )
         try:
-            self._dispatch()
-            self.write({"state": "success"})
+            with self.env.cr.savepoint():
+                self._dispatch()
+        except JobDeferred as exc:
+            self.write(
+                {
+                    "state": "queued",
+                    "attempts": self.attempts - 1,
+                    "claimed_at": False,
+                    "next_attempt_at": fields.Datetime.now() + timedelta(seconds=max(exc.delay, 1)),
+                    "error_message": str(exc),
+                }
+            )
         except Exception as exc:
-            self.write({"state": "failed", "error_message": str(exc)})
-            raise
+            self._record_failure(exc, traceback.format_exc())
+        else:
+            self.write({"state": "success"})
+
+    def _record_failure(self, exc, tb):
+        """Schedule a retry for a transient error; otherwise fail, or dead-letter once retries run out."""
+        try:
+            with self.env.cr.savepoint():
+                self._after_failure(exc)
+        except Exception:
+            _logger.exception("Could not record the failure details of provisioning job %s", self.name)
+        vals = {"error_message": str(exc) or exc.__class__.__name__, "traceback": tb}
+        if not self._is_transient_error(exc):
+            _logger.warning("Provisioning job %s failed: %s", self.name, exc)
+            vals["state"] = "failed"
+        elif self.attempts >= self.max_attempts:
+            _logger.warning("Provisioning job %s dead after %s attempts: %s", self.name, self.attempts, exc)
+            vals["state"] = "dead"
+        else:
+            delay = self._get_retry_delay()
+            _logger.info("Provisioning job %s failed (%s), retrying in %ss", self.name, exc, delay)
+            vals.update(
+                state="queued",
+                claimed_at=False,
+                next_attempt_at=fields.Datetime.now() + timedelta(seconds=delay),
+            )
+        self.write(vals)
+
+    def _after_failure(self, exc):
+        """Hook for the writes a failed handler wants kept (statuses, diagnostics).
+
+        It runs once the handler's savepoint has been rolled back; writes made by
+        the handler itself before raising are lost.
+        """
+
+    def _is_transient_error(self, exc):
+        """Whether ``exc`` may go away on its own (network trouble) and the job is worth retrying."""
+        return isinstance(exc, OSError)
+
+    def _get_retry_delay(self):
+        """Exponential backoff with jitter: between half and all of base * 2^(attempts - 1), capped."""
+        base = max(self._get_int_param("job_retry_base_seconds", 30), 1)
+        cap = max(self._get_int_param("job_retry_max_seconds", 3600), base)
+        delay = min(cap, base * 2 ** max(self.attempts - 1, 0))
+        return int(random.uniform(delay / 2, delay))
+
+    def action_requeue(self):
+        self.filtered(lambda job: job.state in ("failed", "dead")).write(
+            {
+                "state": "queued",
+                "attempts": 0,
+                "claimed_at": False,
+                "next_attempt_at": False,
+            }
+        )
+
+    def action_run(self):
+        """Run the selected queued jobs now, claimed the way a worker claims them.
+
+        Jobs already claimed by a worker are skipped, and the run gets the same
+        timing, retry and dead-letter handling as a worker run.
+        """
+        jobs = self._lock_queued_jobs([("id", "in", self.ids)])
+        if not jobs:
+            return
+        jobs.write({"state": "running", "claimed_at": fields.Datetime.now()})
+        for job in jobs:
+            job._execute_claimed()
 
     def _dispatch(self):
         method_name = f"_handle_{self.job_type}"
@@ -3,6 +3,7 @@ import json
 import secrets
 from odoo import api, fields, models
 from odoo.exceptions import ValidationError
+from .provisioning_job import SUBSCRIPTION_STATE_JOBS
 
 
 class IspSubscription(models.Model):
@@ -126,22 +127,54 @@ class IspSubscription(models.Model):
         "PPPoE username must be unique.",
     )
 
-    def _queue_job(self, job_type, payload=None):
+    def _prepare_job_vals(self, job_type, payload=None):
         self.ensure_one()
-        vals = {
+        return {
             "job_type": job_type,
             "subscription_id": self.id,
             "device_id": False,
             "sector_id": self.sector_id.id,
             "payload_json": json.dumps(payload or {}),
         }
-        job = self.env["isp.provisioning_job"].create(vals)
-        self.env["isp.audit_log"].sudo().log_action(
-            action=job_type,
-            record=self,
-            details=f"Queued job {job.name}",
+
+    def _queue_job(self, job_type, payload=None):
+        self.ensure_one()
+        return self._queue_jobs(job_type, payload)
+
+    def _queue_jobs(self, job_type, payload=None):
+        """Queue ``job_type`` for every subscription of ``self`` with a single create.
+
+        Queued jobs are coalesced first: an identical queued job is reused, older
+        queued state changes are cancelled as superseded, and no job is queued
+        when cancelling them already leaves the subscription in the target state.
+        """
+        Job = self.env["isp.provisioning_job"]
+        if not self:
+            return Job
+        pending, obsolete = Job._coalesce_subscription_jobs(self, job_type, payload)
+        target = SUBSCRIPTION_STATE_JOBS.get(job_type)
+        to_queue = self.filtered(
+            lambda rec: rec.id not in pending and not (rec.id in obsolete and rec.state == target)
         )
-        return job
+        jobs = Job.create([rec._prepare_job_vals(job_type, payload) for rec in to_queue])
+        queued = {job.subscription_id.id: job for job in jobs}
+        details = {}
+        for rec in self:
+            job = queued.get(rec.id)
+            cancelled = obsolete.get(rec.id, Job)
+            if cancelled:
+                superseding = job or pending.get(rec.id)
+                cancelled.write({"state": "cancelled", "superseded_by_id": superseding.id if superseding else False})
+            if job:
+                details[rec.id] = f"Queued job {job.name}"
+            elif rec.id in pending:
+                details[rec.id] = f"Already queued as job {pending[rec.id].name}"
+            else:
+                details[rec.id] = "No job needed"
+            if cancelled:
+                details[rec.id] += f", cancelled {', '.join(cancelled.mapped('name'))}"
+        self.env["isp.audit_log"].sudo().log_actions(action=job_type, records=self, details=details)
+        return jobs | Job.browse([job.id for job in pending.values()])
 
     def action_activate(self):
         for rec in self:
@@ -9,9 +9,13 @@
         "security/ir.model.access.csv",
         "security/ir_rule.xml",
         "data/parameters.xml",
+        "data/cron.xml",
         "views/router_views.xml",
+        "views/drift_views.xml",
         "views/preconfig_views.xml",
-        "views/subscription_views.xml"
+        "views/subscription_views.xml",
+        "views/suspension_views.xml",
+        "views/job_views.xml",
     ],
     "demo": [
         "demo/isp_mikrotik_demo.xml",
@@ -1,5 +1,11 @@
 # -*- coding: utf-8 -*-
 from . import router
+from . import device
+from . import sector
+from . import service_plan
 from . import subscription
 from . import provisioning_job
 from . import preconfig
+from . import drift
+from . import breaker
+from . import metrics
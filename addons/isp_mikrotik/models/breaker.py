@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import logging
+from datetime import timedelta
+from odoo import fields, models
+from .routeros_client import RouterOSCircuitOpen
+
+_logger = logging.getLogger(__name__)
+
+BREAKER_STATES = [("closed", "Closed"), ("open", "Open"), ("half_open", "Half-Open")]
+
+
+class IspMikrotikBreaker(models.Model):
+    """Circuit breaker state of one router.
+
+    Kept out of ``isp.mikrotik.router`` and written through short side
+    transactions, so every worker sees it at once and job transactions that
+    write the router never conflict with it.
+    """
+
+    _name = "isp.mikrotik.breaker"
+    _description = "MikroTik Circuit Breaker"
+
+    router_id = fields.Many2one("isp.mikrotik.router", required=True, ondelete="cascade")
+    state = fields.Selection(BREAKER_STATES, default="closed", required=True)
+    failures = fields.Integer(default=0)
+    opened_at = fields.Datetime()
+    retry_at = fields.Datetime()
+
+    _router_uniq = models.Constraint("unique (router_id)", "Only one circuit breaker per router.")
+
+
+class IspMikrotikRouter(models.Model):
+    _inherit = "isp.mikrotik.router"
+
+    breaker_state = fields.Selection(BREAKER_STATES, compute="_compute_breaker")
+    breaker_failures = fields.Integer(compute="_compute_breaker")
+    breaker_opened_at = fields.Datetime(compute="_compute_breaker")
+    breaker_retry_at = fields.Datetime(compute="_compute_breaker")
+
+    def _compute_breaker(self):
+        breakers = self.env["isp.mikrotik.breaker"].sudo().search([("router_id", "in", self.ids)])
+        by_router = {breaker.router_id.id: breaker for breaker in breakers}
+        for router in self:
+            breaker = by_router.get(router.id)
+            router.breaker_state = breaker.state if breaker else "closed"
+            router.breaker_failures = breaker.failures if breaker else 0
+            router.breaker_opened_at = breaker.opened_at if breaker else False
+            router.breaker_retry_at = breaker.retry_at if breaker else False
+
+    def action_reset_breaker(self):
+        self._breaker_record_success()
+        self.invalidate_recordset(["breaker_state", "breaker_failures", "breaker_opened_at", "breaker_retry_at"])
+
+    def _get_breaker_settings(self):
+        params = self.env["ir.config_parameter"].sudo()
+        try:
+            threshold = int(params.get_param("isp_mikrotik.breaker_threshold", 3))
+            cooldown = int(params.get_param("isp_mikrotik.breaker_cooldown", 120))
+        except (TypeError, ValueError):
+            threshold, cooldown = 3, 120
+        return max(threshold, 1), max(cooldown, 1)
+
+    def _breaker_execute(self, query, params):
+        """Run ``query`` in its own committed transaction; breaker bookkeeping never fails a job."""
+        try:
+            with self.env.registry.cursor() as cr:
+                cr.execute("SET LOCAL lock_timeout = '2s'")
+                cr.execute(query, params)
+                return cr.fetchall() if cr.description else []
+        except Exception:
+            _logger.exception("Could not update the circuit breaker of routers %s", self.ids)
+            return []
+
+    def _breaker_status(self):
+        self.ensure_one()
+        self.env.cr.execute(
+            "SELECT state, failures, retry_at FROM isp_mikrotik_breaker WHERE router_id = %s",
+            [self.id],
+        )
+        return self.env.cr.fetchone() or ("closed", 0, None)
+
+    def _breaker_before_connect(self):
+        """Let a connection attempt through, or raise ``RouterOSCircuitOpen``.
+
+        Once the cooldown of an open breaker is over, the first caller wins the
+        half-open probe; everyone else keeps waiting for its outcome. Returns
+        whether a successful connection must reset the breaker.
+        """
+        self.ensure_one()
+        state, failures, retry_at = self._breaker_status()
+        if state == "closed":
+            return bool(failures)
+        _, cooldown = self._get_breaker_settings()
+        now = fields.Datetime.now()
+        if retry_at and retry_at <= now:
+            probe = self._breaker_execute(
+                """
+                UPDATE isp_mikrotik_breaker
+                   SET state = 'half_open', retry_at = %s
+                 WHERE router_id = %s AND state != 'closed' AND retry_at <= %s
+             RETURNING id
+                """,
+                [now + timedelta(seconds=cooldown), self.id, now],
+            )
+            if probe:
+                return True
+            retry_at = now + timedelta(seconds=cooldown)
+        raise RouterOSCircuitOpen(
+            f"Circuit breaker open for router {self.display_name}; next attempt after {retry_at}.",
+            retry_in=max(int(((retry_at or now) - now).total_seconds()), 1),
+        )
+
+    def _breaker_record_failure(self):
+        self.ensure_one()
+        threshold, cooldown = self._get_breaker_settings()
+        now = fields.Datetime.now()
+        trips = "(isp_mikrotik_breaker.state = 'half_open' OR isp_mikrotik_breaker.failures + 1 >= %(threshold)s)"
+        self._breaker_execute(
+            f"""
+            INSERT INTO isp_mikrotik_breaker (router_id, state, failures, opened_at, retry_at)
+                 VALUES (%(router)s,
+                         CASE WHEN %(threshold)s <= 1 THEN 'open' ELSE 'closed' END,
+                         1,
+                         CASE WHEN %(threshold)s <= 1 THEN %(now)s END,
+                         CASE WHEN %(threshold)s <= 1 THEN %(retry)s END)
+            ON CONFLICT (router_id) DO UPDATE
+                    SET failures = isp_mikrotik_breaker.failures + 1,
+                        state = CASE WHEN {trips} THEN 'open' ELSE isp_mikrotik_breaker.state END,
+                        opened_at = CASE WHEN {trips} AND isp_mikrotik_breaker.state = 'closed'
+                                         THEN %(now)s ELSE isp_mikrotik_breaker.opened_at END,
+                        retry_at = CASE WHEN {trips} THEN %(retry)s ELSE isp_mikrotik_breaker.retry_at END
+            """,
+            {"router": self.id, "threshold": threshold, "now": now, "retry": now + timedelta(seconds=cooldown)},
+        )
+
+    def _breaker_record_success(self):
+        if not self:
+            return
+        self._breaker_execute(
+            """
+            UPDATE isp_mikrotik_breaker
+               SET state = 'closed', failures = 0, opened_at = NULL, retry_at = NULL
+             WHERE router_id IN %s AND (state != 'closed' OR failures > 0)
+            """,
+            [tuple(self.ids)],
+        )
+
+    def _healthcheck_fleet(self):
+        results = super()._healthcheck_fleet()
+        # Routers answering the fleet poll are reachable again; no need to wait for a probe job.
+        self.browse([router_id for router_id, result in results.items() if result["status"] == "ok"])._breaker_record_success()
+        return results
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from odoo import models
+
+
+class IspDevice(models.Model):
+    _inherit = "isp.device"
+
+    def write(self, vals):
+        res = super().write(vals)
+        if "sector_id" in vals:
+            # Cached sector -> router lookups follow the device's sector.
+            self.env["isp.mikrotik.router"]._invalidate_router_cache()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.env["isp.mikrotik.router"]._invalidate_router_cache()
+        return res
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+from datetime import timedelta
+from odoo import api, fields, models
+from .reconciler import SECTIONS, RouterOSReconciler, normalize_value
+from .routeros_client import LibRouterosError, get_routeros_client
+
+_logger = logging.getLogger(__name__)
+
+SECTION_SELECTION = [
+    ("ppp_secret", "PPP Secret"),
+    ("dhcp_lease", "DHCP Lease"),
+    ("queue_simple", "Simple Queue"),
+    ("plan_address", "Plan Address List"),
+]
+
+# Fingerprint rows holding the hash of a whole section, its row count on the
+# router and the hash of what Odoo expects in it.
+SECTION_KEY = "*"
+COUNT_KEY = "#count"
+DESIRED_KEY = "#desired"
+META_KEYS = (SECTION_KEY, COUNT_KEY, DESIRED_KEY)
+
+
+def entry_fingerprint(section, row):
+    values = {field: normalize_value(field, row.get(field)) for field in SECTIONS[section]["fields"]}
+    return hashlib.blake2b(json.dumps(values, sort_keys=True).encode(), digest_size=8).hexdigest()
+
+
+def _display(values):
+    return json.dumps({key: "***" if key == "password" else value for key, value in values.items()}, default=str)
+
+
+def section_fingerprint(entry_hashes):
+    payload = "\n".join(f"{key}={value}" for key, value in sorted(entry_hashes.items()))
+    return hashlib.blake2b(payload.encode(), digest_size=8).hexdigest()
+
+
+def desired_fingerprint(section, expected_entries):
+    """Hash of the entries Odoo expects in ``section`` (``{key: (subscription, values)}``)."""
+    return section_fingerprint(
+        {
+            key: "absent" if values is None else entry_fingerprint(section, values)
+            for key, (_sub, values) in expected_entries.items()
+        }
+    )
+
+
+class IspMikrotikFingerprint(models.Model):
+    _name = "isp.mikrotik.fingerprint"
+    _description = "MikroTik Table Fingerprint"
+
+    router_id = fields.Many2one("isp.mikrotik.router", required=True, ondelete="cascade", index=True)
+    section = fields.Selection(SECTION_SELECTION, required=True)
+    key = fields.Char(required=True)
+    entry_hash = fields.Char(required=True)
+    fetched_at = fields.Datetime(help="On the section row: when the router table was last downloaded in full.")
+
+    _router_section_key_uniq = models.Constraint(
+        "unique (router_id, section, key)",
+        "Only one fingerprint per router table entry.",
+    )
+
+
+class IspMikrotikDrift(models.Model):
+    _name = "isp.mikrotik.drift"
+    _description = "MikroTik Configuration Drift"
+    _order = "detected_at desc"
+
+    router_id = fields.Many2one("isp.mikrotik.router", required=True, ondelete="cascade", index=True)
+    sector_id = fields.Many2one(related="router_id.sector_id", store=True)
+    section = fields.Selection(SECTION_SELECTION, required=True)
+    key = fields.Char(required=True)
+    subscription_id = fields.Many2one("isp.subscription", ondelete="set null")
+    drift_type = fields.Selection(
+        [("missing", "Missing on Router"), ("unexpected", "Unexpected on Router"), ("changed", "Changed on Router")],
+        required=True,
+    )
+    expected = fields.Text()
+    actual = fields.Text()
+    detected_at = fields.Datetime(default=fields.Datetime.now)
+    resolved_at = fields.Datetime()
+    state = fields.Selection([("open", "Open"), ("resolved", "Resolved")], default="open", index=True)
+
+    def action_resolve(self):
+        self.write({"state": "resolved", "resolved_at": fields.Datetime.now()})
+
+
+class IspMikrotikRouter(models.Model):
+    _inherit = "isp.mikrotik.router"
+
+    last_drift_scan_at = fields.Datetime(readonly=True)
+    drift_count = fields.Integer(compute="_compute_drift_count")
+
+    def action_open_drifts(self):
+        self.ensure_one()
+        return {
+            "type": "ir.actions.act_window",
+            "name": "Configuration Drift",
+            "res_model": "isp.mikrotik.drift",
+            "view_mode": "list,form",
+            "domain": [("router_id", "=", self.id)],
+            "context": {"search_default_open": 1},
+        }
+
+    def _compute_drift_count(self):
+        counts = {}
+        if self.ids:
+            groups = self.env["isp.mikrotik.drift"]._read_group(
+                [("router_id", "in", self.ids), ("state", "=", "open")], ["router_id"], ["__count"]
+            )
+            counts = {router.id: count for router, count in groups}
+        for router in self:
+            router.drift_count = counts.get(router.id, 0)
+
+    @api.model
+    def _cron_scan_drift(self):
+        for router in self.search([]):
+            try:
+                with get_routeros_client(self.env, router) as client:
+                    router._scan_drift(client)
+                self.env.cr.commit()
+            except Exception:
+                self.env.cr.rollback()
+                _logger.exception("Drift scan failed for router %s", router.display_name)
+
+    def _scan_drift(self, client):
+        """Compare the router tables with the last seen fingerprints and record drift.
+
+        A section is downloaded only when its cheap indicators moved: the row
+        count on the router (``print count-only``), the hash of what Odoo
+        expects in it, or the age of its last full download (in-place edits on
+        the router leave the count alone). Once downloaded, only the entries
+        whose hash changed are compared, or every expected entry when the
+        Odoo side changed.
+        """
+        self.ensure_one()
+        Fingerprint = self.env["isp.mikrotik.fingerprint"].sudo()
+        reconciler = RouterOSReconciler(self.env, self, client)
+        stored, fetched_at = {}, {}
+        for row in Fingerprint.search_read(
+            [("router_id", "=", self.id)], ["section", "key", "entry_hash", "fetched_at"]
+        ):
+            stored.setdefault(row["section"], {})[row["key"]] = (row["id"], row["entry_hash"])
+            if row["key"] == SECTION_KEY:
+                fetched_at[row["section"]] = row["fetched_at"]
+        full_scan_hours = self._get_positive_param("drift_full_scan_hours", 24, int)
+        full_scan_before = fields.Datetime.now() - timedelta(hours=full_scan_hours)
+
+        desired = reconciler.desired(self._get_bound_subscriptions())
+        drifts = []
+        seen_keys = {}
+        for section in reconciler.managed_sections():
+            previous = stored.get(section, {})
+            expected_entries = desired.get(section, {})
+            meta = {
+                COUNT_KEY: self._section_count(client, section),
+                DESIRED_KEY: desired_fingerprint(section, expected_entries),
+            }
+            desired_changed = previous.get(DESIRED_KEY, (None, None))[1] != meta[DESIRED_KEY]
+            if (
+                previous
+                and not desired_changed
+                and meta[COUNT_KEY] is not None
+                and previous.get(COUNT_KEY, (None, None))[1] == meta[COUNT_KEY]
+                and fetched_at.get(section)
+                and fetched_at[section] >= full_scan_before
+            ):
+                continue
+            actual = reconciler.fetch([section])[section]
+            hashes = {key: entry_fingerprint(section, row) for key, row in actual.items()}
+            meta[SECTION_KEY] = section_fingerprint(hashes)
+            if meta[COUNT_KEY] is None:
+                meta[COUNT_KEY] = "?"
+            keys = set()
+            if previous.get(SECTION_KEY, (None, None))[1] != meta[SECTION_KEY]:
+                keys |= {key for key, value in hashes.items() if previous.get(key, (None, None))[1] != value}
+                keys |= {key for key in previous if key not in META_KEYS and key not in hashes}
+            if desired_changed or not previous:
+                # Odoo's side moved (or first scan): every expected entry must be checked.
+                keys |= set(expected_entries)
+            for key in keys:
+                drift = self._compare_entry(section, key, expected_entries.get(key), actual.get(key))
+                if drift:
+                    drifts.append(drift)
+            seen_keys[section] = keys
+            self._store_fingerprints(section, hashes, previous, meta)
+
+        self._record_drifts(drifts, seen_keys)
+        self.last_drift_scan_at = fields.Datetime.now()
+        auto_repair = self.env["ir.config_parameter"].sudo().get_param("isp_mikrotik.drift_auto_repair")
+        if drifts and auto_repair in ("1", "true", "True"):
+            queued = self.env["isp.provisioning_job"].search_count(
+                [("job_type", "=", "reconcile_router"), ("device_id", "=", self.device_id.id), ("state", "=", "queued")]
+            )
+            if not queued:
+                self.action_reconcile()
+        return drifts
+
+    def _section_count(self, client, section):
+        """Row count of the section's table on the router, or None if the router cannot tell."""
+        try:
+            rows = client.cmd(f"{SECTIONS[section]['path']}/print", **{"count-only": ""})
+        except LibRouterosError:
+            return None
+        return next((str(row["ret"]) for row in rows if "ret" in row), None)
+
+    def _compare_entry(self, section, key, expected, row):
+        if not expected:
+            return None
+        sub, values = expected
+        vals = {"router_id": self.id, "section": section, "key": key, "subscription_id": sub.id}
+        if values is None:
+            if row:
+                vals.update(drift_type="unexpected", actual=_display(row))
+                return vals
+            return None
+        managed = {field: value for field, value in values.items() if field in SECTIONS[section]["fields"]}
+        if not row:
+            vals.update(drift_type="missing", expected=_display(managed))
+            return vals
+        if any(normalize_value(field, row.get(field)) != normalize_value(field, value) for field, value in managed.items()):
+            vals.update(
+                drift_type="changed",
+                expected=_display(managed),
+                actual=_display({field: row.get(field) for field in managed}),
+            )
+            return vals
+        return None
+
+    def _store_fingerprints(self, section, hashes, previous, meta):
+        Fingerprint = self.env["isp.mikrotik.fingerprint"].sudo()
+        hashes = dict(hashes, **meta)
+        now = fields.Datetime.now()
+        to_create = []
+        for key, value in hashes.items():
+            record_id, old_hash = previous.get(key, (None, None))
+            vals = {"entry_hash": value}
+            if key == SECTION_KEY:
+                vals["fetched_at"] = now
+            if record_id is None:
+                to_create.append(dict(vals, router_id=self.id, section=section, key=key))
+            elif old_hash != value or key == SECTION_KEY:
+                Fingerprint.browse(record_id).write(vals)
+        stale_ids = [record_id for key, (record_id, _) in previous.items() if key not in hashes]
+        if stale_ids:
+            Fingerprint.browse(stale_ids).unlink()
+        if to_create:
+            Fingerprint.create(to_create)
+
+    def _record_drifts(self, drifts, seen_keys):
+        Drift = self.env["isp.mikrotik.drift"].sudo()
+        open_drifts = Drift.search([("router_id", "=", self.id), ("state", "=", "open")])
+        by_key = {(drift.section, drift.key): drift for drift in open_drifts}
+        drifted = {(vals["section"], vals["key"]) for vals in drifts}
+        to_resolve = Drift.browse(
+            [
+                drift.id
+                for (section, key), drift in by_key.items()
+                if key in seen_keys.get(section, ()) and (section, key) not in drifted
+            ]
+        )
+        if to_resolve:
+            to_resolve.action_resolve()
+        to_create = []
+        for vals in drifts:
+            existing = by_key.get((vals["section"], vals["key"]))
+            if existing:
+                existing.write({k: v for k, v in vals.items() if k in ("drift_type", "expected", "actual")})
+            else:
+                to_create.append(vals)
+        if to_create:
+            Drift.create(to_create)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from odoo import api, models
+
+
+class IspMetrics(models.AbstractModel):
+    _inherit = "isp.metrics"
+
+    @api.model
+    def _collect_samples(self):
+        samples = super()._collect_samples()
+        self.env.cr.execute(
+            """
+            SELECT r.name, r.last_healthcheck_status, EXTRACT(EPOCH FROM r.last_healthcheck_at), b.state
+              FROM isp_mikrotik_router r
+              LEFT JOIN isp_mikrotik_breaker b ON b.router_id = r.id
+            """
+        )
+        for name, status, checked_at, breaker_state in self.env.cr.fetchall():
+            labels = {"router": name or ""}
+            if status:
+                samples.append(
+                    ("isp_router_up", "gauge", "1 if the last healthcheck of the router succeeded.", labels, int(status == "ok"))
+                )
+            if checked_at is not None:
+                samples.append(
+                    (
+                        "isp_router_last_healthcheck_timestamp_seconds",
+                        "gauge",
+                        "Unix time of the router's last healthcheck.",
+                        labels,
+                        float(checked_at),
+                    )
+                )
+            samples.append(
+                (
+                    "isp_router_breaker_open",
+                    "gauge",
+                    "1 while the router's circuit breaker is open or half-open.",
+                    labels,
+                    int((breaker_state or "closed") != "closed"),
+                )
+            )
+        return samples
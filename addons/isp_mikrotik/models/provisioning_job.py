@@ -1,7 +1,25 @@
 # -*- coding: utf-8 -*-
-from odoo import fields, models
+import copy
+import json
+import time
+from contextlib import nullcontext
+from odoo import api, fields, models
 from odoo.exceptions import UserError
-from .routeros_client import get_routeros_client, LibRouterosError
+from odoo.addons.isp_core.models.provisioning_job import SUBSCRIPTION_STATE_JOBS, JobDeferred
+from .reconciler import PLAN_LIST_PREFIX, normalize_value
+from .routeros_client import (
+    CONNECTION_ERRORS,
+    TRAP_INTERRUPTED,
+    RouterOSCircuitOpen,
+    RouterOSCommand,
+    RouterOSPoolTimeout,
+    TrapError,
+    get_routeros_client,
+)
+
+# Comments marking the firewall rules that act on the suspended address list.
+SUSPENDED_REDIRECT_COMMENT = "isp_suspended_redirect"
+SUSPENDED_BLOCK_COMMENT = "isp_suspended_block"
 
 
 class IspProvisioningJob(models.Model):
@@ -12,40 +30,138 @@ class IspProvisioningJob(models.Model):
             ("activate_pppoe", "Activate PPPoE"),
             ("activate_dhcp", "Activate DHCP"),
             ("ensure_queue", "Ensure Queue"),
+            ("reconcile_router", "Reconcile Router"),
+            ("address_list_sync", "Address List Sync"),
         ],
         ondelete={
             "activate_pppoe": "cascade",
             "activate_dhcp": "cascade",
             "ensure_queue": "cascade",
+            "reconcile_router": "cascade",
+            "address_list_sync": "cascade",
         },
     )
+    router_id = fields.Many2one("isp.mikrotik.router", index=True, ondelete="set null", readonly=True)
+
+    @api.model
+    def _maintenance_job_types(self):
+        return super()._maintenance_job_types() | {"reconcile_router"}
+
+    def _is_transient_error(self, exc):
+        # Lost sessions, a busy pool and interrupted commands are worth a retry;
+        # any other trap (bad value, missing item, login refused) is not.
+        if isinstance(exc, CONNECTION_ERRORS + (RouterOSPoolTimeout,)):
+            return True
+        if isinstance(exc, TrapError):
+            return getattr(exc, "category", None) == TRAP_INTERRUPTED
+        return super()._is_transient_error(exc)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        """Resolve each job's router once, here, so that dispatch needs no lookup."""
+        Router = self.env["isp.mikrotik.router"]
+        Subscription = self.env["isp.subscription"]
+        pending = [vals for vals in vals_list if "router_id" not in vals]
+        Subscription.browse({vals["subscription_id"] for vals in pending if vals.get("subscription_id")}).fetch(
+            ["router_id", "sector_id"]
+        )
+        for vals in pending:
+            router = Router._find_router(
+                self.env["isp.device"].browse(vals.get("device_id") or []),
+                Subscription.browse(vals.get("subscription_id") or []),
+            )
+            vals["router_id"] = router.id
+        return super().create(vals_list)
 
     def _get_router(self):
         self.ensure_one()
-        Router = self.env["isp.mikrotik.router"]
-        router = False
-        if self.device_id:
-            router = Router.search([("device_id", "=", self.device_id.id)], limit=1)
-        if not router and self.subscription_id and self.subscription_id.router_id:
-            router = self.subscription_id.router_id
-        if not router and self.subscription_id and self.subscription_id.sector_id:
-            router = Router.search([("sector_id", "=", self.subscription_id.sector_id.id)], limit=1)
+        timer = self.env.context.get("isp_job_timer")
+        if self.router_id:
+            if timer is not None:
+                timer.add("router_lookup", self.env.context.get("isp_job_router_lookup_ms", 0.0))
+            return self.router_id
+        # The router was deleted, or none served the subscription when the job was queued.
+        started = time.monotonic()
+        router = self.env["isp.mikrotik.router"]._find_router(self.device_id, self.subscription_id)
+        if timer is not None:
+            timer.add("router_lookup", (time.monotonic() - started) * 1000)
         if not router:
             raise UserError("No MikroTik router found for this job.")
+        self.router_id = router
         return router
 
-    def _routeros_pppoe_ensure_secret(self, client, subscription):
-        profile = subscription.plan_id.mikrotik_profile or "default"
+    def _assign_routers(self):
+        """Resolve again and store the router of the jobs in ``self``."""
+        Router = self.env["isp.mikrotik.router"]
+        groups = {}
+        for job in self:
+            router = Router._find_router(job.device_id, job.subscription_id)
+            if router != job.router_id:
+                groups.setdefault(router.id, self.browse())
+                groups[router.id] |= job
+        for router_id, jobs in groups.items():
+            jobs.write({"router_id": router_id})
+
+    def _run_claimed(self):
+        """Run claimed jobs grouped by router, sharing one RouterOS session per group.
+
+        The batch's router lookup time is split evenly over its jobs; opening a
+        group's session is counted in the connect time of its first job.
+        """
+        started = time.monotonic()
+        self.filtered(lambda job: not job.router_id)._assign_routers()
+        lookup_ms = (time.monotonic() - started) * 1000 / (len(self) or 1)
+        groups = {}
+        for job in self:
+            groups.setdefault(job.router_id.id, self.browse())
+            groups[job.router_id.id] |= job
+        for router_id, jobs in groups.items():
+            jobs = jobs.with_context(isp_job_router_lookup_ms=lookup_ms)
+            if not router_id:
+                super(IspProvisioningJob, jobs)._run_claimed()
+                continue
+            router = self.env["isp.mikrotik.router"].browse(router_id)
+            started = time.monotonic()
+            try:
+                session = client = get_routeros_client(self.env, router)
+            except Exception as exc:
+                # Every job of the group records the connection error on its own.
+                session, client = exc, nullcontext()
+            connect_ms = (time.monotonic() - started) * 1000
+            with client:
+                jobs = jobs.with_context(isp_routeros_sessions={router_id: session})
+                super(IspProvisioningJob, jobs[:1].with_context(isp_job_connect_ms=connect_ms))._run_claimed()
+                super(IspProvisioningJob, jobs[1:])._run_claimed()
+
+    def _routeros_session(self, router):
+        """Return the RouterOS client for ``router`` as a context manager.
+
+        Inside a grouped run the group's shared session is reused and left open.
+        """
+        session = (self.env.context.get("isp_routeros_sessions") or {}).get(router.id)
+        timer = self.env.context.get("isp_job_timer")
+        if session is not None and timer is not None:
+            timer.add("connect", self.env.context.get("isp_job_connect_ms", 0.0))
+        if session is None:
+            return get_routeros_client(self.env, router)
+        if isinstance(session, Exception):
+            # A copy per job: re-raising the shared error would stack every
+            # job's frames onto one traceback.
+            raise copy.copy(session) from session
+        return nullcontext(session)
+
+    def _dispatch(self):
+        # The breaker may refuse the first connection or a reconnect mid-job.
         try:
-            client.cmd(
-                "/ppp/secret/add",
-                name=subscription.pppoe_username,
-                password=subscription.pppoe_password,
-                profile=profile,
-                service="pppoe",
-            )
-        except LibRouterosError:
-            client.cmd(
+            return super()._dispatch()
+        except RouterOSCircuitOpen as exc:
+            raise JobDeferred(str(exc), delay=exc.retry_in) from exc
+
+    def _routeros_pppoe_secret_cmd(self, subscription):
+        profile = subscription.plan_id.mikrotik_profile or "default"
+        return RouterOSCommand(
+            "/ppp/secret/add",
+            fallback=RouterOSCommand(
                 "/ppp/secret/set",
                 **{
                     "numbers": subscription.pppoe_username,
@@ -53,110 +169,367 @@ class IspProvisioningJob(models.Model):
                     "profile": profile,
                     "disabled": "no",
                 },
-            )
+            ),
+            name=subscription.pppoe_username,
+            password=subscription.pppoe_password,
+            profile=profile,
+            service="pppoe",
+        )
 
-    def _routeros_pppoe_disable(self, client, subscription):
-        try:
-            client.cmd(
-                "/ppp/secret/set",
-                **{"numbers": subscription.pppoe_username, "disabled": "yes"},
-            )
-        except LibRouterosError:
-            return
+    def _routeros_pppoe_toggle_cmd(self, subscription, disabled):
+        return RouterOSCommand(
+            "/ppp/secret/set",
+            ignore_errors=True,
+            **{"numbers": subscription.pppoe_username, "disabled": "yes" if disabled else "no"},
+        )
 
-    def _routeros_pppoe_enable(self, client, subscription):
-        try:
-            client.cmd(
-                "/ppp/secret/set",
-                **{"numbers": subscription.pppoe_username, "disabled": "no"},
-            )
-        except LibRouterosError:
-            return
-
-    def _routeros_dhcp_ensure_lease(self, client, subscription):
+    def _routeros_dhcp_lease_cmd(self, subscription):
         if not subscription.service_ip or not subscription.service_mac:
-            return
-        try:
-            client.cmd(
-                "/ip/dhcp-server/lease/add",
-                address=subscription.service_ip,
-                **{"mac-address": subscription.service_mac},
-                comment=subscription.name,
-            )
-        except LibRouterosError:
-            client.cmd(
+            return None
+        return RouterOSCommand(
+            "/ip/dhcp-server/lease/add",
+            fallback=RouterOSCommand(
                 "/ip/dhcp-server/lease/set",
                 **{
                     "numbers": subscription.service_ip,
                     "comment": subscription.name,
                     "disabled": "no",
                 },
-            )
+            ),
+            address=subscription.service_ip,
+            **{"mac-address": subscription.service_mac},
+            comment=subscription.name,
+        )
 
-    def _routeros_queue_ensure(self, client, subscription):
+    def _routeros_service_cmd(self, subscription):
+        if subscription.plan_id.service_type == "pppoe":
+            return self._routeros_pppoe_secret_cmd(subscription)
+        if subscription.plan_id.service_type == "dhcp":
+            return self._routeros_dhcp_lease_cmd(subscription)
+        return None
+
+    def _routeros_queue_cmd(self, subscription):
         if not subscription.service_ip:
-            return
+            return None
         down = subscription.plan_id.down_mbps or 0
         up = subscription.plan_id.up_mbps or 0
         max_limit = f"{down}M/{up}M"
         name = subscription.name
-        try:
-            client.cmd(
-                "/queue/simple/add",
-                name=name,
-                target=f"{subscription.service_ip}/32",
-                **{"max-limit": max_limit},
-                comment=subscription.name,
-            )
-        except LibRouterosError:
-            client.cmd(
+        return RouterOSCommand(
+            "/queue/simple/add",
+            fallback=RouterOSCommand(
                 "/queue/simple/set",
                 **{"numbers": name, "max-limit": max_limit, "disabled": "no"},
+            ),
+            name=name,
+            target=f"{subscription.service_ip}/32",
+            **{"max-limit": max_limit},
+            comment=subscription.name,
+        )
+
+    def _routeros_queue_disable_cmd(self, subscription):
+        return RouterOSCommand(
+            "/queue/simple/set",
+            ignore_errors=True,
+            **{"numbers": subscription.name, "disabled": "yes"},
+        )
+
+    def _routeros_queue_remove_cmd(self, subscription):
+        return RouterOSCommand(
+            "/queue/simple/remove",
+            ignore_errors=True,
+            **{"numbers": subscription.name},
+        )
+
+    def _routeros_plan_list_name(self, plan):
+        return f"{PLAN_LIST_PREFIX}{plan.id}"
+
+    def _routeros_pcq_plan_entries(self, plan):
+        """(path, lookup query, values) of the PCQ queue types, mangle rules and queue tree of ``plan``."""
+        list_name = self._routeros_plan_list_name(plan)
+        entries = []
+        for direction, rate, classifier, list_field in (
+            ("down", plan.down_mbps, "dst-address", "dst-address-list"),
+            ("up", plan.up_mbps, "src-address", "src-address-list"),
+        ):
+            mark = f"{list_name}_{direction}"
+            entries += [
+                (
+                    "/queue/type",
+                    {"?name": mark},
+                    {"name": mark, "kind": "pcq", "pcq-rate": f"{rate or 0:g}M", "pcq-classifier": classifier},
+                ),
+                (
+                    "/ip/firewall/mangle",
+                    {"?comment": mark},
+                    {
+                        "chain": "forward",
+                        list_field: list_name,
+                        "action": "mark-packet",
+                        "new-packet-mark": mark,
+                        "passthrough": "no",
+                        "comment": mark,
+                    },
+                ),
+                (
+                    "/queue/tree",
+                    {"?name": mark},
+                    {"name": mark, "parent": "global", "packet-mark": mark, "queue": mark},
+                ),
+            ]
+        return entries
+
+    def _routeros_ensure_entries_cmds(self, client, entries, extra_lookups=()):
+        """Look ``entries`` up in one pipelined round and return the add/set commands they need.
+
+        ``extra_lookups`` are other print commands sent in the same round.
+        Queue types are referenced by the queue tree entries, and RouterOS does
+        not run pipelined commands in order, so their commands are sent here in
+        a round of their own instead of being returned.
+        """
+        lookups = [RouterOSCommand(f"{path}/print", **query) for path, query, _ in entries]
+        client.run(lookups + list(extra_lookups))
+        commands = []
+        for lookup, (path, _, values) in zip(lookups, entries):
+            row = lookup.rows[0] if lookup.rows else None
+            if not row:
+                commands.append(RouterOSCommand(f"{path}/add", **values))
+                continue
+            changes = {
+                field: value
+                for field, value in values.items()
+                if normalize_value(field, row.get(field)) != normalize_value(field, value)
+            }
+            if changes and row.get(".id"):
+                commands.append(RouterOSCommand(f"{path}/set", **dict(changes, numbers=row[".id"])))
+        queue_types = [command for command in commands if command.path.startswith("/queue/type/")]
+        if queue_types:
+            client.run(queue_types)
+        return [command for command in commands if command not in queue_types]
+
+    def _routeros_pcq_plans_cmds(self, client, plans):
+        entries = []
+        for plan in plans:
+            entries += self._routeros_pcq_plan_entries(plan)
+        return self._routeros_ensure_entries_cmds(client, entries)
+
+    def _routeros_shaping_cmds(self, client, router, subscription, action):
+        """Commands shaping ``subscription`` on ``router``; ``action`` is ensure, disable or remove.
+
+        Simple-queue routers get one queue per subscription. PCQ routers get the
+        plan's queue tree and the subscription's IP in the plan address list, so a
+        plan change only moves the address to another list.
+        """
+        if router.shaping_backend != "pcq":
+            builders = {
+                "ensure": self._routeros_queue_cmd,
+                "disable": self._routeros_queue_disable_cmd,
+                "remove": self._routeros_queue_remove_cmd,
+            }
+            return [builders[action](subscription)]
+        if not subscription.service_ip:
+            return []
+        list_name = self._routeros_plan_list_name(subscription.plan_id)
+        listing = RouterOSCommand(
+            "/ip/firewall/address-list/print",
+            **{"?address": subscription.service_ip, ".proplist": ".id,list,disabled"},
+        )
+        plan_entries = [] if action == "remove" else self._routeros_pcq_plan_entries(subscription.plan_id)
+        commands = self._routeros_ensure_entries_cmds(client, plan_entries, [listing])
+        current = None
+        for row in listing.rows:
+            if not str(row.get("list", "")).startswith(PLAN_LIST_PREFIX):
+                continue
+            if action != "remove" and current is None and row.get("list") == list_name:
+                current = row
+                continue
+            commands.append(
+                RouterOSCommand("/ip/firewall/address-list/remove", ignore_errors=True, numbers=row.get(".id"))
+            )
+        if action == "remove":
+            return commands
+        disabled = "yes" if action == "disable" else "no"
+        if current is None:
+            commands.append(
+                RouterOSCommand(
+                    "/ip/firewall/address-list/add",
+                    list=list_name,
+                    address=subscription.service_ip,
+                    comment=subscription.name,
+                    disabled=disabled,
+                )
             )
+        elif normalize_value("disabled", current.get("disabled")) != disabled:
+            commands.append(
+                RouterOSCommand("/ip/firewall/address-list/set", numbers=current.get(".id"), disabled=disabled)
+            )
+        return commands
 
-    def _routeros_queue_disable(self, client, subscription):
-        name = subscription.name
-        try:
-            client.cmd(
-                "/queue/simple/set",
-                **{"numbers": name, "disabled": "yes"},
+    def _get_address_list_settings(self):
+        params = self.env["ir.config_parameter"].sudo()
+        return {
+            "list": params.get_param("isp_mikrotik.suspended_address_list") or "isp_suspended",
+            "portal_ip": params.get_param("isp_mikrotik.suspended_portal_ip") or False,
+            "portal_port": params.get_param("isp_mikrotik.suspended_portal_port") or "80",
+        }
+
+    def _routeros_suspension_rule_cmds(self, settings, existing):
+        """Commands keeping the redirect and block rules of the suspended list in place.
+
+        ``existing`` maps a rule comment to its RouterOS id when already present.
+        """
+        rules = []
+        if settings["portal_ip"]:
+            rules.append(
+                (
+                    "/ip/firewall/nat",
+                    SUSPENDED_REDIRECT_COMMENT,
+                    {
+                        "chain": "dstnat",
+                        "src-address-list": settings["list"],
+                        "protocol": "tcp",
+                        "dst-port": "80",
+                        "action": "dst-nat",
+                        "to-addresses": settings["portal_ip"],
+                        "to-ports": settings["portal_port"],
+                    },
+                )
             )
-        except LibRouterosError:
-            return
+        block = {"chain": "forward", "src-address-list": settings["list"], "action": "drop"}
+        if settings["portal_ip"]:
+            block["dst-address"] = f"!{settings['portal_ip']}"
+        rules.append(("/ip/firewall/filter", SUSPENDED_BLOCK_COMMENT, block))
+        commands = []
+        for path, comment, values in rules:
+            if existing.get(comment):
+                commands.append(RouterOSCommand(f"{path}/set", **dict(values, numbers=existing[comment])))
+            else:
+                commands.append(RouterOSCommand(f"{path}/add", **dict(values, comment=comment)))
+        return commands
+
+    def _routeros_unlist_suspended_cmds(self, client, subscription):
+        """Commands taking ``subscription``'s IP off the suspended address list."""
+        if not subscription.service_ip:
+            return []
+        lookup = RouterOSCommand(
+            "/ip/firewall/address-list/print",
+            **{
+                "?list": self._get_address_list_settings()["list"],
+                "?address": subscription.service_ip,
+                ".proplist": ".id",
+            },
+        )
+        client.run([lookup])
+        return [
+            RouterOSCommand("/ip/firewall/address-list/remove", ignore_errors=True, numbers=row[".id"])
+            for row in lookup.rows
+            if row.get(".id")
+        ]
+
+    @api.model
+    def _coalesce_subscription_jobs(self, subscriptions, job_type, payload=None):
+        """Also take ``subscriptions`` out of the queued address-list syncs a new state change supersedes."""
+        pending, obsolete = super()._coalesce_subscription_jobs(subscriptions, job_type, payload)
+        if job_type in SUBSCRIPTION_STATE_JOBS and subscriptions:
+            ids = set(subscriptions.ids)
+            for job in self._lock_queued_jobs([("job_type", "=", "address_list_sync")]):
+                listed = job.get_payload()
+                if not ids.intersection(listed.get("suspend", []), listed.get("reconnect", [])):
+                    continue
+                suspend = [sub_id for sub_id in listed.get("suspend", []) if sub_id not in ids]
+                reconnect = [sub_id for sub_id in listed.get("reconnect", []) if sub_id not in ids]
+                if suspend or reconnect:
+                    job.payload_json = json.dumps({"suspend": suspend, "reconnect": reconnect})
+                else:
+                    job.state = "cancelled"
+        return pending, obsolete
+
+    @api.model
+    def _queue_address_list_sync(self, router, suspend=(), reconnect=()):
+        """Queue (or extend the queued) address-list sync job of ``router``.
+
+        A later request for a subscription overrides an earlier one still pending.
+        """
+        suspend, reconnect = set(suspend), set(reconnect)
+        job = self.search(
+            [
+                ("job_type", "=", "address_list_sync"),
+                ("device_id", "=", router.device_id.id),
+                ("state", "=", "queued"),
+            ],
+            order="id desc",
+            limit=1,
+        )
+        if job:
+            # Skip a job a worker is claiming right now rather than editing it under its feet.
+            self.env.cr.execute(
+                "SELECT id FROM isp_provisioning_job WHERE id = %s AND state = 'queued' FOR UPDATE SKIP LOCKED",
+                [job.id],
+            )
+            if not self.env.cr.fetchone():
+                job = self.browse()
+        if job:
+            job.invalidate_recordset(["payload_json"])
+            payload = job.get_payload()
+            suspend |= set(payload.get("suspend", [])) - reconnect
+            reconnect |= set(payload.get("reconnect", [])) - suspend
+            job.payload_json = json.dumps({"suspend": sorted(suspend), "reconnect": sorted(reconnect)})
+            return job
+        return self.create(
+            {
+                "job_type": "address_list_sync",
+                "device_id": router.device_id.id,
+                "sector_id": router.sector_id.id,
+                "payload_json": json.dumps({"suspend": sorted(suspend), "reconnect": sorted(reconnect)}),
+            }
+        )
+
+    def _routeros_pppoe_ensure_secret(self, client, subscription):
+        client.run([self._routeros_pppoe_secret_cmd(subscription)])
+
+    def _routeros_pppoe_disable(self, client, subscription):
+        client.run([self._routeros_pppoe_toggle_cmd(subscription, disabled=True)])
+
+    def _routeros_pppoe_enable(self, client, subscription):
+        client.run([self._routeros_pppoe_toggle_cmd(subscription, disabled=False)])
+
+    def _routeros_dhcp_ensure_lease(self, client, subscription):
+        client.run([self._routeros_dhcp_lease_cmd(subscription)])
+
+    def _routeros_queue_ensure(self, client, subscription):
+        client.run([self._routeros_queue_cmd(subscription)])
+
+    def _routeros_queue_disable(self, client, subscription):
+        client.run([self._routeros_queue_disable_cmd(subscription)])
 
     def _routeros_queue_remove(self, client, subscription):
-        name = subscription.name
-        try:
-            client.cmd("/queue/simple/remove", **{"numbers": name})
-        except LibRouterosError:
-            return
+        client.run([self._routeros_queue_remove_cmd(subscription)])
 
     def _handle_mikrotik_healthcheck(self):
         router = self._get_router()
-        client = get_routeros_client(self.env, router)
-        try:
+        with self._routeros_session(router) as client:
             resource = client.cmd("/system/resource/print")
             identity = client.cmd("/system/identity/print")
-            version = False
-            if resource:
-                version = resource[0].get("version")
-            if identity and identity[0].get("name"):
-                router.device_id.name = identity[0].get("name")
-            router.write(
-                {
-                    "routeros_version": version,
-                    "last_healthcheck_at": fields.Datetime.now(),
-                    "last_healthcheck_status": "ok",
-                }
-            )
-        except Exception:
-            router.write(
-                {
-                    "last_healthcheck_at": fields.Datetime.now(),
-                    "last_healthcheck_status": "failed",
-                }
-            )
-            raise
+        version = False
+        if resource:
+            version = resource[0].get("version")
+        if identity and identity[0].get("name"):
+            router.device_id.name = identity[0].get("name")
+        router.write(
+            {
+                "routeros_version": version,
+                "last_healthcheck_at": fields.Datetime.now(),
+                "last_healthcheck_status": "ok",
+            }
+        )
+
+    def _after_failure(self, exc):
+        super()._after_failure(exc)
+        if self.job_type != "mikrotik_healthcheck":
+            return
+        router = self.router_id or self.env["isp.mikrotik.router"]._find_router(self.device_id, self.subscription_id)
+        if router:
+            router.write({"last_healthcheck_at": fields.Datetime.now(), "last_healthcheck_status": "failed"})
 
     def _handle_activate_subscription(self):
         if not self.subscription_id:
@@ -164,14 +537,10 @@ class IspProvisioningJob(models.Model):
         sub = self.subscription_id
         sub._ensure_pppoe_credentials()
         router = self._get_router()
-        client = get_routeros_client(self.env, router)
-
-        if sub.plan_id.service_type == "pppoe":
-            self._routeros_pppoe_ensure_secret(client, sub)
-        elif sub.plan_id.service_type == "dhcp":
-            self._routeros_dhcp_ensure_lease(client, sub)
-
-        self._routeros_queue_ensure(client, sub)
+        with self._routeros_session(router) as client:
+            commands = [self._routeros_service_cmd(sub)] + self._routeros_shaping_cmds(client, router, sub, "ensure")
+            commands += self._routeros_unlist_suspended_cmds(client, sub)
+            client.run(commands)
         sub.write({"state": "active", "start_date": sub.start_date or fields.Date.today()})
 
     def _handle_suspend_subscription(self):
@@ -179,10 +548,11 @@ class IspProvisioningJob(models.Model):
             raise UserError("Subscription is required.")
         sub = self.subscription_id
         router = self._get_router()
-        client = get_routeros_client(self.env, router)
-        if sub.plan_id.service_type == "pppoe":
-            self._routeros_pppoe_disable(client, sub)
-        self._routeros_queue_disable(client, sub)
+        with self._routeros_session(router) as client:
+            commands = self._routeros_shaping_cmds(client, router, sub, "disable")
+            if sub.plan_id.service_type == "pppoe":
+                commands.insert(0, self._routeros_pppoe_toggle_cmd(sub, disabled=True))
+            client.run(commands)
         sub.write({"state": "suspended"})
 
     def _handle_reconnect_subscription(self):
@@ -190,10 +560,11 @@ class IspProvisioningJob(models.Model):
             raise UserError("Subscription is required.")
         sub = self.subscription_id
         router = self._get_router()
-        client = get_routeros_client(self.env, router)
-        if sub.plan_id.service_type == "pppoe":
-            self._routeros_pppoe_enable(client, sub)
-        self._routeros_queue_ensure(client, sub)
+        with self._routeros_session(router) as client:
+            commands = self._routeros_shaping_cmds(client, router, sub, "ensure")
+            if sub.plan_id.service_type == "pppoe":
+                commands.insert(0, self._routeros_pppoe_toggle_cmd(sub, disabled=False))
+            client.run(commands)
         sub.write({"state": "active"})
 
     def _handle_terminate_subscription(self):
@@ -201,10 +572,12 @@ class IspProvisioningJob(models.Model):
             raise UserError("Subscription is required.")
         sub = self.subscription_id
         router = self._get_router()
-        client = get_routeros_client(self.env, router)
-        if sub.plan_id.service_type == "pppoe":
-            self._routeros_pppoe_disable(client, sub)
-        self._routeros_queue_remove(client, sub)
+        with self._routeros_session(router) as client:
+            commands = self._routeros_shaping_cmds(client, router, sub, "remove")
+            commands += self._routeros_unlist_suspended_cmds(client, sub)
+            if sub.plan_id.service_type == "pppoe":
+                commands.insert(0, self._routeros_pppoe_toggle_cmd(sub, disabled=True))
+            client.run(commands)
         sub.write({"state": "terminated"})
 
     def _handle_change_plan(self):
@@ -212,21 +585,22 @@ class IspProvisioningJob(models.Model):
             raise UserError("Subscription is required.")
         sub = self.subscription_id
         router = self._get_router()
-        client = get_routeros_client(self.env, router)
-        if sub.plan_id.service_type == "pppoe":
-            self._routeros_pppoe_ensure_secret(client, sub)
-        self._routeros_queue_ensure(client, sub)
+        with self._routeros_session(router) as client:
+            commands = self._routeros_shaping_cmds(client, router, sub, "ensure")
+            if sub.plan_id.service_type == "pppoe":
+                commands.insert(0, self._routeros_pppoe_secret_cmd(sub))
+            client.run(commands)
 
     def _handle_disconnect_session(self):
         if not self.subscription_id:
             raise UserError("Subscription is required.")
         sub = self.subscription_id
         router = self._get_router()
-        client = get_routeros_client(self.env, router)
-        if sub.plan_id.service_type == "pppoe":
-            client.cmd("/ppp/active/remove", **{"numbers": sub.pppoe_username})
-        else:
-            client.cmd("/ip/hotspot/active/remove", **{"numbers": sub.pppoe_username})
+        with self._routeros_session(router) as client:
+            if sub.plan_id.service_type == "pppoe":
+                client.cmd("/ppp/active/remove", **{"numbers": sub.pppoe_username})
+            else:
+                client.cmd("/ip/hotspot/active/remove", **{"numbers": sub.pppoe_username})
 
     def _handle_activate_pppoe(self):
         if not self.subscription_id:
@@ -234,21 +608,86 @@ class IspProvisioningJob(models.Model):
         sub = self.subscription_id
         sub._ensure_pppoe_credentials()
         router = self._get_router()
-        client = get_routeros_client(self.env, router)
-        self._routeros_pppoe_ensure_secret(client, sub)
+        with self._routeros_session(router) as client:
+            self._routeros_pppoe_ensure_secret(client, sub)
 
     def _handle_activate_dhcp(self):
         if not self.subscription_id:
             raise UserError("Subscription is required.")
         sub = self.subscription_id
         router = self._get_router()
-        client = get_routeros_client(self.env, router)
-        self._routeros_dhcp_ensure_lease(client, sub)
+        with self._routeros_session(router) as client:
+            self._routeros_dhcp_ensure_lease(client, sub)
 
     def _handle_ensure_queue(self):
         if not self.subscription_id:
             raise UserError("Subscription is required.")
         sub = self.subscription_id
         router = self._get_router()
-        client = get_routeros_client(self.env, router)
-        self._routeros_queue_ensure(client, sub)
+        with self._routeros_session(router) as client:
+            client.run(self._routeros_shaping_cmds(client, router, sub, "ensure"))
+
+    def _handle_reconcile_router(self):
+        router = self._get_router()
+        dry_run = bool(self.get_payload().get("dry_run"))
+        with self._routeros_session(router) as client:
+            router._reconcile(client, dry_run=dry_run)
+
+    def _handle_address_list_sync(self):
+        payload = self.get_payload()
+        Subscription = self.env["isp.subscription"]
+        # Only act on subscriptions still in the state the request started from.
+        suspend = Subscription.browse(payload.get("suspend", [])).exists().filtered(lambda s: s.state == "active")
+        reconnect = Subscription.browse(payload.get("reconnect", [])).exists().filtered(
+            lambda s: s.state == "suspended"
+        )
+        # Without a service IP there is nothing to list: go through the per-subscription jobs.
+        for subs, job_type in ((suspend, "suspend_subscription"), (reconnect, "reconnect_subscription")):
+            unlisted = subs.filtered(lambda s: not s.service_ip)
+            if unlisted:
+                unlisted._queue_jobs(job_type)
+        suspend, reconnect = suspend.filtered("service_ip"), reconnect.filtered("service_ip")
+        if not suspend and not reconnect:
+            return
+        router = self._get_router()
+        settings = self._get_address_list_settings()
+        listing = RouterOSCommand(
+            "/ip/firewall/address-list/print",
+            **{"?list": settings["list"], ".proplist": ".id,address"},
+        )
+        rule_lookups = [
+            RouterOSCommand(f"{path}/print", **{"?comment": comment, ".proplist": ".id,comment"})
+            for path, comment in (
+                ("/ip/firewall/nat", SUSPENDED_REDIRECT_COMMENT),
+                ("/ip/firewall/filter", SUSPENDED_BLOCK_COMMENT),
+            )
+        ]
+        with self._routeros_session(router) as client:
+            client.run([listing] + rule_lookups)
+            listed = {row.get("address"): row.get(".id") for row in listing.rows}
+            existing = {row.get("comment"): row.get(".id") for lookup in rule_lookups for row in lookup.rows}
+            commands = self._routeros_suspension_rule_cmds(settings, existing)
+            for sub in suspend:
+                if sub.service_ip not in listed:
+                    commands.append(
+                        RouterOSCommand(
+                            "/ip/firewall/address-list/add",
+                            list=settings["list"],
+                            address=sub.service_ip,
+                            comment=sub.name,
+                        )
+                    )
+            for sub in reconnect:
+                if listed.get(sub.service_ip):
+                    commands.append(
+                        RouterOSCommand(
+                            "/ip/firewall/address-list/remove",
+                            ignore_errors=True,
+                            numbers=listed[sub.service_ip],
+                        )
+                    )
+            client.run(commands)
+        if suspend:
+            suspend.write({"state": "suspended"})
+        if reconnect:
+            reconnect.write({"state": "active"})
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+import re
+
+from .routeros_client import RouterOSCommand
+
+# Prefix of the per-plan address lists classifying traffic on PCQ routers.
+PLAN_LIST_PREFIX = "isp_plan_"
+
+# Managed RouterOS tables: API path, key column, the columns Odoo owns and,
+# for shared tables, which rows are Odoo's.
+SECTIONS = {
+    "ppp_secret": {
+        "path": "/ppp/secret",
+        "key": "name",
+        "fields": ("password", "profile", "service", "disabled"),
+    },
+    "dhcp_lease": {
+        "path": "/ip/dhcp-server/lease",
+        "key": "address",
+        "fields": ("mac-address", "comment", "disabled"),
+    },
+    "queue_simple": {
+        "path": "/queue/simple",
+        "key": "name",
+        "fields": ("target", "max-limit", "comment", "disabled"),
+    },
+    "plan_address": {
+        "path": "/ip/firewall/address-list",
+        "key": "address",
+        "fields": ("list", "comment", "disabled"),
+        "match": lambda row: str(row.get("list", "")).startswith(PLAN_LIST_PREFIX),
+    },
+}
+
+_RATE_RE = re.compile(r"^\s*([\d.]+)\s*([kKmMgG]?)\s*$")
+_RATE_UNITS = {"": 1, "k": 1000, "m": 1000000, "g": 1000000000}
+
+
+def _normalize_rate(value):
+    parts = []
+    for part in str(value).split("/"):
+        match = _RATE_RE.match(part)
+        if not match:
+            return str(value)
+        parts.append(str(int(float(match.group(1)) * _RATE_UNITS[match.group(2).lower()])))
+    return "/".join(parts)
+
+
+def normalize_value(field, value):
+    if isinstance(value, bool):
+        return "yes" if value else "no"
+    if value is None:
+        return ""
+    if field in ("max-limit", "pcq-rate"):
+        return _normalize_rate(value)
+    if field == "mac-address":
+        return str(value).upper()
+    if field == "disabled":
+        return "yes" if str(value).lower() in ("yes", "true") else "no"
+    return str(value)
+
+
+def desired_entries(job_model, subscription, router=None):
+    """Return {section: {field: value}} for ``subscription``; ``None`` means the entry must not exist."""
+    entries = {}
+    if subscription.state not in ("active", "suspended", "terminated"):
+        return entries
+    suspended = subscription.state != "active"
+    if subscription.state == "suspended" and subscription._uses_address_list_suspension():
+        # Suspended through the firewall address list: secret and queue stay enabled.
+        suspended = False
+    if subscription.plan_id.service_type == "pppoe" and subscription.pppoe_username:
+        cmd = job_model._routeros_pppoe_secret_cmd(subscription)
+        entries["ppp_secret"] = dict(cmd.kwargs, disabled="yes" if suspended else "no")
+    if subscription.plan_id.service_type == "dhcp" and subscription.state != "terminated":
+        cmd = job_model._routeros_dhcp_lease_cmd(subscription)
+        if cmd:
+            entries["dhcp_lease"] = dict(cmd.kwargs, disabled="no")
+    if subscription.service_ip and router and router.shaping_backend == "pcq":
+        if subscription.state == "terminated":
+            entries["plan_address"] = None
+        else:
+            entries["plan_address"] = {
+                "list": job_model._routeros_plan_list_name(subscription.plan_id),
+                "address": subscription.service_ip,
+                "comment": subscription.name,
+                "disabled": "yes" if suspended else "no",
+            }
+    elif subscription.service_ip:
+        if subscription.state == "terminated":
+            entries["queue_simple"] = None
+        else:
+            cmd = job_model._routeros_queue_cmd(subscription)
+            entries["queue_simple"] = dict(cmd.kwargs, disabled="yes" if suspended else "no")
+    return entries
+
+
+class RouterOSReconciler:
+    """Diff the managed tables of one router against the subscriptions bound to it.
+
+    ``fetch`` reads each table once, ``plan`` computes the minimal add/set/remove
+    operations and ``apply`` sends them pipelined.
+    """
+
+    def __init__(self, env, router, client):
+        self.env = env
+        self.router = router
+        self.client = client
+        self.actual = {}
+
+    def managed_sections(self):
+        unused = "queue_simple" if self.router.shaping_backend == "pcq" else "plan_address"
+        return [section for section in SECTIONS if section != unused]
+
+    def fetch(self, sections=None):
+        for section in sections or self.managed_sections():
+            spec = SECTIONS[section]
+            proplist = ",".join((".id", spec["key"]) + spec["fields"])
+            rows = self.client.cmd(f"{spec['path']}/print", **{".proplist": proplist})
+            if spec.get("match"):
+                rows = [row for row in rows if spec["match"](row)]
+            table = {}
+            for row in rows:
+                key = row.get(spec["key"])
+                if key is not None and str(key) not in table:
+                    table[str(key)] = row
+            self.actual[section] = table
+        return self.actual
+
+    def desired(self, subscriptions):
+        job_model = self.env["isp.provisioning_job"]
+        result = {section: {} for section in SECTIONS}
+        for sub in subscriptions:
+            for section, values in desired_entries(job_model, sub, self.router).items():
+                if values is None:
+                    key = sub.service_ip if SECTIONS[section]["key"] == "address" else sub.name
+                else:
+                    key = values[SECTIONS[section]["key"]]
+                result[section][str(key)] = (sub, values)
+        return result
+
+    def plan(self, subscriptions):
+        operations = []
+        for section, entries in self.desired(subscriptions).items():
+            spec = SECTIONS[section]
+            actual = self.actual.get(section, {})
+            for key, (sub, values) in entries.items():
+                row = actual.get(key)
+                if values is None:
+                    if row:
+                        operations.append(self._operation("remove", section, key, sub, row, {}))
+                    continue
+                if not row:
+                    operations.append(self._operation("add", section, key, sub, row, values))
+                    continue
+                changes = {
+                    field: value
+                    for field, value in values.items()
+                    if field in spec["fields"] and normalize_value(field, row.get(field)) != normalize_value(field, value)
+                }
+                if changes:
+                    operations.append(self._operation("set", section, key, sub, row, changes))
+        return operations
+
+    def _operation(self, action, section, key, subscription, row, values):
+        return {
+            "action": action,
+            "section": section,
+            "key": key,
+            "subscription_id": subscription.id,
+            "id": row.get(".id") if row else None,
+            "values": values,
+        }
+
+    def apply(self, operations):
+        commands = []
+        for op in operations:
+            path = SECTIONS[op["section"]]["path"]
+            if op["action"] == "add":
+                commands.append(RouterOSCommand(f"{path}/add", **op["values"]))
+            elif op["action"] == "set":
+                commands.append(RouterOSCommand(f"{path}/set", **dict(op["values"], numbers=op["id"])))
+            else:
+                commands.append(RouterOSCommand(f"{path}/remove", numbers=op["id"]))
+        self.client.run(commands)
+        return commands
+
+    @staticmethod
+    def format_plan(operations):
+        lines = []
+        for op in operations:
+            path = SECTIONS[op["section"]]["path"]
+            values = " ".join(
+                f"{field}={'***' if field == 'password' else value}" for field, value in op["values"].items()
+            )
+            lines.append(f"{op['action']} {path} {op['key']} {values}".rstrip())
+        return "\n".join(lines) or "No changes."
@@ -1,5 +1,14 @@
 # -*- coding: utf-8 -*-
-from odoo import api, fields, models
+import asyncio
+import time
+from odoo import api, fields, models, tools
+from odoo.addons.isp_core.models.metrics import METRICS
+from .reconciler import RouterOSReconciler
+from .routeros_async import healthcheck_fleet
+from .routeros_client import ROUTEROS_POOL, get_routeros_client
+
+# Per-transaction key of the router lookup cache version (see _router_cache_version).
+ROUTER_CACHE_VERSION_KEY = "isp_mikrotik.router_cache_version"
 
 
 class IspMikrotikRouter(models.Model):
@@ -12,9 +21,18 @@ class IspMikrotikRouter(models.Model):
     sector_id = fields.Many2one(related="device_id.sector_id", store=True)
     api_user = fields.Char(groups="isp_core.group_isp_admin,isp_core.group_isp_noc")
     auth_method = fields.Selection([( "api", "API"), ("ssh", "SSH")], default="api")
+    shaping_backend = fields.Selection(
+        [("simple_queue", "Simple Queues"), ("pcq", "PCQ Queue Tree")],
+        default="simple_queue",
+        required=True,
+        help="PCQ Queue Tree shapes through one PCQ queue per service plan and a per-plan "
+        "firewall address list; use it on routers with thousands of subscribers.",
+    )
     routeros_version = fields.Char(readonly=True)
     last_healthcheck_at = fields.Datetime(readonly=True)
     last_healthcheck_status = fields.Selection([("ok", "OK"), ("failed", "Failed")], readonly=True)
+    last_reconcile_at = fields.Datetime(readonly=True)
+    last_reconcile_plan = fields.Text(readonly=True)
 
     def _get_api_user(self):
         self.ensure_one()
@@ -30,6 +48,74 @@ class IspMikrotikRouter(models.Model):
             return password
         return self.env["ir.config_parameter"].sudo().get_param("isp_mikrotik.default_api_password")
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        routers = super().create(vals_list)
+        self._invalidate_router_cache()
+        return routers
+
+    def write(self, vals):
+        res = super().write(vals)
+        if "device_id" in vals:
+            self._invalidate_router_cache()
+        return res
+
+    def unlink(self):
+        router_ids = self.ids
+        res = super().unlink()
+        self._invalidate_router_cache()
+        for router_id in router_ids:
+            ROUTEROS_POOL.close_router(router_id)
+        return res
+
+    @api.model
+    def _router_id_for_device(self, device_id):
+        return self._lookup_router_id("device_id", device_id, self._router_cache_version())
+
+    @api.model
+    def _router_id_for_sector(self, sector_id):
+        """First router of the sector; cached until a router or device changes."""
+        return self._lookup_router_id("sector_id", sector_id, self._router_cache_version())
+
+    @api.model
+    @tools.ormcache("field", "value", "version")
+    def _lookup_router_id(self, field, value, version):
+        return self.sudo().search([(field, "=", value)], limit=1).id or False
+
+    @api.model
+    def _router_cache_version(self):
+        """Digest of the columns the router lookups read; cached lookups are keyed on it.
+
+        Computed once per transaction, which sees a stable snapshot, and dropped
+        when the transaction itself changes a router or device. Other caches and
+        workers are left alone, unlike a registry cache clear.
+        """
+        data = self.env.cr.precommit.data
+        if ROUTER_CACHE_VERSION_KEY not in data:
+            self.flush_model(["device_id", "sector_id"])
+            self.env.cr.execute(
+                """
+                SELECT md5(string_agg(concat_ws(',', id, device_id, sector_id), ';' ORDER BY id))
+                  FROM isp_mikrotik_router
+                """
+            )
+            data[ROUTER_CACHE_VERSION_KEY] = self.env.cr.fetchone()[0]
+        return data[ROUTER_CACHE_VERSION_KEY]
+
+    @api.model
+    def _invalidate_router_cache(self):
+        self.env.cr.precommit.data.pop(ROUTER_CACHE_VERSION_KEY, None)
+
+    @api.model
+    def _find_router(self, device=None, subscription=None):
+        """Router serving a device, else the subscription's router, else its sector's first router."""
+        router_id = device and self._router_id_for_device(device.id)
+        if not router_id and subscription:
+            router_id = subscription.router_id.id
+            if not router_id and subscription.sector_id:
+                router_id = self._router_id_for_sector(subscription.sector_id.id)
+        return self.browse(router_id or [])
+
     def action_healthcheck(self):
         for router in self:
             vals = {
@@ -39,6 +125,111 @@ class IspMikrotikRouter(models.Model):
             }
             self.env["isp.provisioning_job"].create(vals)
 
+    def action_healthcheck_fleet(self):
+        self._healthcheck_fleet()
+
+    @api.model
+    def _cron_healthcheck_fleet(self):
+        self.search([])._healthcheck_fleet()
+
+    def _healthcheck_fleet(self):
+        """Poll all routers of ``self`` concurrently and store the results in a few grouped writes."""
+        if not self:
+            return {}
+        started = time.monotonic()
+        params = self.env["ir.config_parameter"].sudo()
+        concurrency = self._get_positive_param("healthcheck_concurrency", 50, int)
+        timeout = self._get_positive_param("healthcheck_timeout", 10, float)
+        results = {}
+        infos = {}
+        if params.get_param("isp_mikrotik.dry_run") in ("1", "true", "True"):
+            results = {router.id: {"status": "ok", "version": router.routeros_version} for router in self}
+        else:
+            for router in self:
+                info = router.get_connection_info()
+                if not info.get("host") or not info.get("password"):
+                    results[router.id] = {"status": "failed", "error": "Missing management IP or API password."}
+                else:
+                    infos[router.id] = info
+        if infos:
+            results.update(asyncio.run(healthcheck_fleet(infos, concurrency=concurrency, timeout=timeout)))
+        METRICS.observe("isp_healthcheck_duration_seconds", time.monotonic() - started)
+        for result in results.values():
+            METRICS.inc("isp_healthcheck_runs_total", {"result": result["status"]})
+
+        now = fields.Datetime.now()
+        groups = {}
+        renames = {}
+        for router in self:
+            result = results[router.id]
+            vals = {"last_healthcheck_at": now, "last_healthcheck_status": result["status"]}
+            if result["status"] == "ok":
+                vals["routeros_version"] = result.get("version") or False
+                identity = result.get("identity")
+                if identity and identity != router.device_id.name:
+                    renames.setdefault(identity, self.env["isp.device"])
+                    renames[identity] |= router.device_id
+            key = tuple(sorted(vals.items()))
+            groups.setdefault(key, self.browse())
+            groups[key] |= router
+        for key, routers in groups.items():
+            routers.write(dict(key))
+        for identity, devices in renames.items():
+            devices.write({"name": identity})
+        return results
+
+    @api.model
+    def _get_positive_param(self, key, default, cast):
+        """``isp_mikrotik.<key>`` as a positive ``cast`` value; ``default`` when unset or invalid."""
+        try:
+            value = cast(self.env["ir.config_parameter"].sudo().get_param(f"isp_mikrotik.{key}", default))
+        except (TypeError, ValueError):
+            return default
+        return value if value > 0 else default
+
+    def _get_bound_subscriptions(self):
+        """Subscriptions provisioned on this router, explicitly or as first router of their sector."""
+        self.ensure_one()
+        domain = [("router_id", "=", self.id)]
+        if self.sector_id and self.search([("sector_id", "=", self.sector_id.id)], limit=1) == self:
+            domain = ["|", ("router_id", "=", self.id), "&", ("router_id", "=", False), ("sector_id", "=", self.sector_id.id)]
+        return self.env["isp.subscription"].search(domain)
+
+    def _reconcile(self, client, dry_run=False):
+        self.ensure_one()
+        reconciler = RouterOSReconciler(self.env, self, client)
+        reconciler.fetch()
+        subscriptions = self._get_bound_subscriptions()
+        operations = reconciler.plan(subscriptions)
+        if not dry_run and self.shaping_backend == "pcq":
+            job_model = self.env["isp.provisioning_job"]
+            client.run(job_model._routeros_pcq_plans_cmds(client, subscriptions.mapped("plan_id")))
+        if not dry_run and operations:
+            reconciler.apply(operations)
+        header = "Dry run" if dry_run else "Applied"
+        self.write(
+            {
+                "last_reconcile_at": fields.Datetime.now(),
+                "last_reconcile_plan": f"{header}: {len(operations)} change(s)\n{RouterOSReconciler.format_plan(operations)}",
+            }
+        )
+        return operations
+
+    def action_reconcile_dry_run(self):
+        for router in self:
+            with get_routeros_client(self.env, router) as client:
+                router._reconcile(client, dry_run=True)
+
+    def action_reconcile(self):
+        for router in self:
+            self.env["isp.provisioning_job"].create(
+                {
+                    "job_type": "reconcile_router",
+                    "device_id": router.device_id.id,
+                    "sector_id": router.sector_id.id,
+                }
+            )
+
     def get_connection_info(self):
         self.ensure_one()
         return {
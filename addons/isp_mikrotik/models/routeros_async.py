@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Minimal asyncio RouterOS API client, used to poll many routers at once."""
+import asyncio
+import hashlib
+
+
+class AsyncTrapError(Exception):
+    pass
+
+
+def encode_length(length):
+    if length < 0x80:
+        return bytes([length])
+    if length < 0x4000:
+        return (length | 0x8000).to_bytes(2, "big")
+    if length < 0x200000:
+        return (length | 0xC00000).to_bytes(3, "big")
+    if length < 0x10000000:
+        return (length | 0xE0000000).to_bytes(4, "big")
+    return b"\xf0" + length.to_bytes(4, "big")
+
+
+def encode_sentence(words):
+    data = b""
+    for word in words:
+        raw = word.encode("utf-8")
+        data += encode_length(len(raw)) + raw
+    return data + b"\x00"
+
+
+async def _read_length(reader):
+    first = (await reader.readexactly(1))[0]
+    if first < 0x80:
+        return first
+    if first < 0xC0:
+        return ((first & 0x3F) << 8) | (await reader.readexactly(1))[0]
+    if first < 0xE0:
+        return ((first & 0x1F) << 16) | int.from_bytes(await reader.readexactly(2), "big")
+    if first < 0xF0:
+        return ((first & 0x0F) << 24) | int.from_bytes(await reader.readexactly(3), "big")
+    return int.from_bytes(await reader.readexactly(4), "big")
+
+
+async def read_sentence(reader):
+    words = []
+    while True:
+        length = await _read_length(reader)
+        if not length:
+            return words
+        words.append((await reader.readexactly(length)).decode("utf-8", errors="replace"))
+
+
+class AsyncRouterOSClient:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, host, port, user, password):
+        reader, writer = await asyncio.open_connection(host, port)
+        client = cls(reader, writer)
+        try:
+            await client.login(user, password)
+        except Exception:
+            await client.close()
+            raise
+        return client
+
+    async def login(self, user, password):
+        reply = await self.command("/login", name=user, password=password or "")
+        challenge = reply[0].get("ret") if reply else None
+        if challenge:
+            # RouterOS < 6.43 answers with an MD5 challenge.
+            digest = hashlib.md5(b"\x00" + (password or "").encode() + bytes.fromhex(challenge)).hexdigest()
+            await self.command("/login", name=user, response=f"00{digest}")
+
+    async def command(self, path, **kwargs):
+        words = [path] + [f"={key}={value}" for key, value in kwargs.items()]
+        self.writer.write(encode_sentence(words))
+        await self.writer.drain()
+        rows = []
+        trap = None
+        while True:
+            sentence = await read_sentence(self.reader)
+            if not sentence:
+                continue
+            reply_word, attrs = sentence[0], {}
+            for word in sentence[1:]:
+                if word.startswith("="):
+                    key, _, value = word[1:].partition("=")
+                    attrs[key] = value
+            if reply_word == "!fatal":
+                raise ConnectionError(" ".join(sentence[1:]) or "fatal")
+            if reply_word == "!trap":
+                trap = AsyncTrapError(attrs.get("message", "trap"))
+            elif reply_word == "!re" or (reply_word == "!done" and attrs):
+                rows.append(attrs)
+            if reply_word == "!done":
+                break
+        if trap:
+            raise trap
+        return rows
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except Exception:
+            pass
+
+
+async def healthcheck_router(info, timeout):
+    async def _check():
+        client = await AsyncRouterOSClient.connect(info["host"], info["port"], info["user"], info["password"])
+        try:
+            resource = await client.command("/system/resource/print")
+            identity = await client.command("/system/identity/print")
+        finally:
+            await client.close()
+        return {
+            "status": "ok",
+            "version": resource[0].get("version") if resource else False,
+            "identity": identity[0].get("name") if identity else False,
+        }
+
+    try:
+        return await asyncio.wait_for(_check(), timeout)
+    except Exception as exc:
+        return {"status": "failed", "error": str(exc) or exc.__class__.__name__}
+
+
+async def healthcheck_fleet(infos, concurrency=50, timeout=10):
+    """Check every router of ``infos`` ({router_id: connection info}) concurrently."""
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def _bounded(router_id, info):
+        async with semaphore:
+            return router_id, await healthcheck_router(info, timeout)
+
+    results = await asyncio.gather(*(_bounded(router_id, info) for router_id, info in infos.items()))
+    return dict(results)
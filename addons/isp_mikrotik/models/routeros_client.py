@@ -1,21 +1,236 @@
 # -*- coding: utf-8 -*-
+import itertools
+import logging
+import re
+import select
+import threading
+import time
+
 from odoo import fields
 from odoo.exceptions import UserError
+from odoo.addons.isp_core.models.metrics import METRICS
+from odoo.addons.isp_core.models.provisioning_job import JobTimer
 
 try:
     from librouteros import connect
-    from librouteros.exceptions import LibRouterosError
+    from librouteros.exceptions import ConnectionClosed, FatalError, LibRouterosError, TrapError
 except Exception:  # pragma: no cover - optional dependency
     connect = None
     LibRouterosError = Exception
+    ConnectionClosed = FatalError = ConnectionError
+
+    class TrapError(LibRouterosError):
+        def __init__(self, message, category=None):
+            self.message = message
+            self.category = category
+            super().__init__(message)
+
+_logger = logging.getLogger(__name__)
+
+# Errors after which a connection can no longer be trusted and must be dropped.
+CONNECTION_ERRORS = (ConnectionClosed, FatalError, OSError)
+
+# Trap category RouterOS uses for "execution of command interrupted".
+TRAP_INTERRUPTED = 2
+
+# Traps meaning "the entry is already there", the only ones a fallback may answer.
+DUPLICATE_TRAP_RE = re.compile(r"already|exists", re.IGNORECASE)
+
+
+class RouterOSStats:
+    """Process-wide counters of RouterOS traffic, read by benchmarks and metrics."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.round_trips = 0
+        self.commands = 0
+
+    def record(self, round_trips, commands, started=None, router=None):
+        """Count traffic; with ``started`` (monotonic), also time it on the running job.
+
+        With ``router``, the traffic is exported to the per-router metrics too.
+        """
+        elapsed = time.monotonic() - started if started is not None else None
+        with self._lock:
+            self.round_trips += round_trips
+            self.commands += commands
+        timer = JobTimer.current()
+        if timer is not None:
+            timer.count("routeros_round_trips", round_trips)
+            timer.count("routeros_commands", commands)
+            if elapsed is not None:
+                timer.add("routeros", elapsed * 1000)
+        if router is not None:
+            labels = {"router": router.name or router.id}
+            METRICS.inc("isp_routeros_commands_total", labels, commands)
+            if elapsed is not None:
+                METRICS.observe("isp_routeros_request_seconds", elapsed, labels)
+
+    def record_error(self, router, kind):
+        METRICS.inc("isp_routeros_errors_total", {"router": router.name or router.id, "kind": kind})
+
+    def snapshot(self):
+        with self._lock:
+            return {"round_trips": self.round_trips, "commands": self.commands}
+
+
+ROUTEROS_STATS = RouterOSStats()
+
+
+class RouterOSPoolTimeout(UserError):
+    """No pooled RouterOS session became free in time."""
+
+
+class RouterOSCircuitOpen(UserError):
+    """The router's circuit breaker refuses connection attempts for now."""
+
+    def __init__(self, message, retry_in=60):
+        super().__init__(message)
+        self.retry_in = retry_in
+
+
+class RouterOSCommand:
+    """A RouterOS API command and how to react when the router traps it.
+
+    ``fallback`` is another command sent when this one is rejected because the
+    entry already exists (the usual "add, else set" idiom); ``ignore_errors``
+    drops any trap silently.
+    """
+
+    def __init__(self, path, fallback=None, ignore_errors=False, **kwargs):
+        self.path = path
+        self.kwargs = kwargs
+        self.fallback = fallback
+        self.ignore_errors = ignore_errors
+        self.rows = []
+        self.error = None
+
+    def words(self):
+        words = []
+        for key, value in self.kwargs.items():
+            if isinstance(value, bool):
+                value = "yes" if value else "no"
+            prefix = "" if key.startswith("?") else "="
+            words.append(f"{prefix}{key}={value}")
+        return words
+
+    def result(self):
+        if self.error:
+            raise self.error
+        return self.rows
+
+
+def _parse_reply_words(words):
+    attrs = {}
+    tag = None
+    for word in words:
+        if word.startswith(".tag="):
+            tag = word[5:]
+        elif word.startswith("="):
+            key, _, value = word[1:].partition("=")
+            attrs[key] = value
+    return attrs, tag
+
+
+class RouterOSPipeline:
+    """Collects commands and sends them tagged, without waiting for each reply."""
+
+    def __init__(self, client, window):
+        self.client = client
+        self.window = window
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.execute()
+
+    def add(self, path, **kwargs):
+        command = path if isinstance(path, RouterOSCommand) else RouterOSCommand(path, **kwargs)
+        self.commands.append(command)
+        return command
+
+    def execute(self):
+        pending = [command for command in self.commands if not command.rows and command.error is None]
+        if pending:
+            self.client._send_pipelined(pending, self.window)
+        return self.commands
+
+
+class PipelineMixin:
+    def _get_pipeline_window(self):
+        try:
+            window = int(self.env["ir.config_parameter"].sudo().get_param("isp_mikrotik.pipeline_window", 32))
+        except (TypeError, ValueError):
+            window = 32
+        return max(window, 1)
+
+    def pipeline(self, window=None):
+        return RouterOSPipeline(self, window or self._get_pipeline_window())
+
+    def run(self, commands):
+        """Run ``commands`` pipelined, then the fallbacks of the ones trapped as duplicates.
 
+        Costs one round-trip (two when fallbacks are needed) instead of one per
+        command. Other traps are raised unless ``ignore_errors``.
+        """
+        commands = [command for command in commands if command]
+        if not commands:
+            return commands
+        pipe = self.pipeline()
+        for command in commands:
+            pipe.add(command)
+        pipe.execute()
+        fallbacks = []
+        for command in commands:
+            if command.error is None:
+                continue
+            if command.fallback and DUPLICATE_TRAP_RE.search(str(command.error)):
+                fallbacks.append(command.fallback)
+            elif not command.ignore_errors:
+                raise command.error
+        if fallbacks:
+            self.run(fallbacks)
+        return commands
 
-class DummyRouterOS:
+    def _send_pipelined(self, commands, window):
+        for command in commands:
+            try:
+                command.rows = self.cmd(command.path, **command.kwargs)
+            except LibRouterosError as exc:
+                command.error = exc
+
+
+class DummyRouterOS(PipelineMixin):
     def __init__(self, env, router):
         self.env = env
         self.router = router
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        return
+
     def cmd(self, path, **kwargs):
+        started = time.monotonic()
+        try:
+            return self._log(path, kwargs)
+        finally:
+            ROUTEROS_STATS.record(1, 1, started, self.router)
+
+    def _send_pipelined(self, commands, window):
+        started = time.monotonic()
+        for command in commands:
+            command.rows = self._log(command.path, command.kwargs)
+        ROUTEROS_STATS.record(-(-len(commands) // window), len(commands), started, self.router)
+
+    def _log(self, path, kwargs):
         self.env["isp.audit_log"].sudo().log_action(
             action="routeros.dry_run",
             record=self.router.device_id,
@@ -24,7 +239,163 @@ class DummyRouterOS:
         return []
 
 
-class RouterOSAdapter:
+class PooledConnection:
+    def __init__(self, api, key):
+        self.api = api
+        self.key = key
+        self.released_at = time.monotonic()
+        # Pipelined tags keep counting across batches, so a late reply to an
+        # earlier batch never matches a command of the current one.
+        self.tags = itertools.count()
+
+    def _socket(self):
+        protocol = getattr(self.api, "protocol", None)
+        transport = getattr(protocol, "transport", None)
+        return getattr(transport, "sock", None)
+
+    def is_alive(self, ping_interval):
+        sock = self._socket()
+        if sock is not None:
+            try:
+                readable, _, _ = select.select([sock], [], [], 0)
+                # An idle API socket has nothing to read; EOF or stray data both mean
+                # the session is unusable.
+                if readable:
+                    return False
+            except (OSError, ValueError):
+                return False
+        if time.monotonic() - self.released_at < ping_interval:
+            return True
+        try:
+            list(self.api("/system/identity/print"))
+        except Exception:
+            return False
+        return True
+
+    def close(self):
+        try:
+            self.api.close()
+        except Exception:
+            pass
+
+
+class RouterOSConnectionPool:
+    """Process-wide pool of RouterOS API sessions keyed by ``isp.mikrotik.router`` id."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._idle = {}
+        self._in_use = {}
+
+    def acquire(self, router_id, key, factory, idle_timeout=300, max_connections=2, wait_timeout=30, ping_interval=60):
+        conn = self._checkout(router_id, key, idle_timeout, max_connections, wait_timeout)
+        if conn is not None:
+            if conn.is_alive(ping_interval):
+                return conn
+            _logger.info("Dropping dead RouterOS connection for router %s", router_id)
+            conn.close()
+        try:
+            return PooledConnection(factory(), key)
+        except Exception:
+            self._free_slot(router_id)
+            raise
+
+    def release(self, router_id, conn, broken=False):
+        if broken:
+            conn.close()
+            self._free_slot(router_id)
+            return
+        conn.released_at = time.monotonic()
+        with self._cond:
+            self._in_use[router_id] = max(self._in_use.get(router_id, 0) - 1, 0)
+            self._idle.setdefault(router_id, []).append(conn)
+            self._cond.notify_all()
+
+    def close_router(self, router_id):
+        with self._cond:
+            idle = self._idle.pop(router_id, [])
+        for conn in idle:
+            conn.close()
+
+    def close_all(self):
+        with self._cond:
+            idle = [conn for conns in self._idle.values() for conn in conns]
+            self._idle.clear()
+        for conn in idle:
+            conn.close()
+
+    def _checkout(self, router_id, key, idle_timeout, max_connections, wait_timeout):
+        """Reserve a slot for ``router_id``; return an idle connection or None to open a new one."""
+        deadline = time.monotonic() + wait_timeout
+        expired = []
+        try:
+            with self._cond:
+                while True:
+                    expired.extend(self._prune(idle_timeout))
+                    idle = self._idle.get(router_id, [])
+                    while idle:
+                        conn = idle.pop()
+                        if conn.key == key:
+                            self._in_use[router_id] = self._in_use.get(router_id, 0) + 1
+                            return conn
+                        expired.append(conn)
+                    if self._in_use.get(router_id, 0) < max_connections:
+                        self._in_use[router_id] = self._in_use.get(router_id, 0) + 1
+                        return None
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise RouterOSPoolTimeout("Timed out waiting for a free RouterOS connection.")
+                    self._cond.wait(remaining)
+        finally:
+            for conn in expired:
+                conn.close()
+
+    def _prune(self, idle_timeout):
+        now = time.monotonic()
+        expired = []
+        for router_id, conns in list(self._idle.items()):
+            alive = [conn for conn in conns if now - conn.released_at < idle_timeout]
+            expired.extend(conn for conn in conns if now - conn.released_at >= idle_timeout)
+            if alive:
+                self._idle[router_id] = alive
+            else:
+                del self._idle[router_id]
+        return expired
+
+    def _free_slot(self, router_id):
+        with self._cond:
+            self._in_use[router_id] = max(self._in_use.get(router_id, 0) - 1, 0)
+            self._cond.notify_all()
+
+
+ROUTEROS_POOL = RouterOSConnectionPool()
+
+
+def _get_pool_settings(env):
+    params = env["ir.config_parameter"].sudo()
+
+    def _int(key, default):
+        try:
+            return int(params.get_param(f"isp_mikrotik.{key}", default))
+        except (TypeError, ValueError):
+            return default
+
+    return {
+        "idle_timeout": _int("pool_idle_timeout", 300),
+        "max_connections": max(_int("pool_max_per_router", 2), 1),
+        "wait_timeout": _int("pool_wait_timeout", 30),
+        "ping_interval": _int("pool_ping_interval", 60),
+        "connect_timeout": _int("connect_timeout", 10),
+    }
+
+
+class RouterOSAdapter(PipelineMixin):
+    """RouterOS API session borrowed from the process-wide pool.
+
+    Use it as a context manager (or call ``close``) so the session goes back to
+    the pool instead of being left open.
+    """
+
     def __init__(self, env, router):
         if not connect:
             raise UserError("librouteros is not installed in this Odoo environment.")
@@ -35,15 +406,154 @@ class RouterOSAdapter:
             raise UserError("Router API password is missing.")
         self.env = env
         self.router = router
-        self.api = connect(
-            host=info["host"],
-            username=info["user"],
-            password=info["password"],
-            port=info.get("port") or 8728,
+        self._info = info
+        self._settings = _get_pool_settings(env)
+        self._key = (info["host"], info.get("port") or 8728, info["user"], info["password"])
+        self._conn = None
+        self._breaker_dirty = False
+        self._acquire()
+
+    @property
+    def api(self):
+        return self._conn.api
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _connect(self):
+        return connect(
+            host=self._info["host"],
+            username=self._info["user"],
+            password=self._info["password"],
+            port=self._info.get("port") or 8728,
+            timeout=self._settings["connect_timeout"],
         )
 
+    def _acquire(self):
+        # Reconnects go through the breaker too: a shared session dropped
+        # mid-group must not keep dialling a router that is known to be down.
+        self._breaker_dirty = self.router._breaker_before_connect() or self._breaker_dirty
+        settings = self._settings
+        timer = JobTimer.current()
+        started = time.monotonic()
+        try:
+            self._conn = ROUTEROS_POOL.acquire(
+                self.router.id,
+                self._key,
+                self._connect,
+                idle_timeout=settings["idle_timeout"],
+                max_connections=settings["max_connections"],
+                wait_timeout=settings["wait_timeout"],
+                ping_interval=settings["ping_interval"],
+            )
+        except CONNECTION_ERRORS:
+            ROUTEROS_STATS.record_error(self.router, "connect")
+            self.router._breaker_record_failure()
+            raise
+        except RouterOSPoolTimeout:
+            ROUTEROS_STATS.record_error(self.router, "pool_timeout")
+            raise
+        finally:
+            if timer is not None:
+                timer.add("connect", (time.monotonic() - started) * 1000)
+        if self._breaker_dirty:
+            self.router._breaker_record_success()
+            self._breaker_dirty = False
+
+    def _drop(self):
+        if self._conn is not None:
+            ROUTEROS_POOL.release(self.router.id, self._conn, broken=True)
+            self._conn = None
+
     def cmd(self, path, **kwargs):
-        return list(self.api(path, **kwargs))
+        """Run one command; a ``print`` is retried once on a fresh session if the connection drops.
+
+        Other commands are not retried: the router may have applied them before
+        the connection was lost, and replaying an ``add`` or ``remove`` would
+        duplicate it or trap.
+        """
+        if self._conn is None:
+            self._acquire()
+        started = time.monotonic()
+        try:
+            return list(self.api(path, **kwargs))
+        except CONNECTION_ERRORS as exc:
+            ROUTEROS_STATS.record_error(self.router, "connection")
+            self._drop()
+            if not path.endswith("/print"):
+                self.router._breaker_record_failure()
+                raise
+            _logger.info("RouterOS connection to router %s lost (%s), reconnecting", self.router.id, exc)
+        except TrapError:
+            ROUTEROS_STATS.record_error(self.router, "trap")
+            raise
+        finally:
+            ROUTEROS_STATS.record(1, 1, started, self.router)
+        self._acquire()
+        started = time.monotonic()
+        try:
+            return list(self.api(path, **kwargs))
+        except CONNECTION_ERRORS:
+            ROUTEROS_STATS.record_error(self.router, "connection")
+            self._drop()
+            self.router._breaker_record_failure()
+            raise
+        except TrapError:
+            ROUTEROS_STATS.record_error(self.router, "trap")
+            raise
+        finally:
+            ROUTEROS_STATS.record(1, 1, started, self.router)
+
+    def _send_pipelined(self, commands, window):
+        """Write tagged sentences keeping at most ``window`` in flight; demultiplex replies by tag."""
+        if self._conn is None:
+            self._acquire()
+        protocol = self.api.protocol
+        started = time.monotonic()
+        pending = {}
+        position = 0
+        try:
+            while position < len(commands) or pending:
+                while position < len(commands) and len(pending) < window:
+                    command = commands[position]
+                    tag = str(next(self._conn.tags))
+                    protocol.writeSentence(command.path, *command.words(), f".tag={tag}")
+                    pending[tag] = command
+                    position += 1
+                reply_word, words = protocol.readSentence()
+                attrs, tag = _parse_reply_words(words)
+                command = pending.get(tag)
+                if command is None:
+                    continue
+                if reply_word == "!re":
+                    command.rows.append(attrs)
+                elif reply_word == "!trap":
+                    ROUTEROS_STATS.record_error(self.router, "trap")
+                    category = attrs.get("category")
+                    command.error = TrapError(
+                        message=attrs.get("message", ""),
+                        category=int(category) if category and category.isdigit() else None,
+                    )
+                elif reply_word == "!done":
+                    if attrs:
+                        command.rows.append(attrs)
+                    del pending[tag]
+        except CONNECTION_ERRORS:
+            # Replies still in flight are lost with the session.
+            ROUTEROS_STATS.record_error(self.router, "connection")
+            self._drop()
+            self.router._breaker_record_failure()
+            raise
+        finally:
+            ROUTEROS_STATS.record(-(-len(commands) // window), len(commands), started, self.router)
+
+    def close(self):
+        if self._conn is not None:
+            ROUTEROS_POOL.release(self.router.id, self._conn)
+            self._conn = None
 
 
 def get_routeros_client(env, router):
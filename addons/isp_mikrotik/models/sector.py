@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from odoo import fields, models
+
+
+class IspSector(models.Model):
+    _inherit = "isp.sector"
+
+    suspension_mode = fields.Selection(
+        [
+            ("disable", "Disable Secret and Queue"),
+            ("address_list", "Firewall Address List"),
+        ],
+        default="disable",
+        required=True,
+        help="Firewall Address List adds suspended subscribers to a RouterOS address list "
+        "redirected to the portal, leaving their secret, queue and session untouched.",
+    )
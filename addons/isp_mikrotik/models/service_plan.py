@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+from odoo import fields, models
+
+
+class IspServicePlan(models.Model):
+    _inherit = "isp.service_plan"
+
+    suspension_mode = fields.Selection(
+        [
+            ("sector", "Sector Default"),
+            ("disable", "Disable Secret and Queue"),
+            ("address_list", "Firewall Address List"),
+        ],
+        default="sector",
+        required=True,
+    )
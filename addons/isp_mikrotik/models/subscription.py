@@ -1,6 +1,12 @@
 # -*- coding: utf-8 -*-
 from odoo import api, fields, models
 
+# Job types grouped into one address-list sync job per router, and their payload key.
+ADDRESS_LIST_JOB_TYPES = {
+    "suspend_subscription": "suspend",
+    "reconnect_subscription": "reconnect",
+}
+
 
 class IspSubscription(models.Model):
     _inherit = "isp.subscription"
@@ -18,3 +24,53 @@ class IspSubscription(models.Model):
             ])
             if len(routers) == 1:
                 rec.router_id = routers[0]
+
+    def write(self, vals):
+        res = super().write(vals)
+        if "router_id" in vals or "sector_id" in vals:
+            # Queued jobs follow the subscription to its new router.
+            self.env["isp.provisioning_job"].sudo().search(
+                [("subscription_id", "in", self.ids), ("device_id", "=", False), ("state", "=", "queued")]
+            )._assign_routers()
+        return res
+
+    def _get_suspension_mode(self):
+        self.ensure_one()
+        if self.plan_id.suspension_mode and self.plan_id.suspension_mode != "sector":
+            return self.plan_id.suspension_mode
+        return self.sector_id.suspension_mode or "disable"
+
+    def _uses_address_list_suspension(self):
+        self.ensure_one()
+        return bool(self.service_ip) and self._get_suspension_mode() == "address_list"
+
+    def _queue_jobs(self, job_type, payload=None):
+        """Fold suspensions/reconnections in address-list mode into one sync job per router."""
+        key = ADDRESS_LIST_JOB_TYPES.get(job_type)
+        if not key or payload:
+            return super()._queue_jobs(job_type, payload)
+        Router = self.env["isp.mikrotik.router"]
+        by_sector = {}
+        by_router = {}
+        others = self.browse()
+        for sub in self:
+            router = sub.router_id
+            if not router and sub.sector_id:
+                if sub.sector_id.id not in by_sector:
+                    by_sector[sub.sector_id.id] = Router.search([("sector_id", "=", sub.sector_id.id)], limit=1)
+                router = by_sector[sub.sector_id.id]
+            if router and sub._uses_address_list_suspension():
+                by_router[router] = by_router.get(router, self.browse()) | sub
+            else:
+                others |= sub
+        jobs = super(IspSubscription, others)._queue_jobs(job_type, payload)
+        Job = self.env["isp.provisioning_job"]
+        for router, subs in by_router.items():
+            job = Job._queue_address_list_sync(router, **{key: subs.ids})
+            self.env["isp.audit_log"].sudo().log_actions(
+                action=job_type,
+                records=subs,
+                details=f"Queued in address list sync {job.name}",
+            )
+            jobs |= job
+        return jobs
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from unittest.mock import MagicMock, patch
+
+from odoo.tests.common import TransactionCase
+
+from odoo.addons.isp_mikrotik.models import routeros_client
+from odoo.addons.isp_mikrotik.models.routeros_client import CONNECTION_ERRORS, RouterOSAdapter, RouterOSCircuitOpen
+
+
+class TestRouterOSAdapter(TransactionCase):
+    def test_dropped_session_stops_reconnecting_once_breaker_opens(self):
+        router = MagicMock(id=0)
+        router.name = "breaker-test"
+        router.get_connection_info.return_value = {"host": "192.0.2.1", "port": 8728, "user": "odoo", "password": "x"}
+        router._breaker_before_connect.side_effect = [False, RouterOSCircuitOpen("open", retry_in=30)]
+        conn = MagicMock()
+        conn.api.side_effect = CONNECTION_ERRORS[0]("connection lost")
+        pool = routeros_client.ROUTEROS_POOL
+        with (
+            patch.object(routeros_client, "connect", MagicMock()),
+            patch.object(pool, "acquire", return_value=conn) as acquire,
+            patch.object(pool, "release"),
+        ):
+            adapter = RouterOSAdapter(self.env, router)
+            with self.assertRaises(RouterOSCircuitOpen) as caught:
+                adapter.cmd("/system/resource/print")
+        self.assertEqual(acquire.call_count, 1)
+        self.assertEqual(caught.exception.retry_in, 30)
+        router._breaker_record_failure.assert_not_called()
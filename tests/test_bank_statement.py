@@ -0,0 +1,164 @@
+import importlib.util
+import io
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+MODELS = Path(__file__).resolve().parent.parent / "addons" / "isp_billing" / "models"
+
+
+def _load(name):
+    # The addon package imports Odoo; these two modules do not.
+    spec = importlib.util.spec_from_file_location(f"isp_billing_{name}", MODELS / f"{name}.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+parser = _load("statement_parser")
+matcher = _load("statement_matcher")
+
+
+@pytest.mark.parametrize(
+    "raw, expected",
+    [
+        ("1,234.56", 1234.56),
+        ("1.234,56", 1234.56),
+        ("1,234", 1234.0),
+        ("12,5", 12.5),
+        ("1.234", 1.234),
+        ("1.234.567", 1234567.0),
+        ("1,234,567.10", 1234567.1),
+        ("(12.00)", -12.0),
+        ("-12", -12.0),
+        ("$ 1 500,00", 1500.0),
+        ("", 0.0),
+    ],
+)
+def test_parse_amount(raw, expected):
+    assert parser.parse_amount(raw) == pytest.approx(expected)
+
+
+def test_parse_amount_with_decimal_separator():
+    assert parser.parse_amount("1.234", ",") == 1234.0
+    assert parser.parse_amount("1.234,5", ",") == 1234.5
+    assert parser.parse_amount("1,234", ".") == 1234.0
+    assert parser.parse_amount("1.234", ".") == pytest.approx(1.234)
+    with pytest.raises(parser.StatementFormatError):
+        parser.parse_amount("12abc")
+
+
+def test_read_csv_maps_headers_and_skips_blank_rows():
+    data = "Fecha;Monto;Referencia;Nombre;Concepto\n02/03/2025;1.500,00;INV/2025/0001;Ana;Pago\n;;;;\n".encode()
+    rows = list(parser.read_statement(io.BytesIO(data), filename="bank.csv", decimal_separator=","))
+    assert len(rows) == 1
+    assert rows[0]["date"] == date(2025, 3, 2)
+    assert rows[0]["amount"] == 1500.0
+    assert rows[0]["reference"] == "INV/2025/0001"
+    assert rows[0]["partner_name"] == "Ana"
+    assert rows[0]["bank_ref"] == ""
+
+
+def test_read_csv_requires_date_and_amount():
+    with pytest.raises(parser.StatementFormatError):
+        list(parser.read_csv(io.BytesIO(b"reference,name\nX,Y\n")))
+
+
+def test_read_ofx_sgml_with_unclosed_last_transaction():
+    data = b"""OFXHEADER:100
+<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><BANKTRANLIST>
+<STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20250302120000[-4:AST]<TRNAMT>250.00<FITID>T1<NAME>Ana<MEMO>INV/2025/0001</STMTTRN>
+<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20250303<TRNAMT>-10.00<FITID>T2
+"""
+    rows = list(parser.read_statement(io.BytesIO(data)))
+    assert [row["bank_ref"] for row in rows] == ["T1", "T2"]
+    assert rows[0]["date"] == date(2025, 3, 2)
+    assert rows[0]["amount"] == 250.0
+    assert rows[0]["description"] == "INV/2025/0001"
+    assert rows[1]["amount"] == -10.0
+
+
+def test_read_camt_entries():
+    data = b"""<?xml version="1.0"?>
+<Document xmlns="urn:iso:std:iso:20022:tech:xsd:camt.053.001.02"><BkToCstmrStmt><Stmt>
+<Ntry><Amt Ccy="DOP">1500.00</Amt><CdtDbtInd>CRDT</CdtDbtInd><BookgDt><Dt>2025-03-02</Dt></BookgDt>
+<AcctSvcrRef>B1</AcctSvcrRef><NtryDtls><TxDtls><Refs><EndToEndId>NOTPROVIDED</EndToEndId></Refs>
+<RltdPties><Dbtr><Nm>Ana</Nm></Dbtr></RltdPties><RmtInf><Ustrd>INV/2025/0001</Ustrd></RmtInf></TxDtls></NtryDtls></Ntry>
+<Ntry><Amt Ccy="DOP">20.00</Amt><CdtDbtInd>DBIT</CdtDbtInd><ValDt><DtTm>2025-03-03T10:00:00</DtTm></ValDt></Ntry>
+</Stmt></BkToCstmrStmt></Document>"""
+    rows = list(parser.read_statement(io.BytesIO(data)))
+    assert rows[0]["bank_ref"] == "B1"
+    assert rows[0]["reference"] == ""
+    assert rows[0]["partner_name"] == "Ana"
+    assert rows[0]["description"] == "INV/2025/0001"
+    assert rows[1]["amount"] == -20.0
+    assert rows[1]["date"] == date(2025, 3, 3)
+
+
+def test_row_key_depends_on_content():
+    row = dict(parser.EMPTY_ROW, date=date(2025, 3, 2), amount=10.0, description="Deposit")
+    assert parser.row_key(row) == parser.row_key(dict(row))
+    assert parser.row_key(row) != parser.row_key(dict(row, amount=10.01))
+    assert parser.row_key(row) != parser.row_key(dict(row, description="Deposit 2"))
+
+
+def _transfer(id, reference, amount, day):
+    return SimpleNamespace(
+        _name="isp.bank.transfer.payment",
+        id=id,
+        name=f"BTP{id}",
+        reference=reference,
+        amount=amount,
+        transfer_datetime=datetime.combine(day, datetime.min.time()),
+    )
+
+
+def _invoice(id, name, amount, partner):
+    return SimpleNamespace(
+        _name="account.move",
+        id=id,
+        name=name,
+        payment_reference=name,
+        amount_residual=amount,
+        partner_id=SimpleNamespace(name=partner),
+    )
+
+
+def _row(**values):
+    return dict(parser.EMPTY_ROW, **values)
+
+
+def test_match_scoring():
+    day = date(2025, 3, 2)
+    transfers = [_transfer(1, "REF-1001", 100.0, day), _transfer(2, "REF-2002", 50.0, day)]
+    invoices = [_invoice(7, "INV/2025/0007", 80.0, "Ana Perez")]
+
+    def score(row):
+        return matcher.StatementMatcher(transfers, invoices, timedelta(days=3)).match(row)[1]
+
+    assert score(_row(date=day, amount=100.0, reference="REF-1001")) == 100
+    assert score(_row(date=day + timedelta(days=10), amount=100.0, reference="REF-1001")) == 85
+    assert score(_row(date=day, amount=99.0, reference="REF-1001")) == 50
+    assert score(_row(date=day, amount=80.0, description="Pago INV/2025/0007")) == 95
+    assert score(_row(date=day, amount=50.0, reference="unknown")) == 60
+    assert score(_row(date=day, amount=80.0, partner_name=" ana perez ")) == 70
+    assert score(_row(date=day, amount=12.0)) == 0
+
+
+def test_date_off_match_stays_below_auto_approval():
+    day = date(2025, 3, 2)
+    record, confidence, _message = matcher.StatementMatcher(
+        [_transfer(1, "REF-1001", 100.0, day)], [], timedelta(days=3)
+    ).match(_row(date=day + timedelta(days=30), amount=100.0, reference="REF-1001"))
+    assert record.id == 1
+    assert confidence < 90
+
+
+def test_match_hands_each_record_to_one_row():
+    day = date(2025, 3, 2)
+    statement = matcher.StatementMatcher([_transfer(1, "REF-1001", 100.0, day)], [], timedelta(days=3))
+    row = _row(date=day, amount=100.0, reference="REF-1001")
+    assert statement.match(row)[0].id == 1
+    assert statement.match(row)[0] is None
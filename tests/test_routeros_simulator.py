@@ -0,0 +1,78 @@
+import socket
+import time
+
+from tools.routeros_simulator import RouterOSSimulator, encode_sentence, read_sentence
+
+
+class Session:
+    def __init__(self, address):
+        self.sock = socket.create_connection(address, timeout=5)
+        self.stream = self.sock.makefile("rb")
+
+    def send(self, *words):
+        self.sock.sendall(encode_sentence(words))
+
+    def replies(self):
+        """Read sentences up to and including the next !done/!fatal."""
+        sentences = []
+        while True:
+            sentence = read_sentence(self.stream)
+            sentences.append(sentence)
+            if sentence[0] in ("!done", "!fatal"):
+                return sentences
+
+    def call(self, *words):
+        self.send(*words)
+        return self.replies()
+
+    def close(self):
+        self.stream.close()
+        self.sock.close()
+
+
+def test_login_add_print_and_duplicate_trap():
+    with RouterOSSimulator(users={"odoo": "secret"}) as sim:
+        session = Session(sim.address)
+        assert session.call("/ppp/secret/print")[0] == ["!trap", "=message=not logged in"]
+        assert session.call("/login", "=name=odoo", "=password=secret") == [["!done"]]
+        done = session.call("/ppp/secret/add", "=name=alice", "=password=x", "=disabled=no")
+        assert done[0][0] == "!done" and done[0][1].startswith("=ret=*")
+        trap = session.call("/ppp/secret/add", "=name=alice", "=password=y")
+        assert trap[0][:2] == ["!trap", "=message=failure: already have such entry"]
+        rows = session.call("/ppp/secret/print", "?name=alice", "=.proplist=name,disabled")
+        assert rows[0] == ["!re", "=name=alice", "=disabled=false"]
+        assert session.call("/ppp/secret/print", "=count-only=") == [["!done", "=ret=1"]]
+        session.close()
+
+
+def test_tagged_pipeline_and_faults():
+    with RouterOSSimulator() as sim:
+        session = Session(sim.address)
+        session.call("/login", "=name=admin", "=password=admin")
+        sim.inject(r"^/queue/simple/add$", "trap", message="simulated busy", category=2)
+        session.send("/queue/simple/add", "=name=q1", "=target=10.0.0.1/32", ".tag=1")
+        session.send("/system/identity/print", ".tag=2")
+        first, second = session.replies(), session.replies()
+        assert first[0] == ["!trap", "=message=simulated busy", "=category=2", ".tag=1"]
+        assert second[0] == ["!re", "=name=sim-router", ".tag=2"]
+        assert sim.state.rows("/queue/simple") == []
+
+        sim.inject(r"^/system/resource/print$", "drop")
+        session.send("/system/resource/print")
+        assert session.stream.read(1) == b""
+        session.close()
+
+
+def test_latency_does_not_serialize_pipeline():
+    with RouterOSSimulator(latency=0.2) as sim:
+        session = Session(sim.address)
+        session.call("/login", "=name=admin", "=password=admin")
+        sim.inject(r"^/system/resource/print$", "delay", delay=0.3)
+        started = time.monotonic()
+        session.send("/system/resource/print", ".tag=slow")
+        for tag in range(5):
+            session.send("/system/identity/print", f".tag={tag}")
+        tags = [session.replies()[-1][-1] for _ in range(6)]
+        assert time.monotonic() - started < 0.9
+        assert tags[-1] == ".tag=slow"
+        session.close()
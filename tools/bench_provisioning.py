@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""Provisioning throughput benchmark.
+
+Seeds a synthetic fleet (sectors, routers, plans, subscriptions) in an Odoo
+database, drives activate/suspend/reconnect/change_plan/terminate waves
+through isp.provisioning_job and prints a JSON report per wave: jobs/s,
+p50/p95/p99 latency, RouterOS round-trips and SQL queries per job.
+
+Run it inside the Odoo container against a throwaway database, e.g.:
+
+    python3 tools/bench_provisioning.py -c /etc/odoo/odoo.conf -d bench --subs 2000 --output bench.json
+
+The seeded records are removed at the end unless --keep is given.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WAVES = ("activate", "suspend", "reconnect", "change_plan", "terminate")
+
+# Parameters the benchmark overrides while it runs.
+BENCH_PARAMS = ("isp_mikrotik.dry_run", "isp_core.job_worker_threads", "isp_core.job_time_limit", "isp_core.job_batch_size")
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def summarize(values):
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+class Benchmark:
+    def __init__(self, env, args):
+        self.env = env
+        self.args = args
+        self.run_id = uuid.uuid4().hex[:8]
+        self.simulators = []
+        self.saved_params = {}
+        self.records = {}
+
+    def seed(self):
+        env, args = self.env, self.args
+        params = env["ir.config_parameter"].sudo()
+        for key in BENCH_PARAMS:
+            self.saved_params[key] = params.get_param(key)
+        params.set_param("isp_mikrotik.dry_run", "1" if args.backend == "dry_run" else "0")
+        params.set_param("isp_core.job_worker_threads", str(args.threads))
+        params.set_param("isp_core.job_batch_size", str(args.batch_size))
+        params.set_param("isp_core.job_time_limit", "3600")
+
+        sectors = env["isp.sector"].create(
+            [{"name": f"Bench {self.run_id} {i}", "code": f"B{self.run_id}{i}"} for i in range(args.sectors)]
+        )
+        device_vals = []
+        for sector in sectors:
+            for index in range(args.routers):
+                host, port = "127.0.0.1", 8728
+                if args.backend == "simulator":
+                    from tools.routeros_simulator import RouterOSSimulator
+
+                    simulator = RouterOSSimulator(users={"bench": "bench"}, latency=args.latency).start()
+                    self.simulators.append(simulator)
+                    host, port = simulator.address
+                device_vals.append(
+                    {
+                        "name": f"{sector.code}-R{index}",
+                        "device_type": "mikrotik",
+                        "sector_id": sector.id,
+                        "mgmt_ip": host,
+                        "mgmt_port": port,
+                    }
+                )
+        devices = env["isp.device"].create(device_vals)
+        routers = env["isp.mikrotik.router"].create([{"device_id": device.id, "api_user": "bench"} for device in devices])
+        for router in routers:
+            params.set_param(f"isp_mikrotik.router_password.{router.id}", "bench")
+        plans = env["isp.service_plan"].create(
+            [
+                {"name": f"Bench {self.run_id} DHCP 10", "service_type": "dhcp", "download_mbps": 10, "upload_mbps": 5},
+                {"name": f"Bench {self.run_id} DHCP 50", "service_type": "dhcp", "download_mbps": 50, "upload_mbps": 10},
+                {"name": f"Bench {self.run_id} PPPoE 100", "service_type": "pppoe", "download_mbps": 100, "upload_mbps": 20},
+                {"name": f"Bench {self.run_id} PPPoE 200", "service_type": "pppoe", "download_mbps": 200, "upload_mbps": 40},
+            ]
+        )
+        partners = env["res.partner"].create([{"name": f"Bench {self.run_id} {i}"} for i in range(args.subs)])
+        routers_by_sector = {}
+        for router in routers:
+            routers_by_sector.setdefault(router.sector_id.id, []).append(router)
+        sub_vals = []
+        for i, partner in enumerate(partners):
+            sector = sectors[i % len(sectors)]
+            sector_routers = routers_by_sector[sector.id]
+            plan = plans[i % len(plans)]
+            sub_vals.append(
+                {
+                    "partner_id": partner.id,
+                    "plan_id": plan.id,
+                    "sector_id": sector.id,
+                    "router_id": sector_routers[(i // len(sectors)) % len(sector_routers)].id,
+                    "auth_method": plan.service_type,
+                    "dhcp_mode": "static",
+                    "service_ip": f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}",
+                    "service_mac": "02:00:%02X:%02X:%02X:%02X" % (i >> 24 & 255, i >> 16 & 255, i >> 8 & 255, i & 255),
+                    "gps_lat": 18.47,
+                    "gps_lng": -69.9,
+                }
+            )
+        subscriptions = env["isp.subscription"].create(sub_vals)
+        self.records = {
+            "sectors": sectors,
+            "devices": devices,
+            "routers": routers,
+            "plans": plans,
+            "partners": partners,
+            "subscriptions": subscriptions,
+        }
+        env.cr.commit()
+
+    def queue_wave(self, wave):
+        subs = self.records["subscriptions"]
+        half = subs[: len(subs) // 2]
+        if wave == "activate":
+            return subs._queue_jobs("activate_subscription")
+        if wave == "suspend":
+            return half._queue_jobs("suspend_subscription")
+        if wave == "reconnect":
+            return half._queue_jobs("reconnect_subscription")
+        if wave == "change_plan":
+            plans = self.records["plans"]
+            moved = subs[: len(subs) // 4]
+            # Swap each subscription to the other plan of the same service type.
+            for plan_from, plan_to in ((plans[0], plans[1]), (plans[2], plans[3])):
+                moved.filtered(lambda sub: sub.plan_id == plan_from).write({"plan_id": plan_to.id})
+            return moved._queue_jobs("change_plan")
+        if wave == "terminate":
+            return subs._queue_jobs("terminate_subscription")
+        raise ValueError(f"Unknown wave: {wave}")
+
+    def run_wave(self, wave):
+        from odoo import fields
+        from odoo.addons.isp_mikrotik.models.routeros_client import ROUTEROS_STATS
+
+        env = self.env
+        Job = env["isp.provisioning_job"]
+        jobs = self.queue_wave(wave)
+        env.cr.commit()
+        stats = []
+        traffic = ROUTEROS_STATS.snapshot()
+        started = time.monotonic()
+        while True:
+            executed = len(stats)
+            Job.with_context(isp_job_stats=stats)._cron_run_pending_jobs()
+            env.cr.commit()
+            env.invalidate_all()
+            remaining = Job.search_count(
+                [
+                    ("id", "in", jobs.ids),
+                    ("state", "=", "queued"),
+                    "|",
+                    ("next_attempt_at", "=", False),
+                    ("next_attempt_at", "<=", fields.Datetime.now()),
+                ]
+            )
+            # Stop when done, or when nothing moves (jobs waiting on a backoff or a busy worker).
+            if not remaining or len(stats) == executed:
+                break
+        elapsed = time.monotonic() - started
+        after = ROUTEROS_STATS.snapshot()
+        ours = [entry for entry in stats if entry["job_id"] in set(jobs.ids)]
+        count = len(ours) or 1
+        states = {}
+        for job in Job.browse(jobs.ids):
+            states[job.state] = states.get(job.state, 0) + 1
+        return {
+            "wave": wave,
+            "jobs": len(jobs),
+            "executions": len(ours),
+            "states": states,
+            "seconds": round(elapsed, 3),
+            "jobs_per_sec": round(len(ours) / elapsed, 2) if elapsed else None,
+            "exec_ms": summarize([round((entry["finished"] - entry["started"]) * 1000, 2) for entry in ours]),
+            "end_to_end_ms": summarize([round((entry["finished"] - started) * 1000, 2) for entry in ours]),
+            "round_trips_per_job": round((after["round_trips"] - traffic["round_trips"]) / count, 2),
+            "commands_per_job": round((after["commands"] - traffic["commands"]) / count, 2),
+            "queries_per_job": round(statistics.mean(entry["queries"] for entry in ours), 2) if ours else None,
+        }
+
+    def cleanup(self):
+        env = self.env
+        env.cr.rollback()
+        params = env["ir.config_parameter"].sudo()
+        for key, value in self.saved_params.items():
+            params.set_param(key, value)
+        if self.records:
+            subs = self.records["subscriptions"]
+            devices = self.records["devices"]
+            env["isp.provisioning_job"].search(
+                ["|", ("subscription_id", "in", subs.ids), ("device_id", "in", devices.ids)]
+            ).unlink()
+            env["isp.audit_log"].search(
+                [
+                    "|",
+                    "&",
+                    ("record_model", "=", "isp.subscription"),
+                    ("record_id", "in", subs.ids),
+                    "&",
+                    ("record_model", "=", "isp.device"),
+                    ("record_id", "in", devices.ids),
+                ]
+            ).unlink()
+            for router in self.records["routers"]:
+                params.search([("key", "=", f"isp_mikrotik.router_password.{router.id}")]).unlink()
+            for key in ("subscriptions", "routers", "devices", "partners", "plans", "sectors"):
+                self.records[key].unlink()
+        env.cr.commit()
+        for simulator in self.simulators:
+            simulator.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ISP provisioning job throughput")
+    parser.add_argument("-c", "--config", help="Odoo configuration file")
+    parser.add_argument("-d", "--db", required=True, help="Database (use a throwaway one)")
+    parser.add_argument("--sectors", type=int, default=4, help="Sectors to seed")
+    parser.add_argument("--routers", type=int, default=1, help="Routers per sector")
+    parser.add_argument("--subs", type=int, default=1000, help="Subscriptions to seed")
+    parser.add_argument("--backend", choices=("dry_run", "simulator"), default="dry_run", help="RouterOS backend")
+    parser.add_argument("--latency", type=float, default=0.002, help="Simulated router latency per command (s)")
+    parser.add_argument("--threads", type=int, default=1, help="isp_core.job_worker_threads during the run")
+    parser.add_argument("--batch-size", type=int, default=20, help="isp_core.job_batch_size during the run")
+    parser.add_argument("--waves", default=",".join(WAVES), help="Comma-separated waves to run, in order")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--keep", action="store_true", help="Keep the seeded records")
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    import odoo
+    from odoo.modules.registry import Registry
+    from odoo.tools import config
+
+    config.parse_config(["-c", args.config] if args.config else [])
+    registry = Registry(args.db)
+    report = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("config", "output")},
+        "waves": [],
+    }
+    with registry.cursor() as cr:
+        env = odoo.api.Environment(cr, odoo.api.SUPERUSER_ID, {})
+        bench = Benchmark(env, args)
+        try:
+            bench.seed()
+            for wave in [wave.strip() for wave in args.waves.split(",") if wave.strip()]:
+                result = bench.run_wave(wave)
+                report["waves"].append(result)
+                print(f"{wave}: {result['jobs_per_sec']} jobs/s", file=sys.stderr)
+        finally:
+            if not args.keep:
+                bench.cleanup()
+
+    data = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            handle.write(data + "\n")
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    main()
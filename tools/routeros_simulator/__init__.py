@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+from .simulator import Fault, RouterOSSimulator, RouterState, Trap, encode_sentence, read_sentence
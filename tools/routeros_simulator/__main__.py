@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import argparse
+import time
+
+from .simulator import RouterOSSimulator, RouterState
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a simulated RouterOS API server")
+    parser.add_argument("--host", default="127.0.0.1", help="Listen address")
+    parser.add_argument("--port", type=int, default=8728, help="Listen port")
+    parser.add_argument("--user", default="admin", help="API user")
+    parser.add_argument("--password", default="admin", help="API password")
+    parser.add_argument("--identity", default="sim-router", help="System identity")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added before every answer")
+    parser.add_argument("--secrets", type=int, default=0, help="Pre-seed N PPP secrets and simple queues")
+    args = parser.parse_args()
+
+    state = RouterState(identity=args.identity)
+    state.seed("/ppp/secret", ({"name": f"sim{i}", "password": "x", "service": "pppoe"} for i in range(args.secrets)))
+    state.seed(
+        "/queue/simple",
+        ({"name": f"sim{i}", "target": f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}/32"} for i in range(args.secrets)),
+    )
+    simulator = RouterOSSimulator(args.host, args.port, users={args.user: args.password}, latency=args.latency, state=state)
+    print(f"RouterOS simulator listening on {args.host}:{simulator.address[1]}")
+    with simulator:
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+    print(f"{state.commands} commands, {simulator.sessions} sessions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+"""In-memory RouterOS API server speaking the binary API protocol over TCP.
+
+It answers real clients (librouteros, the asyncio client of isp_mikrotik)
+with ``!re``/``!done``/``!trap``/``!fatal`` sentences, echoes ``.tag`` so
+pipelined commands work, and keeps generic in-memory tables. Latency and
+faults can be injected per command path.
+"""
+import hashlib
+import heapq
+import itertools
+import re
+import socketserver
+import threading
+import time
+
+# Tables the simulator knows, with the columns that must be unique per row.
+TABLES = {
+    "/interface": ("name",),
+    "/interface/ethernet": ("name",),
+    "/interface/bridge": ("name",),
+    "/interface/bridge/port": ("interface",),
+    "/ip/address": ("address",),
+    "/ip/pool": ("name",),
+    "/ip/dhcp-server": ("name",),
+    "/ip/dhcp-server/network": ("address",),
+    "/ip/dhcp-server/lease": ("address",),
+    "/ip/hotspot": ("name",),
+    "/ip/hotspot/profile": ("name",),
+    "/ip/hotspot/user": ("name",),
+    "/ip/hotspot/user/profile": ("name",),
+    "/ip/hotspot/active": (),
+    "/ip/hotspot/walled-garden": (),
+    "/ip/firewall/address-list": ("list", "address"),
+    "/ip/firewall/filter": (),
+    "/ip/firewall/nat": (),
+    "/ip/firewall/mangle": (),
+    "/ppp/secret": ("name",),
+    "/ppp/profile": ("name",),
+    "/ppp/active": (),
+    "/queue/simple": ("name",),
+    "/queue/type": ("name",),
+    "/queue/tree": ("name",),
+    "/user": ("name",),
+}
+
+# Tables addressed by name in "numbers=" besides their ".id".
+NAMED_KEYS = ("name", "address")
+
+
+def encode_length(length):
+    if length < 0x80:
+        return bytes([length])
+    if length < 0x4000:
+        return (length | 0x8000).to_bytes(2, "big")
+    if length < 0x200000:
+        return (length | 0xC00000).to_bytes(3, "big")
+    if length < 0x10000000:
+        return (length | 0xE0000000).to_bytes(4, "big")
+    return b"\xf0" + length.to_bytes(4, "big")
+
+
+def encode_sentence(words):
+    data = b""
+    for word in words:
+        raw = word.encode("utf-8")
+        data += encode_length(len(raw)) + raw
+    return data + b"\x00"
+
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) < size:
+        raise EOFError("connection closed")
+    return data
+
+
+def read_length(stream):
+    first = _read_exactly(stream, 1)[0]
+    if first < 0x80:
+        return first
+    if first < 0xC0:
+        return ((first & 0x3F) << 8) | _read_exactly(stream, 1)[0]
+    if first < 0xE0:
+        return ((first & 0x1F) << 16) | int.from_bytes(_read_exactly(stream, 2), "big")
+    if first < 0xF0:
+        return ((first & 0x0F) << 24) | int.from_bytes(_read_exactly(stream, 3), "big")
+    return int.from_bytes(_read_exactly(stream, 4), "big")
+
+
+def read_sentence(stream):
+    words = []
+    while True:
+        length = read_length(stream)
+        if not length:
+            return words
+        words.append(_read_exactly(stream, length).decode("utf-8", errors="replace"))
+
+
+class Trap(Exception):
+    def __init__(self, message, category=None):
+        super().__init__(message)
+        self.message = message
+        self.category = category
+
+
+class Fault:
+    """A fault injected on commands whose path matches ``pattern``.
+
+    ``kind`` is ``trap`` (answer ``!trap`` with ``message``), ``fatal`` (send
+    ``!fatal`` and close), ``drop`` (close the socket without answering) or
+    ``delay`` (sleep ``delay`` seconds, then answer normally). ``times`` limits
+    how often it fires; None fires forever.
+    """
+
+    def __init__(self, pattern, kind, message="simulated failure", delay=0.0, times=1, category=None):
+        self.pattern = re.compile(pattern)
+        self.kind = kind
+        self.message = message
+        self.delay = delay
+        self.times = times
+        self.category = category
+
+    def take(self, path):
+        if self.times is not None and self.times <= 0:
+            return False
+        if not self.pattern.search(path):
+            return False
+        if self.times is not None:
+            self.times -= 1
+        return True
+
+
+class RouterState:
+    """Tables and counters shared by every session of one simulated router."""
+
+    def __init__(self, identity="sim-router", version="7.14 (stable)"):
+        self.lock = threading.RLock()
+        self.tables = {path: [] for path in TABLES}
+        self.identity = {"name": identity}
+        self.resource = {"version": version, "uptime": "1d00:00:00", "board-name": "SIM", "cpu-load": "1"}
+        self._ids = itertools.count(1)
+        self.commands = 0
+        self.logins = 0
+
+    def next_id(self):
+        return f"*{next(self._ids):X}"
+
+    def seed(self, path, rows):
+        with self.lock:
+            for row in rows:
+                self.add(path, dict(row))
+
+    def rows(self, path):
+        return self.tables[path]
+
+    def find(self, path, numbers):
+        rows = self.tables[path]
+        found = []
+        for number in str(numbers).split(","):
+            number = number.strip()
+            match = next(
+                (row for row in rows if row[".id"] == number or any(row.get(key) == number for key in NAMED_KEYS)),
+                None,
+            )
+            if match is None:
+                raise Trap("no such item", category=0)
+            found.append(match)
+        return found
+
+    def add(self, path, attrs):
+        unique = TABLES[path]
+        if unique and any(all(row.get(key) == attrs.get(key) for key in unique) for row in self.tables[path]):
+            raise Trap("failure: already have such entry", category=1)
+        row = {".id": self.next_id(), "disabled": "false"}
+        row.update({key: _to_api(value) for key, value in attrs.items()})
+        self.tables[path].append(row)
+        return row[".id"]
+
+
+def _to_api(value):
+    if value in ("yes", "true"):
+        return "true"
+    if value in ("no", "false"):
+        return "false"
+    return value
+
+
+def _matches(row, queries):
+    for query in queries:
+        if query.startswith("-"):
+            if query[1:] in row:
+                return False
+            continue
+        key, sep, value = query.partition("=")
+        if not sep:
+            if key not in row:
+                return False
+        elif str(row.get(key, "")) != _to_api(value):
+            return False
+    return True
+
+
+class SimulatorHandler(socketserver.StreamRequestHandler):
+    """One API session. Replies are written by a writer thread once their delay
+    (the server latency, plus any ``delay`` fault) has passed, so the reader keeps
+    taking pipelined sentences while earlier answers are still pending."""
+
+    def setup(self):
+        super().setup()
+        self.outbox = []
+        self.outbox_seq = itertools.count()
+        self.outbox_ready = threading.Condition()
+        self.closing = False
+        self.writer = threading.Thread(target=self._write_replies, daemon=True)
+        self.writer.start()
+
+    def finish(self):
+        with self.outbox_ready:
+            self.closing = True
+            self.outbox_ready.notify()
+        # Answers already due go out before the socket closes.
+        self.writer.join()
+        super().finish()
+
+    def _write_replies(self):
+        while True:
+            with self.outbox_ready:
+                while True:
+                    if self.outbox:
+                        wait = self.outbox[0][0] - time.monotonic()
+                        if wait <= 0:
+                            data = heapq.heappop(self.outbox)[2]
+                            break
+                        self.outbox_ready.wait(wait)
+                    elif self.closing:
+                        return
+                    else:
+                        self.outbox_ready.wait()
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except OSError:
+                return
+
+    def handle(self):
+        server = self.server
+        self.logged_in = False
+        self.challenge = None
+        with server.state.lock:
+            server.sessions += 1
+        try:
+            while True:
+                words = read_sentence(self.rfile)
+                if not words:
+                    continue
+                if not self._dispatch(words):
+                    return
+        except (EOFError, ConnectionError, OSError):
+            return
+
+    def _send(self, *sentences, delay=0.0):
+        data = b"".join(encode_sentence(words) for words in sentences)
+        due = time.monotonic() + self.server.latency + delay
+        with self.outbox_ready:
+            heapq.heappush(self.outbox, (due, next(self.outbox_seq), data))
+            self.outbox_ready.notify()
+
+    def _dispatch(self, words):
+        server = self.server
+        path, attrs, queries, tag = words[0], {}, [], None
+        for word in words[1:]:
+            if word.startswith(".tag="):
+                tag = word[5:]
+            elif word.startswith("="):
+                key, _, value = word[1:].partition("=")
+                attrs[key] = value
+            elif word.startswith("?"):
+                queries.append(word[1:])
+        tag_words = [f".tag={tag}"] if tag is not None else []
+        delay = 0.0
+        fault = server.take_fault(path)
+        if fault:
+            if fault.kind == "delay":
+                delay = fault.delay
+            elif fault.kind == "drop":
+                return False
+            elif fault.kind == "fatal":
+                self._send(["!fatal", fault.message])
+                return False
+            elif fault.kind == "trap":
+                trap = ["!trap", f"=message={fault.message}"]
+                if fault.category is not None:
+                    trap.append(f"=category={fault.category}")
+                self._send(trap + tag_words, ["!done"] + tag_words)
+                return True
+        with server.state.lock:
+            server.state.commands += 1
+        if path == "/quit":
+            self._send(["!fatal", "session terminated on request"])
+            return False
+        try:
+            if path == "/login":
+                replies = self._login(attrs)
+            elif not self.logged_in:
+                raise Trap("not logged in")
+            else:
+                replies = server.execute(path, attrs, queries)
+        except Trap as exc:
+            trap = ["!trap", f"=message={exc.message}"]
+            if exc.category is not None:
+                trap.append(f"=category={exc.category}")
+            self._send(trap + tag_words, ["!done"] + tag_words, delay=delay)
+            return True
+        rows, done = replies
+        sentences = [["!re"] + [f"={key}={value}" for key, value in row.items()] + tag_words for row in rows]
+        sentences.append(["!done"] + [f"={key}={value}" for key, value in done.items()] + tag_words)
+        self._send(*sentences, delay=delay)
+        return True
+
+    def _login(self, attrs):
+        users = self.server.users
+        name = attrs.get("name")
+        if "response" in attrs and self.challenge:
+            password = users.get(name)
+            expected = hashlib.md5(b"\x00" + (password or "").encode() + self.challenge).hexdigest()
+            if password is None or attrs["response"] != f"00{expected}":
+                raise Trap("invalid user name or password (6)")
+        elif "password" in attrs:
+            if name not in users or users[name] != attrs["password"]:
+                raise Trap("invalid user name or password (6)")
+        else:
+            # Pre-6.43 login: hand out an MD5 challenge first.
+            self.challenge = bytes(16)
+            return [], {"ret": self.challenge.hex()}
+        self.logged_in = True
+        with self.server.state.lock:
+            self.server.state.logins += 1
+        return [], {}
+
+
+class RouterOSSimulator(socketserver.ThreadingTCPServer):
+    """A simulated router listening on ``host:port`` (port 0 picks a free one).
+
+    Use it as a context manager, or call ``start``/``stop``. ``latency`` delays
+    every answer without holding back the commands pipelined after it;
+    ``inject`` queues faults.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, users=None, latency=0.0, state=None):
+        super().__init__((host, port), SimulatorHandler)
+        self.users = users if users is not None else {"admin": "admin"}
+        self.latency = latency
+        self.state = state or RouterState()
+        self.faults = []
+        self.sessions = 0
+        self._thread = None
+
+    @property
+    def address(self):
+        return self.server_address[0], self.server_address[1]
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="routeros_simulator", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def inject(self, pattern, kind, **kwargs):
+        fault = Fault(pattern, kind, **kwargs)
+        with self.state.lock:
+            self.faults.append(fault)
+        return fault
+
+    def take_fault(self, path):
+        with self.state.lock:
+            for fault in self.faults:
+                if fault.take(path):
+                    return fault
+        return None
+
+    def execute(self, path, attrs, queries):
+        """Run one command; return ``(rows, done_attrs)`` or raise ``Trap``."""
+        state = self.state
+        table, _, action = path.rpartition("/")
+        with state.lock:
+            if table in ("/system/identity", "/system/resource"):
+                target = state.identity if table == "/system/identity" else state.resource
+                if action == "print":
+                    return [dict(target)], {}
+                if action == "set" and table == "/system/identity":
+                    target.update(attrs)
+                    return [], {}
+            if table not in TABLES:
+                raise Trap("no such command prefix")
+            if action == "print":
+                proplist = [key for key in attrs.pop(".proplist", "").split(",") if key]
+                count_only = attrs.pop("count-only", None) is not None
+                if attrs:
+                    raise Trap(f"unknown parameter {next(iter(attrs))}")
+                rows = [row for row in state.rows(table) if _matches(row, queries)]
+                if count_only:
+                    return [], {"ret": str(len(rows))}
+                if proplist:
+                    rows = [{key: row[key] for key in proplist if key in row} for row in rows]
+                return [dict(row) for row in rows], {}
+            if action == "add":
+                return [], {"ret": state.add(table, attrs)}
+            if action in ("set", "remove", "enable", "disable"):
+                if "numbers" not in attrs:
+                    raise Trap("missing value for numbers")
+                rows = state.find(table, attrs.pop("numbers"))
+                if action == "remove":
+                    ids = {row[".id"] for row in rows}
+                    state.tables[table] = [row for row in state.rows(table) if row[".id"] not in ids]
+                else:
+                    if action != "set":
+                        attrs = {"disabled": "true" if action == "disable" else "false"}
+                    for row in rows:
+                        row.update({key: _to_api(value) for key, value in attrs.items()})
+                return [], {}
+            raise Trap("no such command")
+